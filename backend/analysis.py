@@ -0,0 +1,195 @@
+"""Lease analysis pipeline shared by the synchronous route and the RQ worker.
+
+Stages after text extraction: Gemini analysis, JSON parsing, optional
+compliance check against the user's master template, scan counting and
+persistence of the result.
+"""
+import functools
+import logging
+
+import chunking
+import clause_analysis
+import lease_versions
+import llm_guard
+import response_parsing
+from extraction import extract_text
+from firebase_client import get_bucket, get_db
+from lazy_imports import lazy_module
+from llm import analyze_lease, analyze_compliance
+from profiles import increment_scan_counts
+
+logger = logging.getLogger(__name__)
+
+firestore = lazy_module('firebase_admin.firestore')
+
+
+def parse_analysis_result(analysis_result_text):
+    """Parse Gemini's analysis JSON, wrapping the raw text if it isn't valid."""
+    try:
+        return response_parsing.parse_lease_analysis(analysis_result_text)
+    except response_parsing.ResponseParseError as parse_err:
+        logger.info(f"JSON Decode Error: {parse_err}")
+        logger.info(f"Raw Gemini Response: {analysis_result_text}")
+        # If response is not valid JSON, wrap raw text
+        return {
+            'raw_analysis': analysis_result_text,
+            'error_message': 'Analysis result was not valid JSON.'
+        }
+    except Exception as parse_err: # Catch other potential parsing errors
+        logger.info(f"Parsing Error: {parse_err}")
+        return {
+            'raw_analysis': analysis_result_text,
+            'error_message': 'An error occurred while parsing the analysis result.'
+        }
+
+
+def add_compliance_report(result_data, text, user_id, tier, user_profile):
+    """Compare against the commercial user's master template, if they have one."""
+    if tier != 'commercial' or not user_profile.get('complianceTemplate'):
+        return
+    logger.info(f"User {user_id} is commercial with a template. Running compliance check.")
+    template_info = user_profile['complianceTemplate']
+    storage_path = template_info.get('storagePath')
+    if not storage_path:
+        return
+
+    try:
+        blob = get_bucket().blob(storage_path)
+        template_bytes = blob.download_as_bytes()
+        template_text = extract_text(template_bytes)
+
+        if template_text:
+            logger.info("Successfully extracted text from master template. Analyzing compliance...")
+            compliance_result = analyze_compliance(text, template_text)
+            # Merge the compliance report into the main analysis result
+            result_data.update(compliance_result)
+        else:
+            logger.info("Warning: Could not extract text from the stored master template.")
+    except Exception as e:
+        logger.info(f"CRITICAL: Failed to download or process compliance template for user {user_id}: {e}")
+        result_data['compliance_report'] = {
+            "summary": "Error: Could not process the master compliance template.",
+            "deviations": [],
+            "missing_clauses": []
+        }
+
+
+def add_version_info(result_data, text, user_id, file_name=None, previous_lease_id=None):
+    """Link the lease to the one it revises, with a change summary (see lease_versions.py)."""
+    if 'error_message' in result_data:
+        return
+    db = get_db()
+    if db is None:
+        return
+    try:
+        lease_versions.attach_version(db, user_id, text, result_data, file_name=file_name,
+                                      previous_lease_id=previous_lease_id)
+    except Exception as e:
+        logger.info(f"Lease version detection failed for user {user_id}: {e}")
+
+
+def record_scan(user_id, tier, should_increment):
+    if should_increment and not increment_scan_counts(user_id, tier):
+        # Log error but proceed - analysis was done, just count failed
+        logger.info(f"CRITICAL: Failed to increment scan counts for user {user_id} (tier: {tier}) after successful analysis.")
+
+
+def save_lease(user_id, file_name, result_data, writer, lease_id=None, text=None):
+    """Persist the analysis as a new ``leases`` doc; returns its ID or None.
+
+    With the lease ``text`` its clause keys are stored too, so later uploads
+    can be recognised as new versions of it.
+    """
+    lease = {
+        'userId': user_id,
+        'fileName': file_name,
+        'status': 'complete' if 'error_message' not in result_data else 'error',
+        'analysis': result_data,
+        'createdAt': firestore.SERVER_TIMESTAMP
+    }
+    if text is not None:
+        lease['clauseKeys'] = lease_versions.clause_keys(text)
+    address_key = lease_versions.address_key((result_data.get('extracted_data') or {}).get('Property_Address'))
+    if address_key:
+        lease['propertyAddressKey'] = address_key
+    version = result_data.get('version')
+    if version:
+        lease['previousVersionId'] = version['previousVersionId']
+        lease['versionNumber'] = version['number']
+    try:
+        return writer('leases', lease, doc_id=lease_id)
+    except Exception as db_error:
+        logger.info(f"Firestore saving error: {db_error}")
+        return None
+
+
+def _analyze_chunk(chunk, index, count, tier=None):
+    analysis_result_text = analyze_lease(chunk, part=(index, count), tier=tier)
+    return parse_analysis_result(analysis_result_text) if analysis_result_text else None
+
+
+def _analyze_document(text, tier):
+    """Whole-document analysis; leases over ``chunking.LEASE_CHUNK_CHARS`` are analysed in chunks and merged."""
+    if len(text) > chunking.LEASE_CHUNK_CHARS:
+        return chunking.analyze_chunked(text, functools.partial(_analyze_chunk, tier=tier))
+    analysis_result_text = analyze_lease(text, tier=tier)
+    if not analysis_result_text:
+        return None
+    return parse_analysis_result(analysis_result_text)
+
+
+def analyze_lease_text(text, user_id, tier, user_profile, progress=None, file_name=None,
+                       previous_lease_id=None):
+    """Gemini analysis plus the optional compliance report; None if Gemini produced nothing.
+
+    Leases are analysed clause by clause first, reusing cached clauses (see
+    clause_analysis.py), and as a whole document if that isn't possible. A
+    revision of one of the user's leases (``previous_lease_id``, or one with the
+    same ``file_name`` or address) gets a change summary under ``version``.
+
+    ``progress(event, data)``, if given, is told about each stage as it
+    finishes: ``clauses`` per batch of annotated clauses, ``analysis`` once
+    the main analysis is done and ``compliance`` after the compliance check.
+
+    Raises ``chunking.DocumentTooLong`` before any Gemini call for a lease
+    too long to analyse. It is shed up front if this process is saturated
+    (llm_guard.admit_request); after that its clause, chunk and compliance
+    calls wait for admission slots rather than failing halfway.
+    """
+    chunking.check_length(text)
+    on_clauses = (lambda clauses: progress('clauses', clauses)) if progress else None
+    with llm_guard.admit_request('lease analysis'):
+        result_data = None
+        if clause_analysis.CLAUSE_ANALYSIS_ENABLED:
+            result_data = clause_analysis.analyze(text, tier=tier, on_clauses=on_clauses, user_id=user_id)
+        if result_data is None:
+            result_data = _analyze_document(text, tier)
+        if result_data is None:
+            return None
+        if progress:
+            progress('analysis', result_data)
+
+        add_compliance_report(result_data, text, user_id, tier, user_profile)
+    if progress and 'compliance_report' in result_data:
+        progress('compliance', {'compliance_report': result_data['compliance_report']})
+    add_version_info(result_data, text, user_id, file_name, previous_lease_id)
+    return result_data
+
+
+def run_lease_analysis(text, user_id, tier, user_profile, should_increment, file_name, writer,
+                       progress=None, previous_lease_id=None):
+    """Run every post-extraction stage for one lease.
+
+    ``writer(collection, data, doc_id=None)`` persists the result: the web app
+    passes ``write_behind.add``, workers pass ``persistence.write_now``.
+    Returns ``{'leaseId', 'analysis'}``, or None if Gemini produced nothing.
+    ``progress`` and ``previous_lease_id`` are passed on to ``analyze_lease_text``.
+    """
+    result_data = analyze_lease_text(text, user_id, tier, user_profile, progress=progress,
+                                     file_name=file_name, previous_lease_id=previous_lease_id)
+    if result_data is None:
+        return None
+
+    record_scan(user_id, tier, should_increment)
+    lease_id = save_lease(user_id, file_name, result_data, writer, text=text)
+    return {'leaseId': lease_id, 'analysis': result_data}
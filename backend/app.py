@@ -1,28 +1,17 @@
 import os
 import json
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
-import google.generativeai as genai
-import firebase_admin
-from firebase_admin import credentials, firestore, storage, auth
+from werkzeug.exceptions import RequestEntityTooLarge
 # from werkzeug.utils import secure_filename # No longer needed for saving temp files if done carefully
-import PyPDF2
 import io # Needed for reading file stream
 from dotenv import load_dotenv # Import dotenv
-import requests # For Maxelpay API call
 import base64 # For Maxelpay encryption
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes # For Maxelpay encryption
-from cryptography.hazmat.backends import default_backend # For Maxelpay encryption
 import time # For timestamp
 import uuid # For unique order ID
-import hmac
-import hashlib
-# Import the specific exception for permission errors
-from google.api_core.exceptions import PermissionDenied, GoogleAPIError 
 import datetime # Needed for daily scan logic
 import calendar # Added for days in month calculation
 # Add imports for file handling if needed (os is already imported)
-from PIL import Image # Potentially needed for image processing/validation
 import mimetypes # To determine image MIME type
 
 # --- Logging configuration ---
@@ -30,34 +19,72 @@ import logging
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
                     format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
-from tasks import queue, analyze, redis_conn
+
+load_dotenv() # Load environment variables from .env file (before modules read them)
+
+# --- Heavy dependencies (imported on first use to keep cold starts fast) ---
+from lazy_imports import lazy_module, is_available
+genai = lazy_module('google.generativeai')
+firebase_admin = lazy_module('firebase_admin')
+firestore = lazy_module('firebase_admin.firestore')
+auth = lazy_module('firebase_admin.auth')
+google_exceptions = lazy_module('google.api_core.exceptions')
+requests = lazy_module('requests') # For Maxelpay API call
+Image = lazy_module('PIL.Image') # Potentially needed for image processing/validation
+
+from firebase_client import get_db, get_bucket
+import queues
+import job_results
+import callbacks
+import signatures
+import singleflight
+import uploads
+import response_parsing
+import retrieval
+import model_router
+import progressive
+from uploads import SpoolingRequest, upload_limit
+import analysis
+import chunking
+import chat_sessions
+from persistence import write_behind
+from extraction import OCR_AVAILABLE, extract_text, render_page_png
+import llm
+import llm_executor
+import llm_guard
+from llm import gemini_api_keys
+from profiles import (
+    FREE_MONTHLY_SCANS,
+    PREMIUM_DAILY_SCANS,
+    PREMIUM_MONTHLY_SCANS,
+    get_fresh_user_profile,
+    get_or_create_user_profile,
+    increment_scan_counts,
+    invalidate_user_profile,
+    update_cached_profile,
+)
 
 
 # --- Optional OCR and Error Tracking ---
-try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
-except ImportError:
-    convert_from_bytes = None
-    pytesseract = None
-    logger.warning("pdf2image or pytesseract not available – rich PDF extraction will be limited to text only.")
-
-# Sentry for error tracking
-try:
-    import sentry_sdk
-    from sentry_sdk.integrations.flask import FlaskIntegration
-    SENTRY_DSN = os.environ.get('SENTRY_DSN')
-    if SENTRY_DSN:
+if not OCR_AVAILABLE:
+    logger.warning("pytesseract or Pillow not available – PDF extraction will be limited to text layers.")
+
+# Sentry for error tracking (only imported when a DSN is configured)
+SENTRY_DSN = os.environ.get('SENTRY_DSN')
+if SENTRY_DSN:
+    try:
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
         sentry_sdk.init(
             dsn=SENTRY_DSN,
             integrations=[FlaskIntegration()],
             traces_sample_rate=0.2,
         )
         logger.info("Sentry initialised for error tracking.")
-    else:
-        logger.info("Sentry DSN not set; error tracking disabled.")
-except ImportError:
-    logger.info("Warning: sentry_sdk not installed – error tracking disabled.")
+    except ImportError:
+        logger.info("Warning: sentry_sdk not installed – error tracking disabled.")
+else:
+    logger.info("Sentry DSN not set; error tracking disabled.")
 # --- End imports ---
 
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'heic', 'heif'}
@@ -66,34 +93,24 @@ MAX_IMAGE_SIZE_MB = 5
 MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
 
 # Placeholder for the actual PayID19 library - replace if needed
-try:
-    import payid19_python_sdk as payid19 
-except ImportError:
+if is_available('payid19_python_sdk'):
+    payid19 = lazy_module('payid19_python_sdk')
+else:
     logger.info("WARNING: PayID19 SDK placeholder not found. Payment endpoint will fail.")
     payid19 = None # Define it as None so the app doesn't crash
 
-load_dotenv() # Load environment variables from .env file
-
-# --- Load Gemini API Keys --- 
-# Load all potential keys, filtering out any that aren't set
-gemini_api_keys = [
-    key for key in [
-        os.environ.get('GEMINI_API_KEY_1'),
-        os.environ.get('GEMINI_API_KEY_2'),
-        os.environ.get('GEMINI_API_KEY_3'),
-        # Keep the original name as a fallback for backward compatibility or single-key use
-        os.environ.get('GEMINI_API_KEY')
-    ] if key
-]
-
+# --- Gemini API Keys (loaded in llm.py) --- 
 if not gemini_api_keys:
     logger.critical(
         "No Gemini API keys found in environment variables (GEMINI_API_KEY_1, _2, _3, or GEMINI_API_KEY)."
     )
     raise SystemExit(1)
 
-# --- Flask App and Firebase Initialization --- 
+# --- Flask App --- 
 app = Flask(__name__)
+# Uploads are spooled to disk with per-route size limits (see uploads.py)
+app.request_class = SpoolingRequest
+app.config['MAX_CONTENT_LENGTH'] = uploads.MAX_CONTENT_LENGTH
 
 # Allowed origins for CORS requests
 ALLOWED_ORIGINS = [
@@ -127,92 +144,32 @@ def apply_cors_headers(response):
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
     return response
 
-# --- Initialize Firebase Admin SDK (Handles Local and Deployed) ---
-db = None # Initialize db to None
-try:
-    firebase_sdk_json_str = os.environ.get('FIREBASE_ADMIN_SDK_JSON_CONTENT')
-    
-    if firebase_sdk_json_str:
-        # Deployed on Render (or env var set manually using JSON content)
-        logger.info("Using Firebase key from environment variable.")
-        firebase_sdk_config = json.loads(firebase_sdk_json_str)
-        cred = credentials.Certificate(firebase_sdk_config)
-        project_id = firebase_sdk_config.get('project_id')
-        # Initialize Firebase app when running with JSON content from env vars
-        firebase_admin.initialize_app(cred, {
-            'storageBucket': f"{project_id}.appspot.com"
-        })
-        logger.info("Firebase Admin SDK initialized successfully.")
-        db = firestore.client()
-    else:
-        # Running Locally - Check for Render Secret File path OR local path
-        render_secret_path = '/etc/secrets/firebase_key.json'
-        local_key_path = 'lease-shield-ai-firebase-admin-sdk.json'  # Assuming file is in same dir as app.py
-
-        if os.path.exists(render_secret_path):
-            logger.info(f"Using Firebase key from Render secret file: {render_secret_path}")
-            cred = credentials.Certificate(render_secret_path)
-            # Attempt to get project_id from credential object
-            try:
-                project_id = cred.project_id
-            except Exception as cred_err:
-                logger.warning(f"Could not get project_id from credential object: {cred_err}")
-                try:
-                    with open(render_secret_path, 'r') as f:
-                        key_data = json.load(f)
-                    project_id = key_data.get('project_id')
-                except Exception as parse_err:
-                    logger.error(f"Error parsing secret file for project_id: {parse_err}")
-                    project_id = None
-        elif os.path.exists(local_key_path):
-            logger.info(f"Using Firebase key from local file: {local_key_path}")
-            cred = credentials.Certificate(local_key_path)
-            # Attempt to parse the file to get project_id
-            try:
-                with open(local_key_path, 'r') as f:
-                    key_data = json.load(f)
-                project_id = key_data.get('project_id')
-            except Exception as parse_err:
-                logger.error(f"Error parsing local key file for project_id: {parse_err}")
-                project_id = None
-        else:
-            raise FileNotFoundError(f"Firebase key file not found at {render_secret_path} or {local_key_path}")
-
-        if not project_id:
-            raise ValueError("Could not determine Firebase project ID from credentials.")
-
-        firebase_admin.initialize_app(cred, {
-            'storageBucket': f"{project_id}.appspot.com"
-        })
-        logger.info("Firebase Admin SDK initialized successfully.")
-        db = firestore.client()
-
-except FileNotFoundError as e:
-    logger.critical(f"Firebase Admin SDK JSON key file not found. {e}")
-    db = None # Ensure db is None if init fails
-except ValueError as e:
-    logger.critical(f"Invalid Firebase Admin SDK JSON content or missing project_id. {e}")
-    db = None # Ensure db is None if init fails
-except Exception as e:
-    logger.critical(f"Failed to initialize Firebase Admin SDK: {e}")
-    db = None # Ensure db is None if init fails
-
-# Only proceed if db was initialized
-if db is None:
-    logger.critical("Aborting application startup due to Firebase initialization failure.")
-    # Optional: exit the application if Firebase is absolutely required
-    # sys.exit(1) 
-
-
-
-# Max characters for pasted text analysis
-MAX_TEXT_LENGTH = 50000 # Approx 10-15 pages
+# Firebase Admin SDK is initialised lazily by firebase_client.get_db() on the
+# first request that needs it (see firebase_client.py).
+
+@app.before_request
+def start_write_behind():
+    """Make sure this worker process has a thread flushing the write spool."""
+    write_behind.start()
+
+# Max characters of an expense document sent to Gemini (leases are chunked instead)
+MAX_EXPENSE_TEXT_LENGTH = 50000 # Approx 10-15 pages
+# Longest a client may block on GET /api/jobs/<id>/result?wait=N. Only gevent
+# workers (SERVING_MODE=async, see gunicorn.conf.py) can afford to park a
+# request; a sync worker would be tied up for the whole wait, so it answers at once.
+SERVING_MODE = os.environ.get('SERVING_MODE', 'sync').lower()
+MAX_RESULT_WAIT_SECONDS = 30 if SERVING_MODE == 'async' else 0
+# RQ's default 180s is too short for OCR plus a Gemini round-trip
+ANALYSIS_JOB_TIMEOUT = int(os.environ.get('ANALYSIS_JOB_TIMEOUT', 900))
+# Time budgets for all Gemini calls of one request (see llm_executor.py); kept
+# under the gunicorn worker timeout
+ANALYZE_BUDGET_SECONDS = float(os.environ.get('ANALYZE_BUDGET_SECONDS', 240))
+CHAT_BUDGET_SECONDS = float(os.environ.get('CHAT_BUDGET_SECONDS', 120))
 
 # Verify Maxelpay webhook signature using HMAC SHA256
 def verify_maxelpay_signature(payload, signature, secret):
     try:
-        expected = hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).hexdigest()
-        return hmac.compare_digest(expected, signature or '')
+        return signatures.verify(payload, signature, secret)
     except Exception as e:
         logger.error(f"Signature verification error: {e}")
         return False
@@ -220,7 +177,8 @@ def verify_maxelpay_signature(payload, signature, secret):
 # Verify Firebase Auth token
 def verify_token(id_token):
     try:
-        decoded_token = firebase_admin.auth.verify_id_token(id_token)
+        get_db() # Ensures the Firebase app is initialised
+        decoded_token = auth.verify_id_token(id_token)
         return decoded_token['uid']
     except Exception as e:
         logger.error(f"Token verification error: {e}")
@@ -231,175 +189,19 @@ def is_admin(user_id):
     if not user_id:
         return False
     try:
-        user = firebase_admin.auth.get_user(user_id)
+        get_db() # Ensures the Firebase app is initialised
+        user = auth.get_user(user_id)
         admin_email = os.environ.get('ADMIN_EMAIL')
         return admin_email and user.email == admin_email
     except Exception as e:
         logger.error(f"Error checking admin status for {user_id}: {e}")
         return False
 
-def extract_pdf_rich_content(file_stream):
-    """
-    Extracts text from a PDF, using OCR as a fallback for scanned images.
-    """
-    text = ""
-    # Try extracting text directly
-    try:
-        file_stream.seek(0)
-        reader = PyPDF2.PdfReader(file_stream)
-        for page in reader.pages:
-            text += page.extract_text() or ""
-    except Exception as e:
-        logger.info(f"PyPDF2 error: {e}. Might be a scanned PDF.")
-
-    # If no text, or if OCR libraries are available, try OCR
-    if not text.strip() and convert_from_bytes and pytesseract:
-        logger.info("Falling back to OCR for PDF content.")
-        try:
-            file_stream.seek(0)
-            images = convert_from_bytes(file_stream.read())
-            for image in images:
-                text += pytesseract.image_to_string(image) + "\n"
-        except Exception as ocr_error:
-            logger.info(f"OCR processing failed: {ocr_error}")
-            # Potentially return a specific error message if OCR fails
-            return None
-            
-    if not text.strip():
-        logger.info("Warning: PDF appears to be empty or unreadable.")
-        return None
-        
-    return text
-
-# Modified to accept a file stream/object instead of path
-def extract_pdf_text(file_stream):
-    text = ""
-    try:
-        reader = PyPDF2.PdfReader(file_stream)
-        for page_num in range(len(reader.pages)):
-            page = reader.pages[page_num]
-            # Append a real newline between pages rather than a literal "\n"
-            text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        logger.info(f"PDF extraction error: {e}")
-        return None
-
-# Analyze lease with Gemini
-def analyze_lease(text):
-    """Analyze lease text using Gemini 2.5 Pro with a double-pass JSON correction step."""
-    base_prompt = f"""
-    Analyze the following lease document. Extract the specified information and format the output ONLY as a single JSON object. 
-    Do not include any text before or after the JSON object (no markdown fences).
-    The JSON object must have these top-level keys: 'extracted_data', 'clause_summaries', 'risks', and 'score'.
-
-    1. extracted_data: An object with these exact keys. If a value cannot be found, use the string "Not Found".
-       - Landlord_Name
-       - Tenant_Name
-       - Property_Address
-       - Lease_Start_Date
-       - Lease_End_Date
-       - Monthly_Rent_Amount
-       - Rent_Due_Date
-       - Security_Deposit_Amount
-       - Lease_Term
-
-    2. clause_summaries: Summarize these clauses using the exact key names (omit if not present or use "Not Found").
-       - Termination_Clause
-       - Pet_Policy
-       - Subletting_Policy
-       - Maintenance_Responsibilities
-       - Late_Fee_Policy
-       - Renewal_Options
-
-    3. risks: Array of strings describing unusual or unfavorable clauses. Return [] if none.
-
-    4. score: Integer from 0 (unfavorable) to 100 (favorable), based on number and severity of risks.
-
-    Lease Document Text:
-    --- START ---
-    {text}
-    --- END ---
-
-    Output ONLY the JSON.
-    """
-
-    try:
-        # Pass 1 (Pro, lower temperature for precision)
-        model_pass1 = get_gemini_model(model_name='gemini-2.5-pro', temperature=0.2)
-        resp1 = model_pass1.generate_content(base_prompt)
-        cleaned1 = (resp1.text or '').strip().lstrip('```json').rstrip('```').strip()
-
-        # Try to parse
-        try:
-            json.loads(cleaned1)
-            return cleaned1
-        except Exception:
-            pass
-
-        # Pass 2 (Refinement) - ask model to strictly fix JSON
-        refine_prompt = f"""
-        The following was intended to be a single strict JSON object response but may contain formatting issues or extra commentary.
-        Return ONLY a corrected JSON object that strictly adheres to the schema described earlier.
-        If any fields are missing, include them with the value "Not Found" where appropriate.
-        Response to correct:
-        ---
-        {cleaned1}
-        ---
-        """
-        model_pass2 = get_gemini_model(model_name='gemini-2.5-pro', temperature=0.1)
-        resp2 = model_pass2.generate_content(refine_prompt)
-        cleaned2 = (resp2.text or '').strip().lstrip('```json').rstrip('```').strip()
-        return cleaned2
-    except Exception as e:
-        logger.info(f"analyze_lease error: {e}")
-        return None
-
-def analyze_compliance(new_lease_text, master_template_text):
-    """
-    Compares a new lease against a master template using Gemini AI.
-    Returns a JSON object with a summary of deviations.
-    """
-    prompt = f"""
-    You are a compliance analysis bot. Compare the 'New Lease Document' against the 'Master Template'.
-    Your goal is to identify differences, deviations, and any clauses present in the new lease that are NOT in the master template.
-
-    Master Template Text:
-    --- START ---
-    {master_template_text}
-    --- END ---
-
-    New Lease Document Text:
-    --- START ---
-    {new_lease_text}
-    --- END ---
-
-    Analyze the documents and provide a report ONLY in a single JSON object format.
-    The JSON object must have one top-level key: 'compliance_report'.
-    The value of 'compliance_report' should be an object with three keys:
-    1.  `summary`: A brief, one-sentence summary of the overall compliance (e.g., "The document largely conforms to the master template with minor deviations.").
-    2.  `deviations`: An array of objects, where each object describes a specific deviation. Each object should have two keys: `clause_title` (e.g., "Termination Clause") and `description` (e.g., "The notice period was changed from 30 days in the template to 60 days.").
-    3.  `missing_clauses`: An array of strings, where each string is the title of a clause present in the Master Template but missing from the New Lease Document.
-
-    If no deviations or missing clauses are found, return empty arrays for those keys.
-    Do not include any text before or after the JSON object.
-    """
-    try:
-        model = get_gemini_model() # Use the standard model with key rotation
-        response = model.generate_content(prompt)
-        cleaned_text = response.text.strip().lstrip('```json').rstrip('```').strip()
-        return json.loads(cleaned_text)
-    except Exception as e:
-        logger.info(f"Error during compliance analysis: {e}")
-        return {"compliance_report": {
-            "summary": "Failed to generate compliance report due to an internal error.",
-            "deviations": [],
-            "missing_clauses": []
-        }}
-
 # --- Maxelpay Encryption Helper --- 
 def maxelpay_encryption(secret_key, payload_data):
   """Encrypts payload data for Maxelpay API using AES CBC."""
+  from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+  from cryptography.hazmat.backends import default_backend
   try:
     # Convert to bytes
     iv = os.urandom(16)
@@ -438,95 +240,8 @@ def maxelpay_encryption(secret_key, payload_data):
 
 # --- End Maxelpay Encryption Helper ---
 
-# --- Firestore User Helpers --- 
-
-def get_or_create_user_profile(user_id):
-    """Gets user profile from Firestore, creates default free tier if not found."""
-    user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
-    if user_doc.exists:
-        # Ensure existing profiles have new fields (handle potential missing fields)
-        profile_data = user_doc.to_dict()
-        if 'dailyScansUsed' not in profile_data:
-            profile_data['dailyScansUsed'] = 0
-        if 'lastScanDate' not in profile_data:
-            profile_data['lastScanDate'] = None # Or a default past date string like '1970-01-01'
-        if 'lastMonthlyScan' not in profile_data:
-            profile_data['lastMonthlyScan'] = datetime.date.today().strftime('%Y-%m')
-            try:
-                user_ref.update({'lastMonthlyScan': profile_data['lastMonthlyScan']})
-            except Exception as e:
-                logger.info(f"Warning: could not backfill lastMonthlyScan for {user_id}: {e}")
-        return profile_data
-    else:
-        logger.info(f"Creating default free profile for user: {user_id}")
-        default_profile = {
-            'userId': user_id, 
-            'subscriptionTier': 'free',
-            'freeScansUsed': 0,
-            'maxAllowedScans': 3, # Default for free tier
-            'dailyScansUsed': 0,
-            'lastScanDate': None, # Initialize as None
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'lastMonthlyScan': datetime.date.today().strftime('%Y-%m')
-        }
-        try:
-            user_ref.set(default_profile)
-            return default_profile
-        except Exception as e:
-             logger.info(f"Error creating user profile for {user_id}: {e}")
-             return None # Indicate failure
-
-def increment_scan_counts(user_id, tier):
-    """Atomically increments scan counts based on tier."""
-    user_ref = db.collection('users').document(user_id)
-    today_str = datetime.date.today().isoformat() # Get YYYY-MM-DD
-
-    try:
-        # Use a transaction to ensure atomicity if needed, but separate updates might be fine
-        
-        # Increment monthly count for limited tiers (free, commercial, premium)
-        if tier in ['free', 'commercial', 'premium']:
-            user_ref.update({
-                'freeScansUsed': firestore.Increment(1),
-                'lastMonthlyScan': today_str[:7]  # Store YYYY-MM of current month
-            })
-            logger.info(f"Incremented monthly scan count for user {user_id} (tier: {tier})")
-
-        # Handle daily count for premium tier
-        if tier == 'premium':
-            # Fetch current daily count and date first
-            user_doc = user_ref.get()
-            if user_doc.exists:
-                profile_data = user_doc.to_dict()
-                last_scan_date = profile_data.get('lastScanDate')
-                daily_scans = profile_data.get('dailyScansUsed', 0)
-
-                update_data = {}
-                if last_scan_date == today_str:
-                    # Same day, just increment
-                    update_data['dailyScansUsed'] = firestore.Increment(1)
-                    logger.info(f"Incremented daily scan count for user {user_id} (tier: {tier})")
-                else:
-                    # New day, reset count to 1 and update date
-                    update_data['dailyScansUsed'] = 1
-                    update_data['lastScanDate'] = today_str
-                    logger.info(f"Reset daily scan count to 1 for user {user_id} (tier: {tier}) on new day {today_str}")
-                
-                user_ref.update(update_data)
-            else:
-                 logger.info(f"Error: Could not find user {user_id} to update daily scan count.")
-                 return False # Indicate failure if user doc missing
-
-        return True
-    except Exception as e:
-        logger.info(f"Error incrementing scan counts for {user_id} (tier: {tier}): {e}")
-        return False
-
-# --- End Firestore User Helpers --- 
 
 # --- Global Daily Chat Message Limit Helpers ---
-from google.cloud.firestore import Transaction  # Added for typing clarity but optional
 
 def _get_today_iso():
     # Use UTC date to ensure consistent daily reset regardless of server timezone
@@ -546,6 +261,7 @@ def _increment_chat_count_if_not_limited(limit=_GLOBAL_CHAT_LIMIT):
     Returns:
         bool: True if the increment was successful, False if the limit had been reached.
     """
+    db = get_db()
     if db is None:
         logger.info("Database not initialised; cannot track chat quota.")
         return False  # Fail open, but log it
@@ -586,6 +302,7 @@ def _increment_chat_count_if_not_limited(limit=_GLOBAL_CHAT_LIMIT):
 
 
 def _increment_user_chat_count_if_not_limited(user_id, limit=_PER_USER_CHAT_LIMIT):
+    db = get_db()
     if db is None:
         return False
 
@@ -648,8 +365,12 @@ def public_api_info():
 
 # --- AI Chat Endpoint ---
 @app.route('/api/chat', methods=['POST'])
+@upload_limit(25 * uploads.MB)
+@llm_executor.budget(CHAT_BUDGET_SECONDS)
+@llm_guard.sheds_load
 def ai_chat():
     """Endpoint to handle real-time chat messages with rate limits."""
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -672,6 +393,8 @@ def ai_chat():
         user_message = request.form.get('message', '').strip()
         requested_model = request.form.get('model')
         uploaded_files = request.files.getlist('files')
+        session_id = request.form.get('sessionId')
+        use_portfolio = request.form.get('use_portfolio', 'false').lower() == 'true'
 
         if not user_message and not uploaded_files:
             return jsonify({'error': 'No message or files provided.'}), 400
@@ -697,31 +420,79 @@ def ai_chat():
         base_model_key = 'gemini-2.5-pro'
         use_refinement = True
 
-    model_id_to_use = MODEL_MAP.get(base_model_key, 'gemini-2.5-pro')
-    logger.info(f"Chat request using model: {model_id_to_use} (alias {requested_model}), refinement={use_refinement}")
+    route = None # Set when the client didn't pick a model and the router does
+    model_id_to_use = MODEL_MAP.get(base_model_key)
 
-    # --- Prompt Construction ---
-    prompt_parts = []
-    if user_message:
-        prompt_parts.append(user_message)
+    # --- Conversation Session (see chat_sessions.py) ---
+    session_store = None
+    try:
+        session_store = queues.get_redis_conn()
+        if session_id:
+            session = chat_sessions.load(session_store, session_id, user_id)
+        else:
+            session = chat_sessions.new_session(user_id, key_index=llm.next_key_index())
+    except chat_sessions.SessionNotFound:
+        return jsonify({'error': 'Chat session not found or expired. Please start a new conversation.', 'sessionExpired': True}), 404
+    except Exception as e:
+        # Without Redis the conversation still works, one message at a time
+        logger.info(f"Chat sessions unavailable: {e}")
+        session_store = None
+        session = chat_sessions.new_session(user_id, key_index=llm.next_key_index())
 
+    # --- Prompt Construction ---
+    # PDFs are extracted once per session; images only go with the turn they were sent in
+    turn_parts = []
     for file in uploaded_files:
         try:
             if file.mimetype.startswith('image/'):
                 image_part = {"mime_type": file.mimetype, "data": file.read()}
-                prompt_parts.append(image_part)
+                turn_parts.append(image_part)
             elif file.mimetype == 'application/pdf':
-                pdf_text = extract_pdf_rich_content(file.stream)
-                if pdf_text:
-                    prompt_parts.append(f"\\n--- PDF Content: {file.filename} ---\\n{pdf_text}")
+                content_hash = uploads.content_hash(file)
+                if chat_sessions.has_document(session, content_hash):
+                    continue
+                pdf_text = extract_text(uploads.pdf_source(file))
+                if pdf_text and not chat_sessions.add_document(session, file.filename, pdf_text, content_hash):
+                    # Over the session's document budget: send it with this turn only
+                    turn_parts.append(f"--- PDF Content: {file.filename} ---\n{pdf_text}")
             # Add other file types here if needed
         except Exception as e:
             logger.info(f"Error processing file {file.filename}: {e}")
             # Optionally append an error message to the prompt
-            prompt_parts.append(f"\\n[Could not process file: {file.filename}]")
+            turn_parts.append(f"[Could not process file: {file.filename}]")
+
+    # Ground the answer in the user's analysed leases: only the best-matching passages are sent
+    if use_portfolio and user_message:
+        try:
+            hits = retrieval.index_for_user(db, user_id).search(user_message)
+            if hits:
+                turn_parts.insert(0, retrieval.format_passages(hits))
+        except Exception as e:
+            logger.info(f"Portfolio retrieval failed for user {user_id}: {e}")
 
-    if not prompt_parts:
-         return jsonify({'error': 'Could not construct a valid prompt from the provided input.'}), 500
+    prompt_parts = chat_sessions.build_prompt(session, user_message, turn_parts)
+
+    if model_id_to_use is None:
+        user_profile = get_or_create_user_profile(user_id) or {}
+        prompt_chars = sum(len(part) for part in prompt_parts if isinstance(part, str))
+        route = model_router.choose('chat', chars=prompt_chars, tier=user_profile.get('subscriptionTier'))
+        model_id_to_use = route.model
+    logger.info(f"Chat request using model: {model_id_to_use} (alias {requested_model}), refinement={use_refinement}")
+    started = time.monotonic()
+    key_index = session['keyIndex'] # Same key every turn, so Gemini's prefix cache applies
+
+    def finish_turn(response_data):
+        chat_sessions.add_turn(session, user_message, response_data['response'])
+        if session_store is not None:
+            try:
+                chat_sessions.save(session_store, session)
+                response_data['sessionId'] = session['id']
+            except Exception as e:
+                logger.info(f"Could not save chat session {session['id']}: {e}")
+        logger.info(f"Chat turn {len(session['turns'])} of session {session['id']}: "
+                    f"{sum(len(p) for p in prompt_parts if isinstance(p, str))} prompt chars, "
+                    f"answered in {time.monotonic() - started:.2f}s")
+        return jsonify(response_data)
 
     # --- AI Generation ---
     try:
@@ -730,14 +501,12 @@ def ai_chat():
             logger.info("Executing 3-pass creative refinement for gemini-2.5-fly")
 
             # Pass 1: Standard response
-            model_standard = get_gemini_model(model_name=model_id_to_use, temperature=0.5) # Lower temp for precision
-            pass1_response_obj = model_standard.generate_content(prompt_parts)
+            pass1_response_obj = llm.generate(prompt_parts, model_name=model_id_to_use, temperature=0.5, key_index=key_index) # Lower temp for precision
             pass1_response = pass1_response_obj.text.strip()
             logger.info(f"Fly Pass 1 (Standard): {pass1_response[:100]}...")
 
             # Pass 2: Creative response
-            model_creative = get_gemini_model(model_name=model_id_to_use, temperature=1.0) # Higher temp for creativity
-            pass2_response_obj = model_creative.generate_content(prompt_parts)
+            pass2_response_obj = llm.generate(prompt_parts, model_name=model_id_to_use, temperature=1.0, key_index=key_index) # Higher temp for creativity
             pass2_response = pass2_response_obj.text.strip()
             logger.info(f"Fly Pass 2 (Creative): {pass2_response[:100]}...")
 
@@ -758,20 +527,17 @@ You can choose one, or synthesize the best elements of both into a new, more com
 The final output should be the single best response, not a commentary on the differences.
 Final Answer:"""
             
-            model_synthesis = get_gemini_model(model_name=model_id_to_use) # Use default temp for synthesis
-            final_response_obj = model_synthesis.generate_content(synthesis_prompt)
+            final_response_obj = llm.generate(synthesis_prompt, model_name=model_id_to_use) # Use default temp for synthesis
             final_response = final_response_obj.text.strip()
             logger.info(f"Fly Pass 3 (Synthesis): {final_response[:100]}...")
 
             # Return only the final synthesized response to the user
             response_data = {'response': final_response}
-            return jsonify(response_data)
+            return finish_turn(response_data)
 
         # --- Default/Original Logic for other models ---
-        model = get_gemini_model(model_name=model_id_to_use) # Use the key-rotating helper
-
-        # First pass: Generate initial response
-        initial_response = model.generate_content(prompt_parts)
+        # First pass: Generate initial response (key rotation, hedging and deadline in llm.generate)
+        initial_response = llm.generate(prompt_parts, model_name=model_id_to_use, key_index=key_index)
         ai_response_text = initial_response.text.strip()
 
         if use_refinement:
@@ -780,7 +546,7 @@ Final Answer:"""
                 ai_response_text,
                 "Refine and improve this response: Make it more accurate, complete, helpful, and concise while preserving the original meaning. Correct any errors and enhance clarity."
             ]
-            refined_response_obj = model.generate_content(refinement_prompt)
+            refined_response_obj = llm.generate(refinement_prompt, model_name=model_id_to_use)
             refined_response = refined_response_obj.text.strip()
 
             response_data = {
@@ -791,17 +557,43 @@ Final Answer:"""
         else:
              response_data = {'response': ai_response_text}
 
-        return jsonify(response_data)
+        if route:
+            model_router.record_outcome(route, time.monotonic() - started, ok=True)
+        return finish_turn(response_data)
 
+    except llm_guard.Overloaded:
+        raise # 503 with Retry-After (handle_llm_overloaded)
     except Exception as e:
+        if route:
+            model_router.record_outcome(route, time.monotonic() - started, ok=False)
         logger.info(f"Gemini chat error with model {model_id_to_use}: {e}")
         return jsonify({'error': 'Failed to generate AI response. Please try a different model or check your input.', 'details': str(e)}), 500
 
+@app.route('/api/chat/sessions/<session_id>', methods=['DELETE'])
+def end_chat_session(session_id):
+    """Forget a conversation's documents and history before they expire."""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Unauthorized'}), 401
+    token = auth_header.split('Bearer ')[1]
+    user_id = verify_token(token)
+    if not user_id:
+        return jsonify({'error': 'Invalid token'}), 401
+
+    redis_conn = queues.get_redis_conn()
+    try:
+        chat_sessions.load(redis_conn, session_id, user_id)
+    except chat_sessions.SessionNotFound:
+        return jsonify({'error': 'Chat session not found'}), 404
+    chat_sessions.delete(redis_conn, session_id)
+    return '', 204
+
 # --- End AI Chat Endpoint ---
 
 # --- Maxelpay Checkout Route ---
 @app.route('/api/payid/create-checkout-session', methods=['POST']) # Keep route name consistent with frontend for now
 def create_checkout_session():
+    db = get_db()
     if db is None:
         logger.info("Error: Firestore database client not initialized.")
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
@@ -937,6 +729,7 @@ def create_checkout_session():
 
 @app.route('/api/maxelpay/webhook', methods=['POST'])
 def maxelpay_webhook():
+    db = get_db()
     if db is None:
         logger.info("Webhook Error: Firestore database client not initialized.")
         return jsonify({'status': 'received (internal DB error)'}), 200
@@ -1000,6 +793,7 @@ def maxelpay_webhook():
                     # Optionally clear free scans used:
                     # 'freeScansUsed': 0
                 })
+                invalidate_user_profile(user_id)
                 logger.info(f"Successfully updated user {user_id} subscription to 'paid' for order {order_id}")
             except Exception as user_update_error:
                 logger.info(f"Webhook Error: Failed to update user profile for user {user_id} (order {order_id}): {user_update_error}")
@@ -1022,7 +816,10 @@ def maxelpay_webhook():
 # --- End Webhook Route ---
 
 @app.route('/api/analyze', methods=['POST'])
+@upload_limit(25 * uploads.MB)
+@llm_executor.budget(ANALYZE_BUDGET_SECONDS)
 def analyze_document():
+    db = get_db()
     if db is None:
         logger.info("Error: Firestore database client not initialized.")
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
@@ -1035,7 +832,8 @@ def analyze_document():
     if not user_id:
         return jsonify({'error': 'Invalid token'}), 401
     
-    user_profile = get_or_create_user_profile(user_id)
+    # Quota is decided on a fresh read, never on another process's cached copy
+    user_profile = get_fresh_user_profile(user_id)
     if not user_profile:
          return jsonify({'error': 'Could not retrieve or create user profile.'}), 500
 
@@ -1047,8 +845,10 @@ def analyze_document():
                 'freeScansUsed': 0,
                 'lastMonthlyScan': current_month_str
             })
-            user_profile['freeScansUsed'] = 0
-            user_profile['lastMonthlyScan'] = current_month_str
+            update_cached_profile(user_id, {
+                'freeScansUsed': 0,
+                'lastMonthlyScan': current_month_str
+            })
             logger.info(f"Monthly scan count reset for user {user_id} for new month {current_month_str}")
         except Exception as e:
             logger.info(f"Error resetting monthly scans for {user_id}: {e}")
@@ -1079,8 +879,8 @@ def analyze_document():
         should_increment = False
         logger.info(f"User {user_id} (Paid) - Access granted (Unlimited)")
     elif tier == 'premium': # New Premium tier
-        max_monthly_scans = 50 # Defined limit
-        max_daily_scans = 3 # Defined limit
+        max_monthly_scans = PREMIUM_MONTHLY_SCANS
+        max_daily_scans = PREMIUM_DAILY_SCANS
         # Check monthly limit
         if monthly_scans_used < max_monthly_scans:
             # Check daily limit
@@ -1107,7 +907,7 @@ def analyze_document():
             logger.info(f"User {user_id} (Commercial) scan limit reached ({monthly_scans_used}/{max_scans}).")
             return jsonify({'error': f'Commercial scan limit reached ({monthly_scans_used}/{max_scans} used). Contact admin for more.', 'limitReached': 'monthly'}), 429
     elif tier == 'free':
-        free_limit = 3
+        free_limit = FREE_MONTHLY_SCANS
         if monthly_scans_used < free_limit:
             can_analyze = True
             should_increment = True # Increment monthly count
@@ -1126,22 +926,51 @@ def analyze_document():
          return jsonify({'error': 'Analysis not permitted with current subscription.'}), 403
     # --- End Authorization & Subscription Check ---
 
+    # Server-to-server clients can ask for a signed POST on completion; that
+    # always runs as a background job.
+    callback_url = request.form.get('callback_url')
+    if not callback_url and request.is_json:
+        callback_url = (request.get_json(silent=True) or {}).get('callback_url')
+    if callback_url:
+        callback_error = callbacks.validate_callback_url(callback_url)
+        if callback_error:
+            return jsonify({'error': callback_error}), 400
+        if not callbacks.CALLBACK_SIGNING_SECRET:
+            logger.info("ERROR: callback_url given but CALLBACK_SIGNING_SECRET is not set.")
+            return jsonify({'error': 'Server configuration error: Callbacks unavailable.'}), 500
+
+    respond_async = bool(callback_url) or wants_async_response()
+
+    # The lease this upload revises, when the client knows it (see lease_versions.py)
+    previous_lease_id = request.form.get('previousLeaseId')
+    if not previous_lease_id and request.is_json:
+        previous_lease_id = (request.get_json(silent=True) or {}).get('previousLeaseId')
+    if previous_lease_id is not None and not isinstance(previous_lease_id, str):
+        return jsonify({'error': 'previousLeaseId must be a string.'}), 400
+
+    # A retried async submission with a known Idempotency-Key is answered
+    # before the upload body is read
+    if respond_async:
+        existing_job = find_idempotent_job(user_id)
+        if existing_job is not None:
+            return job_accepted_response(existing_job)
+    else:
+        # Synchronous analysis calls Gemini in this process; shed it before reading the upload
+        llm_guard.shed_if_saturated()
+
     text = None
-    file_content_type = None
+    pdf_file = None
     original_filename = "Uploaded File" # Default name
 
-    # Try getting file first
-    if 'leaseFile' in request.files:
-        file = request.files['leaseFile']
+    # Try getting file first ('file' is accepted for clients of the old job endpoint)
+    file = request.files.get('leaseFile') or request.files.get('file')
+    if file is not None:
         original_filename = file.filename or original_filename
         file_content_type = file.content_type
         
         if file_content_type == 'application/pdf':
-            # Read file stream into memory for PyPDF2
-            file_stream = io.BytesIO(file.read())
-            text = extract_pdf_rich_content(file_stream) # Use the new rich content extractor
-            if text is None:
-                 return jsonify({'error': 'Failed to extract text from PDF'}), 500
+            # Read later: by the worker (async) or inside the single flight (sync)
+            pdf_file = file
         elif file_content_type == 'text/plain':
             try:
                 text = file.read().decode('utf-8')
@@ -1155,117 +984,200 @@ def analyze_document():
     elif request.is_json and 'text' in request.json:
         text = request.json['text']
         original_filename = "Pasted Text"
-        # Add input validation for text length
-        if len(text) > MAX_TEXT_LENGTH:
-            logger.info(f"Input text too long: {len(text)} characters")
-            return jsonify({'error': f'Pasted text exceeds the maximum length of {MAX_TEXT_LENGTH} characters.'}), 413 # Payload Too Large
+        # Long text is analysed in chunks (see chunking.py); the body size is
+        # bounded by the route's upload limit
+        if not isinstance(text, str):
+            return jsonify({'error': 'Pasted text must be a string.'}), 400
         if not text.strip(): # Check if text is just whitespace
              return jsonify({'error': 'Pasted text cannot be empty.'}), 400
     
     # If neither file nor text provided
-    if text is None:
+    if text is None and pdf_file is None:
         return jsonify({'error': 'No file or text provided for analysis'}), 400
 
+    # Identical uploads from the same user share one analysis (see singleflight.py)
+    if pdf_file is not None:
+        content_hash = uploads.content_hash(pdf_file)
+    else:
+        content_hash = singleflight.hash_text(text)
+    if previous_lease_id:
+        content_hash = f"{content_hash}:{previous_lease_id}"
+
+    if respond_async:
+        pdf_bytes = pdf_file.read() if pdf_file is not None else None # Extraction runs in the worker
+        return enqueue_lease_analysis(user_id, tier, should_increment, original_filename,
+                                      content_hash, pdf_bytes=pdf_bytes, text=text,
+                                      callback_url=callback_url, previous_lease_id=previous_lease_id)
+
+    if wants_event_stream():
+        return stream_lease_analysis(text, pdf_file, user_id, tier, user_profile, should_increment,
+                                     original_filename, content_hash, previous_lease_id)
+
+    extraction_failed = False
+
+    def analyze_once():
+        nonlocal extraction_failed
+        lease_text = text
+        if lease_text is None:
+            lease_text = extract_text(uploads.pdf_source(pdf_file))
+            if lease_text is None:
+                extraction_failed = True
+                return None
+        return analysis.run_lease_analysis(lease_text, user_id, tier, user_profile, should_increment,
+                                           original_filename, writer=write_behind.add,
+                                           previous_lease_id=previous_lease_id)
+
     # Analyze the extracted/provided text
     try:
-        analysis_result_text = analyze_lease(text)
-        if not analysis_result_text:
+        outcome, led = singleflight.run(queues.get_redis_conn(),
+                                        singleflight.flight_key('analyze', user_id, content_hash),
+                                        analyze_once)
+        if extraction_failed:
+            return jsonify({'error': 'Failed to extract text from PDF'}), 500
+        if outcome is None:
             return jsonify({'error': 'AI analysis failed. Please try again later.'}), 500
-        
-        # Parse the JSON response from Gemini
-        try:
-            # Gemini might return markdown ```json ... ```
-            cleaned_text = analysis_result_text.strip().lstrip('```json').rstrip('```')
-            result_data = json.loads(cleaned_text)
-        except json.JSONDecodeError as json_err:
-            logger.info(f"JSON Decode Error: {json_err}")
-            logger.info(f"Raw Gemini Response: {analysis_result_text}")
-            # If response is not valid JSON, wrap raw text
-            result_data = {
-                'raw_analysis': analysis_result_text,
-                'error_message': 'Analysis result was not valid JSON.'
-            }
-        except Exception as parse_err: # Catch other potential parsing errors
-            logger.info(f"Parsing Error: {parse_err}")
-            result_data = {
-                'raw_analysis': analysis_result_text,
-                'error_message': 'An error occurred while parsing the analysis result.'
-            }
-
-        # --- NEW: Compliance Analysis Step ---
-        if tier == 'commercial' and user_profile.get('complianceTemplate'):
-            logger.info(f"User {user_id} is commercial with a template. Running compliance check.")
-            template_info = user_profile['complianceTemplate']
-            storage_path = template_info.get('storagePath')
-            
-            if storage_path:
-                try:
-                    bucket = storage.bucket()
-                    blob = bucket.blob(storage_path)
-                    template_bytes = blob.download_as_bytes()
-                    template_text = extract_pdf_rich_content(io.BytesIO(template_bytes))
-
-                    if template_text:
-                        logger.info("Successfully extracted text from master template. Analyzing compliance...")
-                        compliance_result = analyze_compliance(text, template_text)
-                        # Merge the compliance report into the main analysis result
-                        result_data.update(compliance_result)
-                    else:
-                        logger.info("Warning: Could not extract text from the stored master template.")
-                except Exception as e:
-                    logger.info(f"CRITICAL: Failed to download or process compliance template for user {user_id}: {e}")
-                    # Optionally add an error to the report
-                    result_data['compliance_report'] = {
-                        "summary": "Error: Could not process the master compliance template.",
-                        "deviations": [],
-                        "missing_clauses": []
-                    }
-        # --- End Compliance Analysis Step ---
-
-        # --- Increment scan counts if needed --- 
-        if should_increment:
-            # Use the new function and pass the tier
-            if not increment_scan_counts(user_id, tier):
-                 # Log error but proceed - analysis was done, just count failed
-                 logger.info(f"CRITICAL: Failed to increment scan counts for user {user_id} (tier: {tier}) after successful analysis.")
-                 # Consider adding to a retry queue or alert system
-        # --- End Increment --- 
+        if not led:
+            logger.info(f"Analysis request from {user_id} coalesced onto in-flight lease {outcome['leaseId']}")
 
-        # Save result to Firestore (as before, creating new doc)
-        new_lease_id = None
-        try:
-            lease_ref = db.collection('leases').add({
-                'userId': user_id,
-                'fileName': original_filename, # Use original filename or default
-                # 'filePath': None, # No longer storing path
-                # 'fileUrl': None, # No longer storing URL
-                'status': 'complete' if 'error_message' not in result_data else 'error',
-                'analysis': result_data,
-                'createdAt': firestore.SERVER_TIMESTAMP # Use server timestamp
-            })
-            new_lease_id = lease_ref[1].id # Get the ID of the newly created doc
-        except Exception as db_error:
-            logger.info(f"Firestore saving error: {db_error}")
-            # Decide if we should fail the request or just return the analysis without saving
-            new_lease_id = None # Indicate saving failed
-        
-        # Return analysis result (and optionally the new lease ID)
-        return jsonify({
+        # Return analysis result (and the ID the lease doc is being written under)
+        response = {
             'success': True,
-            'leaseId': new_lease_id, # Return the ID of the *newly created* doc
-            'analysis': result_data
-        })
+            'leaseId': outcome['leaseId'],
+            'analysis': outcome['analysis']
+        }
+        if 'coverage' in outcome['analysis']:
+            # Long leases analysed in parts: tell the client if some parts are missing
+            response['coverage'] = outcome['analysis']['coverage']
+        return jsonify(response)
     
+    except llm_guard.Overloaded:
+        raise
+    except chunking.DocumentTooLong as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         logger.info(f"Analysis endpoint error: {e}")
-        # Attempt to save error state if possible (might fail if analysis failed early)
-        # We don't have a lease_id readily available here unless we create it earlier
-        # For simplicity now, just return the error
         return jsonify({'error': str(e)}), 500
 
+def wants_async_response():
+    """Execution-mode negotiation for /api/analyze.
+
+    Clients opt into background processing with ``Prefer: respond-async``
+    (RFC 7240) or a ``mode=async`` query/form/JSON field; everything else gets
+    the original synchronous response.
+    """
+    prefer = [p.strip().lower() for p in request.headers.get('Prefer', '').split(',')]
+    if 'respond-async' in prefer:
+        return True
+    mode = request.args.get('mode') or request.form.get('mode')
+    if not mode and request.is_json:
+        mode = (request.get_json(silent=True) or {}).get('mode')
+    return (mode or '').lower() == 'async'
+
+def wants_event_stream():
+    """Whether the client asked for progressive results (``Accept: text/event-stream`` or ``mode=stream``)."""
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return True
+    mode = request.args.get('mode') or request.form.get('mode')
+    if not mode and request.is_json:
+        mode = (request.get_json(silent=True) or {}).get('mode')
+    return (mode or '').lower() == 'stream'
+
+def stream_lease_analysis(text, pdf_file, user_id, tier, user_profile, should_increment, file_name,
+                          content_hash, previous_lease_id=None):
+    """Answer /api/analyze as Server-Sent Events (see progressive.py).
+
+    Rule-engine findings and regex-extracted terms are sent as soon as the
+    text is available, Gemini's results as they arrive. The analysis shares
+    the synchronous path's single-flight key, so a double-click or retry
+    (streamed or not) waits for the leader's result instead of running and
+    charging a second analysis; such a follower gets only the final event.
+    """
+    def run(progress):
+        def analyze_once():
+            return analysis.run_lease_analysis(lease_text, user_id, tier, user_profile, should_increment,
+                                               file_name, writer=write_behind.add, progress=progress,
+                                               previous_lease_id=previous_lease_id)
+        outcome, led = singleflight.run(queues.get_redis_conn(),
+                                        singleflight.flight_key('analyze', user_id, content_hash),
+                                        analyze_once)
+        if not led:
+            logger.info(f"Streamed analysis from {user_id} coalesced onto in-flight lease {outcome['leaseId']}")
+        return outcome
+
+    def generate():
+        nonlocal lease_text
+        if lease_text is None:
+            lease_text = extract_text(uploads.pdf_source(pdf_file))
+            if lease_text is None:
+                yield progressive.format_event('error', {'error': 'Failed to extract text from PDF'})
+                return
+        yield from progressive.stream_analysis(lease_text, run, ANALYZE_BUDGET_SECONDS)
+
+    lease_text = text
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def find_idempotent_job(user_id):
+    """Return the job a previous request with this Idempotency-Key created, if any."""
+    idem_key = request.headers.get('Idempotency-Key')
+    if not idem_key:
+        return None
+    existing = queues.get_redis_conn().get(f'idempotency:{user_id}:{idem_key}')
+    if not existing:
+        return None
+    return queues.get_queue().fetch_job(existing.decode('utf-8'))
+
+def enqueue_lease_analysis(user_id, tier, should_increment, file_name, content_hash,
+                           pdf_bytes=None, text=None, callback_url=None, previous_lease_id=None):
+    """Queue the full analysis pipeline on the RQ worker and answer 202.
+
+    A submission identical to one already queued, running or recently finished
+    attaches to that job instead of starting another.
+    """
+    redis_conn = queues.get_redis_conn()
+    if callback_url:
+        # Each distinct callback needs its own job to deliver it
+        content_hash = f"{content_hash}:{singleflight.hash_text(callback_url)[:16]}"
+    flight = singleflight.flight_key('job', user_id, content_hash)
+    job_id = str(uuid.uuid4())
+    owner_id = singleflight.claim_job(redis_conn, flight, job_id, ttl=ANALYSIS_JOB_TIMEOUT)
+
+    job = None
+    if owner_id != job_id:
+        job = queues.get_queue().fetch_job(owner_id)
+        if job is None or job.get_status() in ('failed', 'stopped', 'canceled'):
+            job = None
+            singleflight.replace_job(redis_conn, flight, job_id, ttl=ANALYSIS_JOB_TIMEOUT)
+        else:
+            logger.info(f"Analysis submission from {user_id} attached to in-flight job {job.id}")
+    if job is None:
+        job = queues.enqueue('tasks.analyze', pdf_bytes,
+                             user_id=user_id, tier=tier, should_increment=should_increment,
+                             file_name=file_name, text=text, callback_url=callback_url,
+                             previous_lease_id=previous_lease_id, job_id=job_id, meta={'userId': user_id},
+                             retries=3, result_ttl=86400, job_timeout=ANALYSIS_JOB_TIMEOUT)
+
+    idem_key = request.headers.get('Idempotency-Key')
+    if idem_key:
+        redis_conn.setex(f'idempotency:{user_id}:{idem_key}', 3600, job.id)
+    return job_accepted_response(job)
+
+def job_accepted_response(job):
+    response = jsonify({
+        'success': True,
+        'job_id': job.id,
+        'jobId': job.id,
+        'progressUrl': f'/api/progress/{job.id}',
+        'resultUrl': f'/api/jobs/{job.id}/result'
+    })
+    response.headers['Preference-Applied'] = 'respond-async'
+    response.headers['Location'] = f'/api/progress/{job.id}'
+    return response, 202
+
 # --- Add DELETE Endpoint --- 
 @app.route('/api/leases/<string:lease_id>', methods=['DELETE'])
 def delete_lease(lease_id):
+    db = get_db()
     if db is None:
         logger.info("Error: Firestore database client not initialized.")
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
@@ -1285,23 +1197,26 @@ def delete_lease(lease_id):
     try:
         lease_ref = db.collection('leases').document(lease_id)
         lease_doc = lease_ref.get()
+        # A fresh analysis may still be in the write-behind spool
+        lease_data = lease_doc.to_dict() if lease_doc.exists else write_behind.pending_document('leases', lease_id)
 
-        if not lease_doc.exists:
+        if lease_data is None:
             return jsonify({'error': 'Lease analysis not found'}), 404
 
         # Security Check: Ensure the user requesting delete owns the document
-        if lease_doc.to_dict().get('userId') != user_id:
-            logger.info(f"Unauthorized delete attempt: User {user_id} tried to delete lease {lease_id} owned by {lease_doc.to_dict().get('userId')}")
+        if lease_data.get('userId') != user_id:
+            logger.info(f"Unauthorized delete attempt: User {user_id} tried to delete lease {lease_id} owned by {lease_data.get('userId')}")
             return jsonify({'error': 'Forbidden'}), 403
 
-        # Delete the document from Firestore
+        # Drop spooled writes first so a later flush can't bring the lease back
+        write_behind.discard('leases', lease_id)
         lease_ref.delete()
 
         # Optionally: Delete corresponding file from Firebase Storage if applicable
         # file_path = lease_doc.to_dict().get('filePath')
         # if file_path:
         #    try:
-        #        bucket = storage.bucket() # Get bucket reference if needed
+        #        bucket = get_bucket() # Get bucket reference if needed
         #        blob = bucket.blob(file_path)
         #        blob.delete()
         #        logger.info(f"Deleted storage file: {file_path}")
@@ -1320,6 +1235,7 @@ def delete_lease(lease_id):
 
 @app.route('/api/admin/users', methods=['GET'])
 def get_all_users():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1347,7 +1263,7 @@ def get_all_users():
             user_data['userId'] = doc.id # Ensure userId is included
             # Optionally fetch email from Firebase Auth if not stored in profile
             try:
-                auth_user = firebase_admin.auth.get_user(doc.id)
+                auth_user = auth.get_user(doc.id)
                 user_data['email'] = auth_user.email
             except Exception as auth_err:
                 logger.info(f"Could not fetch email for user {doc.id}: {auth_err}")
@@ -1368,8 +1284,31 @@ def get_all_users():
         logger.info(f"Error fetching users from Firestore: {e}")
         return jsonify({'error': 'Failed to retrieve users'}), 500
 
+@app.route('/api/admin/llm-metrics', methods=['GET'])
+def get_llm_metrics():
+    """Gemini latency, hedging and routing health as seen by this web process."""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Unauthorized: Missing or invalid token'}), 401
+    token = auth_header.split('Bearer ')[1]
+    user_id = verify_token(token)
+    if not user_id:
+        return jsonify({'error': 'Unauthorized: Invalid token'}), 401
+    if not is_admin(user_id):
+        logger.info(f"Forbidden access attempt to /api/admin/llm-metrics by user: {user_id}")
+        return jsonify({'error': 'Forbidden: Admin access required'}), 403
+
+    return jsonify({
+        'pid': os.getpid(),
+        'models': llm_executor.metrics(),
+        'routing': model_router.snapshot(),
+        'breakers': llm_guard.breaker_states(),
+        'admission': llm_guard.admission_stats()
+    }), 200
+
 @app.route('/api/admin/set-scans', methods=['POST'])
 def set_user_scans():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1419,6 +1358,7 @@ def set_user_scans():
             # 'subscriptionTier': 'commercial' # Or another tier name
         })
         
+        invalidate_user_profile(target_user_id)
         logger.info(f"Admin {user_id} set scan limit for user {target_user_id} to {scan_limit}")
         return jsonify({'success': True, 'message': f'Scan limit updated to {scan_limit} for user {target_user_id}'}), 200
         
@@ -1428,6 +1368,7 @@ def set_user_scans():
         
 @app.route('/api/admin/create-commercial', methods=['POST'])
 def create_commercial_user():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1464,14 +1405,14 @@ def create_commercial_user():
     # 3. Create User in Firebase Auth
     new_user_uid = None
     try:
-        new_user = firebase_admin.auth.create_user(
+        new_user = auth.create_user(
             email=email,
             password=password,
             email_verified=True # Optional: mark as verified since admin created
         )
         new_user_uid = new_user.uid
         logger.info(f"Admin {requesting_user_id} created new Auth user {email} ({new_user_uid})")
-    except firebase_admin.auth.EmailAlreadyExistsError:
+    except auth.EmailAlreadyExistsError:
         logger.info(f"Failed to create user: Email {email} already exists.")
         return jsonify({'error': 'Email already exists'}), 409 # Conflict
     except Exception as e:
@@ -1492,6 +1433,7 @@ def create_commercial_user():
                 'lastMonthlyScan': datetime.date.today().strftime('%Y-%m')
             }
             user_ref.set(profile_data)
+            invalidate_user_profile(new_user_uid)
             logger.info(f"Created Firestore profile for commercial user {email} ({new_user_uid}) with scan limit {scan_limit}")
             return jsonify({
                 'success': True, 
@@ -1512,6 +1454,7 @@ def create_commercial_user():
 # --- NEW: Commercial Analytics Endpoint ---
 @app.route('/api/commercial/analytics', methods=['GET'])
 def get_commercial_analytics():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1626,6 +1569,7 @@ def get_commercial_analytics():
 
 @app.route('/api/compliance/template', methods=['GET'])
 def get_compliance_template():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1648,7 +1592,9 @@ def get_compliance_template():
         return jsonify({'message': 'No template found'}), 404
 
 @app.route('/api/compliance/template', methods=['POST'])
+@upload_limit(20 * uploads.MB)
 def upload_compliance_template():
+    db = get_db()
     if db is None: return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
     # Authorization & Subscription Check
@@ -1672,7 +1618,7 @@ def upload_compliance_template():
     try:
         # Define the storage path
         storage_path = f"compliance_templates/{user_id}/master_template"
-        bucket = storage.bucket()
+        bucket = get_bucket()
         blob = bucket.blob(storage_path)
 
         # Upload the file
@@ -1686,6 +1632,7 @@ def upload_compliance_template():
         }
         user_ref = db.collection('users').document(user_id)
         user_ref.update({'complianceTemplate': template_info})
+        invalidate_user_profile(user_id)
 
         return jsonify({'success': True, 'template': {'fileName': file.filename}}), 200
 
@@ -1695,6 +1642,7 @@ def upload_compliance_template():
 
 @app.route('/api/compliance/template', methods=['DELETE'])
 def delete_compliance_template():
+    db = get_db()
     if db is None: return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
     # Authorization & Subscription Check
@@ -1716,7 +1664,7 @@ def delete_compliance_template():
         # Delete from Firebase Storage
         storage_path = template_info.get('storagePath')
         if storage_path:
-            bucket = storage.bucket()
+            bucket = get_bucket()
             blob = bucket.blob(storage_path)
             if blob.exists():
                 blob.delete()
@@ -1724,6 +1672,7 @@ def delete_compliance_template():
         # Remove from user's profile in Firestore
         user_ref = db.collection('users').document(user_id)
         user_ref.update({'complianceTemplate': firestore.DELETE_FIELD})
+        update_cached_profile(user_id, {'complianceTemplate': None})
 
         return jsonify({'success': True}), 200
 
@@ -1740,7 +1689,11 @@ def allowed_image_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
 @app.route('/api/inspect-photos', methods=['POST'])
+@upload_limit(60 * uploads.MB)
+@llm_executor.budget(ANALYZE_BUDGET_SECONDS)
+@llm_guard.sheds_load
 def inspect_photos():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1812,30 +1765,29 @@ def inspect_photos():
 
             analysis_result_json = None
             last_error = None
+            route = model_router.choose('photo_inspection')
+            started = time.monotonic()
             # Iterate through API keys (similar to analyze_lease)
-            for i, api_key in enumerate(gemini_api_keys):
+            for i in range(len(gemini_api_keys)):
                 logger.info(f"Attempting Gemini Vision with API key #{i+1} for {file.filename}")
                 try:
-                    genai.configure(api_key=api_key)
-                    # Use a model that supports vision, e.g., gemini-pro-vision or 1.5 flash/pro
-                    model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20') 
-                    
-                    # Generate content with prompt and image
-                    response = model.generate_content([prompt, image_part])
+                    # Generate content with prompt and image (the routed model must support vision)
+                    response = llm.generate([prompt, image_part], model_name=route.model, json_mode=True, key_index=i)
                     
                     # Clean and parse the response
-                    cleaned_text = response.text.strip().lstrip('```json').rstrip('```').strip()
-                    analysis_result_json = json.loads(cleaned_text)
+                    analysis_result_json = response_parsing.parse_json_response(response.text)
                     
                     logger.info(f"Gemini Vision successful with API key #{i+1} for {file.filename}")
                     break # Success, exit key loop
                     
-                except json.JSONDecodeError as json_err:
+                except llm_guard.Overloaded:
+                    raise
+                except response_parsing.ResponseParseError as json_err:
                     logger.info(f"JSON Decode Error (key #{i+1}) for {file.filename}: {json_err}")
                     logger.info(f"Raw Gemini Response: {response.text}")
                     last_error = json_err # Store error and try next key
                     continue
-                except PermissionDenied as e:
+                except google_exceptions.PermissionDenied as e:
                     if "API key not valid" in str(e) or "invalid" in str(e).lower():
                         logger.info(f"Warning: Gemini API key #{i+1} failed (Invalid Key): {e}")
                         last_error = e
@@ -1844,7 +1796,7 @@ def inspect_photos():
                         logger.info(f"Gemini API Permission Error (key #{i+1}) for {file.filename}: {e}")
                         last_error = e
                         break # Non-key permission error, stop trying
-                except GoogleAPIError as e: 
+                except google_exceptions.GoogleAPIError as e: 
                     logger.info(f"Gemini API Error (key #{i+1}) for {file.filename}: {e}")
                     last_error = e
                     # Potentially retry on specific errors like rate limits, but stop for now
@@ -1853,6 +1805,7 @@ def inspect_photos():
                     logger.info(f"Unexpected Error during Gemini vision (key #{i+1}) for {file.filename}: {e}")
                     last_error = e
                     break # Stop on unexpected errors
+            model_router.record_outcome(route, time.monotonic() - started, ok=analysis_result_json is not None)
 
             # Process results if analysis was successful
             found_issues = []
@@ -1888,6 +1841,8 @@ def inspect_photos():
                 "analysis_error": str(last_error) if last_error and not analysis_result_json else None # Include error if analysis failed
             })
 
+        except llm_guard.Overloaded:
+            raise
         except Exception as file_proc_err:
              logger.info(f"Error processing file {file.filename}: {file_proc_err}")
              # Add a result indicating this file failed processing
@@ -1919,15 +1874,14 @@ def inspect_photos():
     # --- Save to Firestore ---
     inspection_id = None
     try:
-        inspection_ref = db.collection('inspections').add({
+        inspection_id = write_behind.add('inspections', {
             'userId': user_id,
             'status': 'complete', # Or indicate partial success if some files failed
             'results': all_results,
             'repairEstimate': final_estimate,
             'createdAt': firestore.SERVER_TIMESTAMP
         })
-        inspection_id = inspection_ref[1].id
-        logger.info(f"Saved inspection {inspection_id} for user {user_id}")
+        logger.info(f"Queued inspection {inspection_id} for user {user_id}")
     except Exception as db_error:
         logger.info(f"Firestore saving error for inspection (user {user_id}): {db_error}")
         # Proceed without saving, but log the error
@@ -1948,7 +1902,11 @@ def allowed_finance_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_FINANCE_EXTENSIONS
 
 @app.route('/api/scan-expense', methods=['POST'])
+@upload_limit(40 * uploads.MB)
+@llm_executor.budget(ANALYZE_BUDGET_SECONDS)
+@llm_guard.sheds_load
 def scan_expense_documents():
+    db = get_db()
     if db is None:
         return jsonify({'error': 'Server configuration error: Database unavailable.'}), 500
 
@@ -1980,35 +1938,29 @@ def scan_expense_documents():
 
             logger.info(f"Processing expense document: {file.filename}")
             file.seek(0)
-            file_bytes = file.read()
+            file_bytes = None
             mime_type = mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
             
             text_content = None
             image_fallback_bytes = None  # If we need to send an image instead of text
             if mime_type == 'application/pdf':
-                # First attempt to extract text (including OCR)
-                text_content = extract_pdf_rich_content(io.BytesIO(file_bytes))
+                # First attempt to extract text (including OCR), straight from the upload spool
+                pdf_source = uploads.pdf_source(file)
+                text_content = extract_text(pdf_source)
                 # If no meaningful text, fall back to image conversion for the first page
                 if not text_content or len(text_content.strip()) < 40:
                     try:
-                        from pdf2image import convert_from_bytes
-                        images = convert_from_bytes(file_bytes, first_page=1, last_page=1)
-                        if images:
-                            img_io = io.BytesIO()
-                            images[0].save(img_io, format='PNG')
-                            image_fallback_bytes = img_io.getvalue()
-                            mime_type = 'image/png'  # Treat as image for downstream logic
-                            logger.info(f"Falling back to image analysis for {file.filename} (first page converted to PNG).")
-                        else:
-                            raise ValueError("PDF to image conversion produced no pages.")
+                        image_fallback_bytes = render_page_png(pdf_source, page_number=1)
+                        mime_type = 'image/png'  # Treat as image for downstream logic
+                        logger.info(f"Falling back to image analysis for {file.filename} (first page converted to PNG).")
                     except Exception as img_err:
                         raise ValueError(f"Failed both text extraction and image fallback: {img_err}")
             elif mime_type.startswith('image/'):
                 # This is handled later by sending the image data directly
-                pass
+                file_bytes = file.read()
             else:
                 # For other text-based files if any
-                text_content = file_bytes.decode('utf-8')
+                text_content = file.read().decode('utf-8')
 
             prompt = """Analyze the provided financial document (e.g., receipt, invoice).
 Extract all key financial details. The output MUST be a single JSON object.
@@ -2026,49 +1978,58 @@ The final `total` is the most important field.
 Return ONLY the JSON object. Do not include ```json markdown or any other text.
 If the document is not a receipt/invoice or is unreadable, return an empty JSON object: {}
 """
+            truncated = bool(text_content) and len(text_content) > MAX_EXPENSE_TEXT_LENGTH
+            if truncated:
+                logger.info(f"Expense document {file.filename} truncated from {len(text_content)} to {MAX_EXPENSE_TEXT_LENGTH} characters")
             if text_content:
-                prompt += "\n\n" + text_content[:MAX_TEXT_LENGTH]
+                prompt += "\n\n" + text_content[:MAX_EXPENSE_TEXT_LENGTH]
 
             analysis_result_json = None
             last_error = None
+            route = model_router.choose('expense_scan', chars=len(text_content or ''))
+            started = time.monotonic()
 
-            for i, api_key in enumerate(gemini_api_keys):
+            for i in range(len(gemini_api_keys)):
                 logger.info(f"Attempting Expense Analysis with API key #{i+1} for {file.filename}")
                 try:
-                    genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
                     if mime_type.startswith('image/'):
                         # Use fallback image bytes if we created one, otherwise use original bytes
                         img_bytes = image_fallback_bytes or file_bytes
                         document_part = {"mime_type": mime_type, "data": img_bytes}
-                        response = model.generate_content([prompt, document_part])
+                        response = llm.generate([prompt, document_part], model_name=route.model, json_mode=True, key_index=i)
                     else:
-                        response = model.generate_content(prompt)
+                        response = llm.generate(prompt, model_name=route.model, json_mode=True, key_index=i)
 
                     if not response.text:
                         raise ValueError("The AI model returned an empty response.")
 
-                    cleaned_text = response.text.strip().lstrip('```json').rstrip('```').strip()
-                    analysis_result_json = json.loads(cleaned_text)
+                    analysis_result_json = response_parsing.parse_json_response(response.text)
                     # Treat an empty JSON object (i.e. {}) as a failure so we can retry with the next key
                     if isinstance(analysis_result_json, dict) and len(analysis_result_json) == 0:
                         raise ValueError("The AI model returned an empty JSON object (no data extracted).")
                     logger.info(f"Expense Analysis successful for {file.filename}")
                     last_error = None
                     break
+                except llm_guard.Overloaded:
+                    raise
                 except Exception as e:
                     last_error = e
                     logger.info(f"Error with API key #{i+1} for {file.filename}: {e}")
                     continue
+            model_router.record_outcome(route, time.monotonic() - started, ok=bool(analysis_result_json))
 
             if analysis_result_json:
                 analysis_result_json['fileName'] = file.filename
+                if truncated:
+                    analysis_result_json['truncated'] = True
                 all_extracted_data.append(analysis_result_json)
             else:
                 error_message = f"Analysis failed for {file.filename}. Last error: {last_error}"
                 logger.info(error_message)
                 processing_errors.append({"fileName": file.filename, "error": str(last_error)})
 
+        except llm_guard.Overloaded:
+            raise
         except Exception as file_proc_err:
              logger.info(f"Error processing file {file.filename}: {file_proc_err}")
              import traceback
@@ -2084,14 +2045,13 @@ If the document is not a receipt/invoice or is unreadable, return an empty JSON
         logger.info(f"Saving {len(all_extracted_data)} successfully extracted expense documents.")
         for data in all_extracted_data:
             try:
-                expense_ref = db.collection('expenses').add({
+                expense_id = write_behind.add('expenses', {
                     'userId': user_id,
                     'fileName': data.get('fileName', 'Unknown'),
                     'status': 'complete',
                     'extractedData': data,
                     'createdAt': firestore.SERVER_TIMESTAMP
                 })
-                expense_id = expense_ref[1].id
                 saved_expense_ids.append(expense_id)
             except Exception as db_error:
                 logger.info(f"Firestore saving error for expense: {db_error}")
@@ -2117,6 +2077,7 @@ If the document is not a receipt/invoice or is unreadable, return an empty JSON
 
 # --- NEW: Lease Calculator Endpoint ---
 @app.route('/api/calculate-lease', methods=['POST'])
+@upload_limit(15 * uploads.MB)
 def calculate_lease_costs():
     # Optional: Add authentication if needed
     # auth_header = request.headers.get('Authorization')
@@ -2220,48 +2181,6 @@ def calculate_lease_costs():
         return jsonify({'error': 'An unexpected error occurred during calculation.'}), 500
 # --- End Lease Calculator Endpoint ---
 
-# --- Reusable Gemini Model Initialization ---
-# Store initialized models to potentially reuse them and cycle keys
-gemini_models = {}
-current_key_index = 0
-
-def get_gemini_model(model_name="gemini-2.5-flash-preview-05-20", temperature=None):
-    global current_key_index
-    global gemini_models
-    global gemini_api_keys
-
-    if not gemini_api_keys:
-        raise ValueError("No Gemini API keys configured.")
-
-    # Cycle through keys
-    key_to_use = gemini_api_keys[current_key_index]
-    current_key_index = (current_key_index + 1) % len(gemini_api_keys)
-    
-    # Model unique ID now includes temperature if specified, to cache different configurations
-    temp_suffix = f"_t{temperature}" if temperature is not None else ""
-    model_key_id = f"{model_name}_{current_key_index}{temp_suffix}"
-
-    if model_key_id not in gemini_models:
-        logger.info(f"Initializing Gemini model {model_name} with key index {current_key_index} and temperature {temperature or 'default'}")
-        genai.configure(api_key=key_to_use)
-        
-        generation_config = {}
-        if temperature is not None:
-            generation_config['temperature'] = temperature
-
-        safety_settings = [
-            # Your safety settings here...
-        ]
-        
-        model = genai.GenerativeModel(
-            model_name, 
-            safety_settings=safety_settings,
-            generation_config=genai.types.GenerationConfig(**generation_config) if generation_config else None
-        )
-        gemini_models[model_key_id] = model
-        
-    return gemini_models[model_key_id]
-
 # --- Analyze Image with Gemini ---
 def analyze_image(image_file_storage):
     """Analyzes an uploaded image file using Gemini 2.5 Flash Preview."""
@@ -2302,12 +2221,18 @@ def analyze_image(image_file_storage):
              image_parts[0] # Embed the image data directly in the prompt list
         ]
 
-        # Get the Gemini 2.5 Flash Preview model (using the key rotation logic)
-        model = get_gemini_model(model_name="gemini-2.5-flash-preview-05-20") # Updated model name
+        # Routed model, using the key rotation logic
+        route = model_router.choose('image_description')
 
         # Generate content
-        logger.info(f"Sending image ({image_parts[0]['mime_type']}) to Gemini 2.5 Flash Preview for analysis...")
-        response = model.generate_content(prompt)
+        logger.info(f"Sending image ({image_parts[0]['mime_type']}) to {route.model} for analysis...")
+        started = time.monotonic()
+        try:
+            response = llm.generate(prompt, model_name=route.model)
+        except Exception:
+            model_router.record_outcome(route, time.monotonic() - started, ok=False)
+            raise
+        model_router.record_outcome(route, time.monotonic() - started, ok=bool(response and response.parts))
 
         # Check for response and valid text part
         if response and response.parts:
@@ -2340,7 +2265,11 @@ def analyze_image(image_file_storage):
 
 # --- New Route for Image Analysis ---
 @app.route('/api/analyze-image', methods=['POST'])
+@upload_limit(15 * uploads.MB)
+@llm_executor.budget(ANALYZE_BUDGET_SECONDS)
+@llm_guard.sheds_load
 def analyze_image_route():
+    db = get_db()
     if db is None:
          return jsonify({"error": "Database not initialized. Cannot process request."}), 503
 
@@ -2354,7 +2283,8 @@ def analyze_image_route():
     if not user_id:
         return jsonify({'error': 'Invalid or expired token'}), 401
 
-    user_profile = get_or_create_user_profile(user_id)
+    # Quota is decided on a fresh read, never on another process's cached copy
+    user_profile = get_fresh_user_profile(user_id)
     if not user_profile:
          return jsonify({'error': 'Could not retrieve or create user profile.'}), 500
 
@@ -2366,8 +2296,10 @@ def analyze_image_route():
                 'freeScansUsed': 0,
                 'lastMonthlyScan': current_month_str
             })
-            user_profile['freeScansUsed'] = 0
-            user_profile['lastMonthlyScan'] = current_month_str
+            update_cached_profile(user_id, {
+                'freeScansUsed': 0,
+                'lastMonthlyScan': current_month_str
+            })
             logger.info(f"Monthly scan count reset for user {user_id} for new month {current_month_str}")
         except Exception as e:
             logger.info(f"Error resetting monthly scans for {user_id}: {e}")
@@ -2398,8 +2330,8 @@ def analyze_image_route():
         should_increment = False
         logger.info(f"User {user_id} (Paid) - Image Analysis Access granted (Unlimited)")
     elif tier == 'premium': # New Premium tier
-        max_monthly_scans = 50 # Defined limit
-        max_daily_scans = 3 # Defined limit
+        max_monthly_scans = PREMIUM_MONTHLY_SCANS
+        max_daily_scans = PREMIUM_DAILY_SCANS
         # Check monthly limit
         if monthly_scans_used < max_monthly_scans:
             # Check daily limit
@@ -2426,7 +2358,7 @@ def analyze_image_route():
             logger.info(f"User {user_id} (Commercial) image scan limit reached ({monthly_scans_used}/{max_scans}).")
             return jsonify({'error': f'Commercial scan limit reached ({monthly_scans_used}/{max_scans} used). Contact admin for more.', 'limitReached': 'monthly'}), 429
     elif tier == 'free':
-        free_limit = 3
+        free_limit = FREE_MONTHLY_SCANS
         if monthly_scans_used < free_limit:
             can_analyze = True
             should_increment = True # Increment monthly count
@@ -2487,10 +2419,12 @@ def analyze_image_route():
     except ValueError as e: # Catch specific errors from analyze_image
         logger.info(f"ValueError in /api/analyze-image: {e}")
         return jsonify({'error': f'Analysis Error: {e}'}), 400 # Bad Request or specific error
-    except GoogleAPIError as e: # Catch Google API specific errors (rate limits, auth)
+    except google_exceptions.GoogleAPIError as e: # Catch Google API specific errors (rate limits, auth)
          logger.info(f"GoogleAPIError in /api/analyze-image: {e}")
          # Provide a more generic error to the user
          return jsonify({'error': 'Failed to communicate with the analysis service. Please try again later.'}), 503 # Service Unavailable
+    except llm_guard.Overloaded:
+        raise
     except Exception as e:
         logger.info(f"Unexpected error in /api/analyze-image: {e}")
         # Log the full traceback for debugging if possible
@@ -2500,39 +2434,132 @@ def analyze_image_route():
 
 
 # --- Async PDF analysis endpoints ---
-@app.route('/api/analyze', methods=['POST'])
-def enqueue_analyze():
-    if 'file' not in request.files:
-        return jsonify({'error': 'file required'}), 400
-    pdf_bytes = request.files['file'].read()
-    idem_key = request.headers.get('Idempotency-Key')
-    if idem_key:
-        existing = redis_conn.get(f'idempotency:{idem_key}')
-        if existing:
-            job = queue.fetch_job(existing)
-            if job:
-                return jsonify({'job_id': job.id}), 202
-    job = queue.enqueue(analyze, pdf_bytes, retry=3, result_ttl=86400)
-    if idem_key:
-        redis_conn.setex(f'idempotency:{idem_key}', 3600, job.id)
-    return jsonify({'job_id': job.id}), 202
-
 @app.route('/api/progress/<job_id>')
 def job_progress(job_id):
     def generate():
         while True:
-            job = queue.fetch_job(job_id)
+            job = queues.get_queue().fetch_job(job_id)
             if not job:
                 yield f"data: {{\"state\": \"not_found\", \"progress\": 0}}\n\n"
                 break
             state = job.get_status()
-            progress = job.meta.get('progress', 0)
-            yield f"data: {{\"state\": \"{state}\", \"progress\": {progress}}}\n\n"
+            event = {'state': state, 'progress': job.meta.get('progress', 0)}
+            if 'stage' in job.meta:
+                event['stage'] = job.meta['stage']
+                event['stageTimings'] = job.meta.get('stage_timings', {})
+            yield f"data: {json.dumps(event)}\n\n"
             if state in ('finished', 'failed', 'stopped'):
                 break
             time.sleep(1)
     return Response(generate(), mimetype='text/event-stream')
 
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Serve a finished analysis job's result from compressed storage.
+
+    ``?wait=N`` blocks up to N seconds (capped; not at all on sync workers)
+    for the job to finish. Only the user who submitted the job may read it:
+    the job's ``userId`` must match, and once the job has expired the owner
+    recorded with the stored result or its Firestore copy must. A finished
+    job with no result (one that was cancelled) gets ``410``. Supports
+    ``If-None-Match`` and sends the stored compressed body as-is to clients
+    that accept its encoding.
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Unauthorized'}), 401
+    token = auth_header.split('Bearer ')[1]
+    user_id = verify_token(token)
+    if not user_id:
+        return jsonify({'error': 'Invalid token'}), 401
+
+    try:
+        wait_seconds = min(float(request.args.get('wait', 0)), MAX_RESULT_WAIT_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    deadline = time.monotonic() + max(wait_seconds, 0)
+
+    redis_conn = queues.get_redis_conn()
+    while True:
+        job = queues.get_queue().fetch_job(job_id)
+        if job is not None and job.meta.get('userId') != user_id:
+            return jsonify({'error': 'Forbidden'}), 403
+
+        entry = job_results.load(redis_conn, job_id)
+        if entry is not None and job is None and entry.get('userId') != user_id:
+            # No job left to vouch for the cached copy: its owner is checked on the persisted one
+            entry = None
+        if entry is None and (job is None or job.get_status() == 'finished'):
+            entry = _load_persisted_job_result(job_id, user_id)
+            if entry == 'forbidden':
+                return jsonify({'error': 'Forbidden'}), 403
+        if entry is not None:
+            return _job_result_response(entry)
+
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        state = job.get_status()
+        if state in ('failed', 'stopped', 'canceled'):
+            return jsonify({'state': state, 'error': 'Analysis job did not complete.'}), 500
+        if state == 'finished':
+            # Finished without a result to serve (e.g. cancelled, or its result expired): never will have one
+            return jsonify({'state': state, 'error': 'Analysis job has no result.'}), 410
+        if time.monotonic() >= deadline:
+            response = jsonify({'state': state, 'progress': job.meta.get('progress', 0)})
+            response.headers['Retry-After'] = '1'
+            return response, 202
+        time.sleep(0.5)
+
+def _load_persisted_job_result(job_id, user_id):
+    """Fall back to the Firestore copy once Redis has expired the result."""
+    db = get_db()
+    if db is None:
+        return None
+    doc = db.collection(job_results.JOB_RESULTS_COLLECTION).document(job_id).get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict()
+    if data.get('userId') != user_id:
+        return 'forbidden'
+    # Re-cache for subsequent polls
+    return job_results.store(queues.get_redis_conn(), job_id, data.get('result', {}), user_id=user_id)
+
+def _job_result_response(entry):
+    etag = entry['etag']
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    encoding = entry['encoding']
+    accepted = request.headers.get('Accept-Encoding', '')
+    if encoding in [e.split(';')[0].strip() for e in accepted.split(',')]:
+        response = Response(entry['body'], mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = jsonify(job_results.decompress(entry['body']))
+    response.status_code = entry.get('status', 200)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, max-age=0'
+    return response
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_upload_too_large(e):
+    limit = request.max_content_length
+    message = 'Upload is too large.'
+    if limit:
+        message = f'Upload is too large. The limit for this endpoint is {limit // uploads.MB} MB.'
+    return jsonify({'error': message}), 413
+
+@app.errorhandler(llm_guard.Overloaded)
+def handle_llm_overloaded(e):
+    logger.info(f"Shedding {request.path}: {e}")
+    response = jsonify({'error': 'The analysis service is busy. Please try again shortly.',
+                        'retryAfter': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
 @app.errorhandler(Exception)
 def handle_unexpected_error(e):
     """Catches any unhandled exception."""
@@ -0,0 +1,62 @@
+"""Benchmark analysis-job throughput of the warm worker pool against fork-per-job.
+
+Enqueues ``--jobs`` rule-engine jobs (no ``user_id``, so no Gemini calls or
+Firestore writes) on the analysis queue, then drains it in burst mode with the
+chosen worker mode and the same number of processes:
+
+    python bench_worker.py --mode fork --processes 4 --jobs 500 --pdf sample.pdf
+    python bench_worker.py --mode warm --processes 4 --jobs 500 --pdf sample.pdf
+
+Use a Redis database with no other traffic (``REDIS_URL``); the queue is
+emptied before the run.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+import queues
+
+
+def run(mode, processes, jobs, pdf_path=None, text=None):
+    queue = queues.get_queue()
+    queue.empty()
+    pdf_bytes = None
+    if pdf_path:
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+    elif text is None:
+        text = 'Tenant shall pay a late fee if rent is not received. ' * 200
+    enqueued = [queue.enqueue('tasks.analyze', pdf_bytes, text=text, result_ttl=600)
+                for _ in range(jobs)]
+
+    started = time.monotonic()
+    if mode == 'fork':
+        workers = [subprocess.Popen([sys.executable, 'worker.py', '--burst', '--mode', 'fork'])
+                   for _ in range(processes)]
+    else:
+        workers = [subprocess.Popen([sys.executable, 'worker.py', '--burst', '--mode', 'warm',
+                                     '--processes', str(processes)])]
+    for process in workers:
+        process.wait()
+    elapsed = time.monotonic() - started
+
+    failed = sum(1 for job in enqueued if job.get_status(refresh=True) != 'finished')
+    print(f"mode:        {mode} ({processes} processes)")
+    print(f"jobs:        {jobs} ({failed} not finished)")
+    print(f"elapsed:     {elapsed:.2f}s (includes worker start-up)")
+    print(f"throughput:  {jobs / elapsed:.1f} jobs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('warm', 'fork'), required=True)
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--pdf', help='PDF to analyse in every job (default: a short text lease)')
+    args = parser.parse_args()
+    run(args.mode, args.processes, args.jobs, pdf_path=args.pdf)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Signed completion callbacks for analysis jobs.
+
+A client that submits a job with ``callback_url`` gets the outcome POSTed to
+that URL by a worker instead of holding an SSE connection open. The JSON body is
+signed with HMAC-SHA256 (``X-LeaseShield-Signature``), the same scheme used to
+verify Maxelpay webhooks. Failed deliveries are re-scheduled on the RQ
+scheduler with exponential backoff; after ``CALLBACK_MAX_ATTEMPTS`` the payload
+is written to the ``callback_dead_letters`` collection.
+
+``validate_callback_url`` only screens the URL as submitted: a public name
+can resolve to an internal address by the time the job finishes (DNS
+rebinding). Each delivery therefore resolves the host itself, refuses it if
+any address is private, loopback, link-local or otherwise not globally
+routable, and connects to the address it checked (TLS is still verified
+against the host name). Redirects are never followed.
+"""
+import datetime
+import ipaddress
+import json
+import logging
+import os
+import socket
+from urllib.parse import urlparse
+
+import queues
+import signatures
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_SIGNING_SECRET = os.environ.get('CALLBACK_SIGNING_SECRET')
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get('CALLBACK_MAX_ATTEMPTS', 8))
+CALLBACK_TIMEOUT_SECONDS = float(os.environ.get('CALLBACK_TIMEOUT_SECONDS', 10))
+CALLBACK_BASE_DELAY_SECONDS = 30
+CALLBACK_MAX_DELAY_SECONDS = 3600
+DEAD_LETTER_COLLECTION = 'callback_dead_letters'
+
+# Client errors that will not go away on retry; 408 and 429 are retried
+_RETRYABLE_4XX = {408, 425, 429}
+
+
+class UnsafeCallbackHost(Exception):
+    """The callback host resolves to an address callbacks must not reach."""
+
+
+def validate_callback_url(url):
+    """Return an error message for an unacceptable callback URL, else None."""
+    if not isinstance(url, str) or len(url) > 2048:
+        return 'callback_url must be a URL string'
+    parsed = urlparse(url)
+    if parsed.scheme != 'https' or not parsed.hostname:
+        return 'callback_url must be an absolute https:// URL'
+    host = parsed.hostname.lower()
+    if host == 'localhost' or host.endswith('.localhost') or host.endswith('.internal'):
+        return 'callback_url must point to a public host'
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    if not address.is_global:
+        return 'callback_url must point to a public host'
+    return None
+
+
+def resolve_public_address(host, port):
+    """The address to deliver to: ``host`` resolved, if every address it has is public.
+
+    Raises ``UnsafeCallbackHost`` otherwise, and ``OSError`` if it doesn't resolve.
+    """
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+    if not addresses:
+        raise OSError(f"{host} has no addresses")
+    for address in addresses:
+        if not address.is_global:
+            raise UnsafeCallbackHost(f"{host} resolves to non-public address {address}")
+    return addresses[0]
+
+
+def _pinned_session(host):
+    """A requests session whose HTTPS connections verify TLS against ``host``, whatever address they dial."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class PinnedAdapter(HTTPAdapter):
+        def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+            pool_kwargs['server_hostname'] = host
+            pool_kwargs['assert_hostname'] = host
+            super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    session = requests.Session()
+    session.trust_env = False  # no proxies: the connection must go to the checked address
+    session.mount('https://', PinnedAdapter())
+    return session
+
+
+def _post(callback_url, body, headers):
+    """POST to ``callback_url`` via the address it resolves to now, checked to be public."""
+    parsed = urlparse(callback_url)
+    port = parsed.port or 443
+    address = resolve_public_address(parsed.hostname, port)
+    netloc = f"[{address}]" if address.version == 6 else str(address)
+    url = parsed._replace(netloc=f"{netloc}:{port}").geturl()
+    host_header = parsed.hostname if parsed.port in (None, 443) else f"{parsed.hostname}:{parsed.port}"
+    with _pinned_session(parsed.hostname) as session:
+        return session.post(url, data=body, headers=dict(headers, Host=host_header),
+                            timeout=CALLBACK_TIMEOUT_SECONDS, allow_redirects=False)
+
+
+def retry_delay(attempt):
+    """Seconds to wait before delivery attempt ``attempt + 1``."""
+    return min(CALLBACK_MAX_DELAY_SECONDS, CALLBACK_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+
+
+def schedule(job_id, user_id, callback_url, payload):
+    """Queue the first delivery attempt for a finished or failed job."""
+    return queues.get_queue().enqueue('callbacks.deliver', job_id, user_id, callback_url,
+                                      payload, attempt=1, result_ttl=0)
+
+
+def deliver(job_id, user_id, callback_url, payload, attempt=1):
+    """RQ job: POST ``payload`` to ``callback_url`` and re-schedule on failure."""
+    import requests
+
+    body = json.dumps(dict(payload, jobId=job_id, attempt=attempt,
+                           sentAt=datetime.datetime.utcnow().isoformat() + 'Z'),
+                      separators=(',', ':'), sort_keys=True).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'LeaseShield-Callbacks/1.0',
+        'X-LeaseShield-Job-Id': job_id,
+        'X-LeaseShield-Delivery-Attempt': str(attempt),
+    }
+    if CALLBACK_SIGNING_SECRET:
+        headers['X-LeaseShield-Signature'] = signatures.sign(body, CALLBACK_SIGNING_SECRET)
+
+    error = None
+    retryable = True
+    try:
+        response = _post(callback_url, body, headers)
+        if 200 <= response.status_code < 300:
+            logger.info(f"Callback for job {job_id} delivered on attempt {attempt}")
+            return True
+        # Redirects aren't followed: a 3xx is a failed delivery
+        error = f"HTTP {response.status_code}"
+        retryable = response.status_code >= 500 or response.status_code in _RETRYABLE_4XX
+    except UnsafeCallbackHost as e:
+        error = str(e)
+        retryable = False
+    except (requests.RequestException, OSError) as e:
+        error = str(e)
+
+    if retryable and attempt < CALLBACK_MAX_ATTEMPTS:
+        delay = retry_delay(attempt)
+        logger.warning(f"Callback for job {job_id} failed ({error}), attempt {attempt}; retrying in {delay}s")
+        queues.get_queue().enqueue_in(datetime.timedelta(seconds=delay), 'callbacks.deliver',
+                                      job_id, user_id, callback_url, payload,
+                                      attempt=attempt + 1, result_ttl=0)
+        return False
+
+    logger.error(f"Callback for job {job_id} abandoned after {attempt} attempts: {error}")
+    dead_letter(job_id, user_id, callback_url, payload, attempt, error)
+    return False
+
+
+def dead_letter(job_id, user_id, callback_url, payload, attempts, error):
+    from firebase_admin import firestore
+    from persistence import write_now
+
+    write_now(DEAD_LETTER_COLLECTION, {
+        'jobId': job_id,
+        'userId': user_id,
+        'callbackUrl': callback_url,
+        'payload': payload,
+        'attempts': attempts,
+        'lastError': error,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+    }, doc_id=job_id)
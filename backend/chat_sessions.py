@@ -0,0 +1,109 @@
+"""Conversation-scoped document sessions for /api/chat.
+
+The first message of a conversation creates a session; its PDFs are extracted
+once and the text is kept in Redis (compressed, ``CHAT_SESSION_TTL_SECONDS``
+after last use) under the returned session id. Follow-up messages send only
+the session id and the new message.
+
+Prompts are laid out as a stable prefix - the documents, then earlier turns -
+followed by the new message, and every turn of a session starts on the same
+API key. Gemini 2.5's implicit context caching keys on identical prompt
+prefixes per project, so from the second turn on the document tokens are
+served from its cache. Explicit ``CachedContent`` needs a newer
+google-generativeai than the pinned 0.5.4 and would tie a session to one key's
+project, so it isn't used.
+"""
+import hashlib
+import os
+import time
+import uuid
+
+import job_results
+
+CHAT_SESSION_TTL_SECONDS = int(os.environ.get('CHAT_SESSION_TTL_SECONDS', 2 * 3600))
+CHAT_SESSION_MAX_TURNS = int(os.environ.get('CHAT_SESSION_MAX_TURNS', 20))
+CHAT_SESSION_MAX_DOCUMENT_CHARS = int(os.environ.get('CHAT_SESSION_MAX_DOCUMENT_CHARS', 400000))
+
+PREAMBLE = ("You are Lease Shield's assistant. Answer the user's latest message; the documents "
+            "they shared and the conversation so far are included for context.")
+
+
+class SessionNotFound(LookupError):
+    """Unknown, expired, or someone else's session."""
+
+
+def _key(session_id):
+    return f'chat-session:{session_id}'
+
+
+def new_session(user_id, key_index=0):
+    return {
+        'id': uuid.uuid4().hex,
+        'userId': user_id,
+        'keyIndex': key_index,
+        'documents': [],
+        'turns': [],
+        'createdAt': time.time(),
+    }
+
+
+def load(redis_conn, session_id, user_id):
+    body = redis_conn.get(_key(session_id)) if session_id else None
+    if body is None:
+        raise SessionNotFound(session_id)
+    session = job_results.decompress(body)
+    if session.get('userId') != user_id:
+        raise SessionNotFound(session_id)
+    return session
+
+
+def save(redis_conn, session):
+    body, _ = job_results.compress(session)
+    redis_conn.set(_key(session['id']), body, ex=CHAT_SESSION_TTL_SECONDS)
+
+
+def delete(redis_conn, session_id):
+    redis_conn.delete(_key(session_id))
+
+
+def has_document(session, content_hash):
+    return any(doc['hash'] == content_hash for doc in session['documents'])
+
+
+def add_document(session, name, text, content_hash=None):
+    """Add a document's text; False if it is already in the session or doesn't fit."""
+    content_hash = content_hash or hashlib.sha256(text.encode('utf-8')).hexdigest()
+    if has_document(session, content_hash):
+        return False
+    used = sum(len(doc['text']) for doc in session['documents'])
+    if used + len(text) > CHAT_SESSION_MAX_DOCUMENT_CHARS:
+        return False
+    session['documents'].append({'name': name, 'hash': content_hash, 'text': text})
+    return True
+
+
+def add_turn(session, message, reply):
+    session['turns'].append({'user': message, 'model': reply})
+    # Dropping the oldest turn changes the prefix once, rather than every turn
+    del session['turns'][:-CHAT_SESSION_MAX_TURNS]
+
+
+def context_prefix(session):
+    """Documents then earlier turns: identical across a session's turns until a new one is added."""
+    parts = [PREAMBLE]
+    for doc in session['documents']:
+        parts.append(f"--- PDF Content: {doc['name']} ---\n{doc['text']}")
+    if session['turns']:
+        history = '\n\n'.join(f"User: {turn['user']}\nAssistant: {turn['model']}"
+                              for turn in session['turns'])
+        parts.append(f"--- Conversation so far ---\n{history}")
+    return '\n\n'.join(parts)
+
+
+def build_prompt(session, message, extra_parts=()):
+    """Prompt parts for the next turn: the cached prefix, the new message, then e.g. images."""
+    prompt = [context_prefix(session)]
+    if message:
+        prompt.append(f"--- Latest message ---\n{message}")
+    prompt.extend(extra_parts)
+    return prompt
@@ -0,0 +1,34 @@
+"""Per-stage checkpoints for analysis jobs.
+
+Each completed stage of ``tasks.analyze`` stores its output in Redis, keyed by
+job ID, a hash of the job's input and the stage name. When RQ retries the job,
+or re-queues it after a worker crash, finished stages are loaded instead of
+re-run, so a late Gemini failure does not repeat a slow OCR pass.
+"""
+import os
+
+import job_results
+
+CHECKPOINT_TTL_SECONDS = int(os.environ.get('CHECKPOINT_TTL_SECONDS', 86400))
+
+
+def _key(job_id, input_hash, stage):
+    return f'checkpoint:{job_id}:{input_hash}:{stage}'
+
+
+def load(redis_conn, job_id, input_hash, stage):
+    """Return ``(found, value)`` for a stage's saved output."""
+    body = redis_conn.get(_key(job_id, input_hash, stage))
+    if body is None:
+        return False, None
+    return True, job_results.decompress(body)['value']
+
+
+def save(redis_conn, job_id, input_hash, stage, value, ttl=CHECKPOINT_TTL_SECONDS):
+    body, _ = job_results.compress({'value': value})
+    redis_conn.set(_key(job_id, input_hash, stage), body, ex=ttl)
+
+
+def clear(redis_conn, job_id, input_hash, stages):
+    """Drop a finished job's checkpoints."""
+    redis_conn.delete(*[_key(job_id, input_hash, stage) for stage in stages])
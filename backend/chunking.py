@@ -0,0 +1,204 @@
+"""Map-reduce analysis for leases too long for a single prompt.
+
+The text is split at section boundaries (article/section headings, numbered
+clauses) into chunks of at most ``LEASE_CHUNK_CHARS``. Chunks are analysed
+concurrently and the per-chunk results are merged deterministically:
+
+* ``extracted_data`` / ``clause_summaries`` - per key, the first value in
+  document order that isn't "Not Found",
+* ``risks`` - concatenated in document order, duplicates dropped,
+* ``score`` - the mean of the chunk scores weighted by chunk length
+  ("Not Found", as for a single prompt, if no chunk scored the lease).
+
+A chunk that fails or misses ``LEASE_CHUNK_DEADLINE_SECONDS`` is left out of
+the merge, so latency stays bounded by the slowest chunk within the deadline.
+The merged result says so in ``coverage`` (whether every part was analysed,
+the analysed share of the text and the parts missing), which the API passes
+on to the client. When more than ``LEASE_MAX_FAILED_CHUNK_SHARE`` of the
+chunks failed the result isn't worth keeping: ``analyze_chunked`` returns
+None, so the analysis fails and no scan is charged.
+A lease needing more than ``LEASE_MAX_CHUNKS`` chunks is rejected up front
+with ``DocumentTooLong`` (``check_length``) rather than fanned out into an
+unbounded number of Gemini calls.
+"""
+import concurrent.futures
+import contextvars
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+LEASE_CHUNK_CHARS = int(os.environ.get('LEASE_CHUNK_CHARS', 40000))
+LEASE_CHUNK_WORKERS = int(os.environ.get('LEASE_CHUNK_WORKERS', 4))
+LEASE_MAX_CHUNKS = int(os.environ.get('LEASE_MAX_CHUNKS', 12))
+LEASE_CHUNK_DEADLINE_SECONDS = float(os.environ.get('LEASE_CHUNK_DEADLINE_SECONDS', 240))
+# Fail the analysis when more chunks than this could not be analysed
+LEASE_MAX_FAILED_CHUNK_SHARE = float(os.environ.get('LEASE_MAX_FAILED_CHUNK_SHARE', 0.25))
+CLAUSE_MAX_CHARS = int(os.environ.get('CLAUSE_MAX_CHARS', 4000))
+CLAUSE_MIN_CHARS = 80
+
+NOT_FOUND = 'Not Found'
+MERGED_OBJECT_KEYS = ('extracted_data', 'clause_summaries')
+
+
+class DocumentTooLong(ValueError):
+    """The text would need more than ``LEASE_MAX_CHUNKS`` chunks."""
+
+# A line that starts a new section: "ARTICLE 4", "Section 12", "§ 3", "12.", "12.3 Rent", "IV."
+_SECTION_START = re.compile(
+    r'^[ \t]*(?:(?:ARTICLE|Article|SECTION|Section|CLAUSE|Clause|SCHEDULE|Schedule|ADDENDUM|Addendum)'
+    r'[ \t]+(?:\d{1,3}|[IVXLC]{1,6}|[A-Z])\b'
+    r'|§|\d{1,3}(?:\.\d{1,3})*[.)][ \t]|[IVXLC]{1,6}\.[ \t])',
+    re.MULTILINE)
+
+
+def _hard_split(block, max_chars):
+    """Split an oversized block at paragraph, then sentence, then character boundaries."""
+    pieces = []
+    while len(block) > max_chars:
+        window = block[:max_chars]
+        cut = window.rfind('\n\n')
+        if cut < max_chars // 2:
+            cut = max(window.rfind('. '), window.rfind('.\n'))
+            cut = cut + 1 if cut >= max_chars // 2 else max_chars
+        pieces.append(block[:cut])
+        block = block[cut:]
+    if block:
+        pieces.append(block)
+    return pieces
+
+
+def _section_blocks(text, max_chars):
+    """``text`` cut at every section start, with oversized sections hard-split."""
+    starts = [m.start() for m in _SECTION_START.finditer(text)]
+    bounds = sorted({0, *starts, len(text)})
+    blocks = []
+    for start, end in zip(bounds, bounds[1:]):
+        blocks.extend(_hard_split(text[start:end], max_chars))
+    return blocks
+
+
+def split_clauses(text, max_chars=CLAUSE_MAX_CHARS, min_chars=CLAUSE_MIN_CHARS):
+    """Split ``text`` into individual clauses (see clause_analysis.py).
+
+    A block shorter than ``min_chars``, typically a bare heading such as
+    "ARTICLE 4 - RENT", is joined to the clause that follows it.
+    """
+    clauses, pending = [], ''
+    for block in _section_blocks(text, max_chars):
+        pending += block
+        if len(pending.strip()) >= min_chars:
+            clauses.append(pending)
+            pending = ''
+    if pending.strip():
+        if clauses and len(clauses[-1]) + len(pending) <= max_chars:
+            clauses[-1] += pending
+        else:
+            clauses.append(pending)
+    return clauses
+
+
+def split_sections(text, max_chars=LEASE_CHUNK_CHARS):
+    """Split ``text`` into chunks of at most ``max_chars``, preferring section boundaries."""
+    blocks = _section_blocks(text, max_chars)
+
+    chunks, current = [], ''
+    for block in blocks:
+        if current and len(current) + len(block) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += block
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+def _is_found(value):
+    return value not in (None, '', NOT_FOUND, [], {})
+
+
+def merge_results(results, weights):
+    """Merge per-chunk analysis dicts (``None`` for failed chunks) in document order."""
+    merged = {key: {} for key in MERGED_OBJECT_KEYS}
+    risks, seen_risks = [], set()
+    weighted_score, score_weight = 0.0, 0
+    for result, weight in zip(results, weights):
+        if not isinstance(result, dict) or 'error_message' in result:
+            continue
+        for key in MERGED_OBJECT_KEYS:
+            for field, value in (result.get(key) or {}).items():
+                if _is_found(value) and not _is_found(merged[key].get(field)):
+                    merged[key][field] = value
+                else:
+                    merged[key].setdefault(field, NOT_FOUND)
+        for risk in result.get('risks') or []:
+            normalized = ' '.join(str(risk).lower().split())
+            if normalized not in seen_risks:
+                seen_risks.add(normalized)
+                risks.append(risk)
+        try:
+            weighted_score += float(result['score']) * weight
+            score_weight += weight
+        except (KeyError, TypeError, ValueError):
+            pass
+    merged['risks'] = risks
+    merged['score'] = int(round(weighted_score / score_weight)) if score_weight else NOT_FOUND
+    return merged
+
+
+def check_length(text, max_chars=LEASE_CHUNK_CHARS):
+    """Raise ``DocumentTooLong`` if ``text`` needs more than ``LEASE_MAX_CHUNKS`` chunks."""
+    count = len(split_sections(text, max_chars))
+    if count > LEASE_MAX_CHUNKS:
+        raise DocumentTooLong(f"The document is too long to analyze ({len(text)} characters, "
+                              f"{count} parts; the limit is {LEASE_MAX_CHUNKS} parts of up to "
+                              f"{max_chars} characters).")
+
+
+def analyze_chunked(text, analyze_chunk, max_chars=LEASE_CHUNK_CHARS):
+    """Run ``analyze_chunk(chunk, index, count)`` over every chunk concurrently and merge.
+
+    ``analyze_chunk`` returns a parsed analysis dict, or None on failure.
+    Returns None if more than ``LEASE_MAX_FAILED_CHUNK_SHARE`` of the chunks
+    failed; raises ``DocumentTooLong`` above ``LEASE_MAX_CHUNKS`` chunks.
+    """
+    chunks = split_sections(text, max_chars)
+    if not chunks:
+        return None
+    if len(chunks) > LEASE_MAX_CHUNKS:
+        raise DocumentTooLong(f"The document is too long to analyze ({len(chunks)} parts; "
+                              f"the limit is {LEASE_MAX_CHUNKS}).")
+    logger.info(f"Analyzing {len(text)} characters as {len(chunks)} chunk(s)")
+    results = [None] * len(chunks)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(LEASE_CHUNK_WORKERS, len(chunks)))
+    try:
+        # Each chunk runs in a copy of the caller's context so it keeps the LLM deadline
+        futures = {pool.submit(contextvars.copy_context().run, analyze_chunk, chunk, i + 1, len(chunks)): i
+                   for i, chunk in enumerate(chunks)}
+        done, not_done = concurrent.futures.wait(futures, timeout=LEASE_CHUNK_DEADLINE_SECONDS)
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logger.info(f"Chunk {futures[future] + 1}/{len(chunks)} failed: {e}")
+        for future in not_done:
+            future.cancel()
+            logger.info(f"Chunk {futures[future] + 1}/{len(chunks)} missed the deadline")
+    finally:
+        pool.shutdown(wait=False)
+
+    missing = [i + 1 for i, result in enumerate(results)
+               if not isinstance(result, dict) or 'error_message' in result]
+    if len(missing) == len(chunks) or len(missing) > LEASE_MAX_FAILED_CHUNK_SHARE * len(chunks):
+        logger.info(f"Chunked analysis failed for {len(missing)}/{len(chunks)} chunks; not using it")
+        return None
+    merged = merge_results(results, [len(chunk) for chunk in chunks])
+    merged['chunking'] = {'chunks': len(chunks), 'failed': len(missing)}
+    analyzed_chars = sum(len(chunk) for i, chunk in enumerate(chunks) if i + 1 not in missing)
+    merged['coverage'] = {
+        'complete': not missing,
+        'analyzedShare': round(analyzed_chars / sum(len(chunk) for chunk in chunks), 3),
+        'missingParts': missing,
+    }
+    return merged
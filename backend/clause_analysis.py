@@ -0,0 +1,275 @@
+"""Clause-level lease analysis with a clause cache.
+
+Off unless ``CLAUSE_ANALYSIS_ENABLED=true``, so it can be rolled out
+deliberately. The lease is split into clauses (``chunking.split_clauses``).
+Each clause is normalized and hashed (see clause_cache.py), and clauses
+seen in an earlier lease reuse their cached annotation: category, summary,
+risks and stated facts. Only novel clauses go to Gemini, up to
+``CLAUSE_BATCH_SIZE`` per call, with the calls running concurrently. The
+result is assembled in document order into the usual analysis shape:
+
+* ``extracted_data`` - the first value stated for each field,
+* ``clause_summaries`` - the summaries of the clauses in each category,
+* ``risks`` - every clause's risks, duplicates dropped,
+* ``score`` - from one more call, which rates the collected risks on the
+  whole-document prompt's 0-100 scale. If that call fails, the score is 100
+  less a penalty per risk by severity.
+
+The shared cache is used by every user, so only annotations from
+single-clause calls are stored there: in a batched prompt, text in one
+clause could steer the annotation of another, and a tenant could poison the
+cached analysis of common boilerplate that other tenants receive. Batched
+annotations are cached under the submitting user's scope, which still makes
+their next version of the same lease cheap.
+
+Once more than ``CLAUSE_MAX_FAILED_SHARE`` of the clauses have failed, the
+batches not yet sent are dropped, so the fallback to whole-document
+analysis doesn't pay for them too.
+
+``clauseCache`` on the result reports the clause count, how many were
+served without a Gemini call and the hit rate. ``on_clauses`` receives
+``[{'clause': number, **annotation}, ...]`` for the cached clauses first and
+then for each batch as Gemini answers it, for progressive delivery. ``analyze`` returns None
+(and the caller falls back to whole-document analysis) when the lease has no
+usable clause structure or too many clauses couldn't be annotated.
+"""
+import concurrent.futures
+import contextvars
+import logging
+import os
+
+import chunking
+import clause_cache
+import response_parsing
+from llm import analyze_clauses, score_risks
+
+logger = logging.getLogger(__name__)
+
+CLAUSE_ANALYSIS_ENABLED = os.environ.get('CLAUSE_ANALYSIS_ENABLED', 'false').lower() == 'true'
+CLAUSE_BATCH_SIZE = int(os.environ.get('CLAUSE_BATCH_SIZE', 8))
+CLAUSE_BATCH_CHARS = int(os.environ.get('CLAUSE_BATCH_CHARS', 30000))
+CLAUSE_BATCH_WORKERS = int(os.environ.get('CLAUSE_BATCH_WORKERS', 8))
+# Fall back to whole-document analysis when more clauses than this could not be annotated
+CLAUSE_MAX_FAILED_SHARE = 0.25
+# Below this many clauses the text has no clause structure worth caching
+CLAUSE_MIN_COUNT = 3
+
+NOT_FOUND = response_parsing.NOT_FOUND
+OTHER = 'Other'
+SEVERITIES = ('low', 'medium', 'high')
+SEVERITY_PENALTY = {'low': 2, 'medium': 7, 'high': 15}
+
+
+def clean_annotation(item):
+    """Conform one clause annotation from Gemini to the cached format."""
+    category = item.get('category')
+    if category not in response_parsing.LEASE_CLAUSE_FIELDS:
+        category = OTHER
+    risks = []
+    for risk in item.get('risks') or []:
+        if isinstance(risk, str):
+            risk = {'text': risk}
+        if isinstance(risk, dict) and str(risk.get('text') or '').strip():
+            severity = str(risk.get('severity', '')).lower()
+            risks.append({'text': str(risk['text']).strip(),
+                          'severity': severity if severity in SEVERITIES else 'medium'})
+    facts = item.get('facts') if isinstance(item.get('facts'), dict) else {}
+    return {
+        'category': category,
+        'summary': str(item.get('summary') or '').strip(),
+        'risks': risks,
+        'facts': {field: str(value).strip() for field, value in facts.items()
+                  if field in response_parsing.LEASE_EXTRACTED_FIELDS
+                  and value not in (None, '', NOT_FOUND)},
+    }
+
+
+def score_from_risks(risks):
+    """Fallback score when ``score_risks`` fails: 100 less a penalty per risk."""
+    return max(0, 100 - sum(SEVERITY_PENALTY.get(risk['severity'], 7) for risk in risks))
+
+
+def assemble(annotations, tier=None):
+    """Build the analysis from per-clause annotations in document order (None entries skipped)."""
+    extracted = {}
+    summaries = {}
+    risks, seen_risks = [], set()
+    for annotation in annotations:
+        if annotation is None:
+            continue
+        for field, value in annotation['facts'].items():
+            extracted.setdefault(field, value)
+        if annotation['category'] != OTHER and annotation['summary']:
+            summaries.setdefault(annotation['category'], []).append(annotation['summary'])
+        for risk in annotation['risks']:
+            normalized = ' '.join(risk['text'].lower().split())
+            if normalized not in seen_risks:
+                seen_risks.add(normalized)
+                risks.append(risk)
+    result = response_parsing.normalize_lease_analysis({
+        'extracted_data': extracted,
+        'clause_summaries': {category: ' '.join(parts) for category, parts in summaries.items()},
+        'risks': [risk['text'] for risk in risks],
+        'score': _score(risks, tier),
+    })
+    result['risk_details'] = risks
+    return result
+
+
+def _score(risks, tier):
+    if not risks:
+        return 100
+    score = score_risks(risks, tier=tier)
+    return score_from_risks(risks) if score is None else score
+
+
+def _batches(numbered, max_clauses=None, max_chars=CLAUSE_BATCH_CHARS):
+    max_clauses = max_clauses or CLAUSE_BATCH_SIZE
+    batch, size = [], 0
+    for number, clause in numbered:
+        if batch and (len(batch) >= max_clauses or size + len(clause) > max_chars):
+            yield batch
+            batch, size = [], 0
+        batch.append((number, clause))
+        size += len(clause)
+    if batch:
+        yield batch
+
+
+def _annotate_batch(batch, tier):
+    """``{clause number: annotation}`` for one batch; missing numbers failed."""
+    response_text = analyze_clauses(batch, tier=tier)
+    if not response_text:
+        return {}
+    try:
+        data = response_parsing.parse_json_response(response_text)
+    except response_parsing.ResponseParseError as e:
+        logger.info(f"Clause batch response not parseable: {e}")
+        return {}
+    wanted = {number for number, _ in batch}
+    annotations = {}
+    for item in data.get('clauses') or []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            number = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        if number in wanted:
+            annotations[number] = clean_annotation(item)
+    return annotations
+
+
+def _report(on_clauses, annotations):
+    if on_clauses and annotations:
+        on_clauses([dict(annotation, clause=number) for number, annotation in sorted(annotations.items())])
+
+
+def annotate(numbered, tier=None, on_batch=None, max_failed=None):
+    """Annotate ``[(number, clause), ...]`` with Gemini, batches in parallel.
+
+    Returns ``(annotations, shareable)``: ``{number: annotation}`` and the
+    numbers annotated in a single-clause call, which alone may go in the
+    shared cache. Once more than ``max_failed`` clauses have failed, the
+    batches not yet sent are dropped.
+    """
+    batches = list(_batches(numbered))
+    if not batches:
+        return {}, set()
+    annotations, shareable = {}, set()
+    failed = 0
+    workers = min(CLAUSE_BATCH_WORKERS, len(batches))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = iter(batches)
+    futures = {}
+
+    def submit_next():
+        batch = next(pending, None)
+        if batch is not None:
+            # Each batch runs in a copy of the caller's context so it keeps the LLM deadline
+            futures[pool.submit(contextvars.copy_context().run, _annotate_batch, batch, tier)] = batch
+
+    try:
+        # Only ``workers`` batches are sent at a time, so a failing run stops sending early
+        for _ in range(workers):
+            submit_next()
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch = futures.pop(future)
+                batch_annotations = future.result()
+                annotations.update(batch_annotations)
+                if len(batch) == 1:
+                    shareable.update(batch_annotations)
+                if on_batch:
+                    on_batch(batch_annotations)
+                failed += len(batch) - len(batch_annotations)
+            if max_failed is not None and failed > max_failed:
+                logger.info(f"Clause analysis: {failed} clauses failed; not sending the remaining batches")
+                break
+            for _ in done:
+                submit_next()
+    finally:
+        pool.shutdown(wait=False)
+    return annotations, shareable
+
+
+def _lookup(clauses, user_id):
+    """Cached annotations for ``clauses``: the shared cache first, then the user's own."""
+    annotations = clause_cache.lookup_many([clause_cache.cache_key(clause) for clause in clauses])
+    missing = [i for i, annotation in enumerate(annotations) if annotation is None]
+    if user_id and missing:
+        scoped = clause_cache.lookup_many([clause_cache.cache_key(clauses[i], scope=user_id) for i in missing])
+        for i, annotation in zip(missing, scoped):
+            annotations[i] = annotation
+    return annotations
+
+
+def analyze(text, tier=None, on_clauses=None, user_id=None):
+    """Clause-level analysis of ``text`` reusing cached clauses; None to fall back."""
+    clauses = chunking.split_clauses(text)
+    if len(clauses) < CLAUSE_MIN_COUNT:
+        return None
+    keys = [clause_cache.cache_key(clause) for clause in clauses]
+    annotations = _lookup(clauses, user_id)
+    from_cache = sum(1 for annotation in annotations if annotation is not None)
+    _report(on_clauses, {i + 1: annotation for i, annotation in enumerate(annotations) if annotation is not None})
+
+    # A clause repeated within the lease is analysed once
+    novel = {}
+    for i, (key, annotation) in enumerate(zip(keys, annotations)):
+        if annotation is None and key not in novel:
+            novel[key] = i
+    max_failed = CLAUSE_MAX_FAILED_SHARE * len(clauses)
+    fresh, shareable = annotate([(i + 1, clauses[i]) for i in novel.values()], tier=tier,
+                                on_batch=lambda batch: _report(on_clauses, batch), max_failed=max_failed)
+    entries = {}
+    for number, annotation in fresh.items():
+        if number in shareable:
+            entries[keys[number - 1]] = annotation
+        elif user_id:
+            entries[clause_cache.cache_key(clauses[number - 1], scope=user_id)] = annotation
+    clause_cache.store_many(entries)
+
+    failed = 0
+    for i, key in enumerate(keys):
+        if annotations[i] is None:
+            annotations[i] = fresh.get(novel[key] + 1)
+            failed += annotations[i] is None
+    if failed > max_failed:
+        logger.info(f"Clause analysis failed for {failed}/{len(clauses)} clauses; falling back")
+        return None
+
+    result = assemble(annotations, tier=tier)
+    reused = len(clauses) - len(novel)
+    result['clauseCache'] = {
+        'clauses': len(clauses),
+        'hits': reused,
+        'fromCache': from_cache,
+        'analyzed': len(fresh),
+        'failed': failed,
+        'hitRate': round(reused / len(clauses), 3),
+    }
+    logger.info(f"Clause analysis: {len(clauses)} clauses, {reused} reused "
+                f"({from_cache} from cache), {len(fresh)} sent to Gemini, {failed} failed")
+    return result
@@ -0,0 +1,98 @@
+"""Clause-level cache of Gemini clause annotations, shared across documents.
+
+Leases reuse the same boilerplate clauses. ``clause_analysis`` normalizes
+each clause (leading section number, case, whitespace, quote and dash
+variants), hashes it and looks
+the hash up here before asking Gemini, so a clause seen in any earlier lease
+costs nothing. Entries live in Redis (``CLAUSE_CACHE=redis``, the default, or
+``off``) and each hit refreshes the entry's TTL.
+
+Cache errors are logged and treated as misses.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+CLAUSE_CACHE = os.environ.get('CLAUSE_CACHE', 'redis')
+CLAUSE_CACHE_TTL_SECONDS = int(os.environ.get('CLAUSE_CACHE_TTL_SECONDS', 90 * 86400))
+# Bump when the clause prompt or annotation format changes so stale annotations are not reused
+CACHE_VERSION = 2
+
+_QUOTES = str.maketrans({'\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"',
+                         '\u2013': '-', '\u2014': '-', '\u00a0': ' '})
+_SPACE_RE = re.compile(r'\s+')
+# "5.", "4.2)", "B.", "iv)", optionally after "Section"/"Article"/"Clause": the same clause is
+# numbered differently from lease to lease
+_NUMBERING_RE = re.compile(r'^\s*(?:(?:article|section|clause)\s+)?(?:\d+(?:\.\d+)*|[A-Z]|[ivx]+)[.)]\s*',
+                           re.IGNORECASE)
+
+
+def normalize(clause):
+    """Canonical form of a clause: the same wording hashes the same however it was numbered or laid out."""
+    return _SPACE_RE.sub(' ', _NUMBERING_RE.sub('', clause, count=1).translate(_QUOTES)).strip().lower()
+
+
+def cache_key(clause, scope=None):
+    """Key of ``clause`` in the shared cache, or in ``scope``'s own (e.g. a user ID) when given."""
+    prefix = f'{CACHE_VERSION}:{scope}:' if scope else f'{CACHE_VERSION}:'
+    return hashlib.sha256(f'{prefix}{normalize(clause)}'.encode('utf-8')).hexdigest()
+
+
+class RedisClauseCache:
+    def __init__(self, get_conn, ttl=CLAUSE_CACHE_TTL_SECONDS):
+        self._get_conn = get_conn
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        pipe = self._get_conn().pipeline(transaction=False)
+        for key in keys:
+            pipe.getex(f'clause:{key}', ex=self.ttl)
+        return [json.loads(value) if value is not None else None for value in pipe.execute()]
+
+    def put_many(self, entries):
+        pipe = self._get_conn().pipeline(transaction=False)
+        for key, annotation in entries.items():
+            pipe.set(f'clause:{key}', json.dumps(annotation, separators=(',', ':')), ex=self.ttl)
+        pipe.execute()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the configured cache backend, or None when caching is off."""
+    global _cache
+    if _cache is None and CLAUSE_CACHE != 'off':
+        with _cache_lock:
+            if _cache is None:
+                import queues
+                _cache = RedisClauseCache(queues.get_redis_conn)
+    return _cache
+
+
+def lookup_many(keys):
+    """Cached annotations for ``keys``, None where missing."""
+    cache = get_cache()
+    if cache is None or not keys:
+        return [None] * len(keys)
+    try:
+        return cache.get_many(keys)
+    except Exception as e:
+        logger.warning(f"Clause cache lookup failed: {e}")
+        return [None] * len(keys)
+
+
+def store_many(entries):
+    cache = get_cache()
+    if cache is None or not entries:
+        return
+    try:
+        cache.put_many(entries)
+    except Exception as e:
+        logger.warning(f"Clause cache store failed: {e}")
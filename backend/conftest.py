@@ -0,0 +1,83 @@
+"""Shared test fixtures."""
+import pytest
+
+
+def _encode(value):
+    """Store values the way redis-py does without ``decode_responses``: as bytes."""
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class FakePipeline:
+    """Queues commands and runs them on ``execute``, returning their results in order."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    def __getattr__(self, name):
+        def op(*args, **kwargs):
+            self.ops.append((name, args, kwargs))
+            return self
+        return op
+
+    def execute(self):
+        ops, self.ops = self.ops, []
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in ops]
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands the backend uses (strings, hashes, sorted sets).
+
+    Expiry is accepted and ignored.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    # --- Strings ---
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = _encode(value)
+        return True
+
+    # --- Hashes ---
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({_encode(k): _encode(v) for k, v in mapping.items()})
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    # --- Sorted sets ---
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zrem(self, key, member):
+        return self.data.get(key, {}).pop(member, None) is not None
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.data.get(key, {})
+        for member in [m for m, score in zset.items() if low <= score <= high]:
+            del zset[member]
+
+
+@pytest.fixture
+def fake_redis():
+    return FakeRedis()
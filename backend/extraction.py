@@ -0,0 +1,128 @@
+"""PDF text extraction engine shared by the web app and the RQ worker.
+
+A document is opened once with PyMuPDF and each page is classified from its
+text layer and how much of it is covered by images:
+
+* ``text``    - a usable text layer; used as-is,
+* ``scanned`` - no usable text but images; OCR'd (see ocr.py),
+* ``mixed``   - a text layer plus large images, e.g. a typed lease with a
+  scanned addendum; OCR'd too, and the OCR text wins if it is clearly longer,
+* ``empty``   - nothing to read.
+
+Only pages that need OCR are rendered. ``iter_pages`` yields pages lazily, so
+callers can stop early and never hold more than one rendered page.
+"""
+import logging
+import os
+from dataclasses import dataclass
+
+import ocr
+from lazy_imports import lazy_module
+from ocr import OCR_AVAILABLE, OCRCancelled
+
+logger = logging.getLogger(__name__)
+
+fitz = lazy_module('fitz')
+
+# Fewer characters than this and a page's text layer is treated as missing
+TEXT_LAYER_MIN_CHARS = 20
+# Share of the page covered by images above which a text page counts as mixed
+MIXED_IMAGE_COVERAGE = 0.3
+# OCR text replaces a mixed page's text layer only if it is this much longer
+MIXED_OCR_GAIN = 1.2
+
+
+@dataclass
+class PageContent:
+    number: int  # 1-based
+    kind: str  # 'text', 'scanned', 'mixed' or 'empty'
+    text: str
+    width: float  # points
+    height: float
+    ocr_used: bool = False
+
+
+def classify_page(text_chars, image_coverage):
+    if text_chars < TEXT_LAYER_MIN_CHARS:
+        return 'scanned' if image_coverage > 0 else 'empty'
+    if image_coverage >= MIXED_IMAGE_COVERAGE:
+        return 'mixed'
+    return 'text'
+
+
+def _image_coverage(page):
+    page_area = abs(page.rect.width * page.rect.height)
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        x0, y0, x1, y1 = info['bbox']
+        covered += abs((x1 - x0) * (y1 - y0))
+    return min(1.0, covered / page_area)
+
+
+def _open(source):
+    """Open PDF bytes, or a file path such as an upload spool (no copy into memory)."""
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source, filetype='pdf')
+    return fitz.open(stream=source, filetype='pdf')
+
+
+def iter_pages(data, use_ocr=True, should_cancel=None, ocr_stats=None):
+    """Yield a ``PageContent`` per page of a PDF, opening the document once.
+
+    ``data`` is the PDF as bytes or a path to it.
+
+    ``should_cancel`` is checked before each OCR'd page; ``OCRCancelled`` is
+    raised if it returns True. Pass ``ocr_stats`` (``ocr.new_stats()``) to
+    collect OCR page and cache-hit counts.
+    """
+    doc = _open(data)
+    try:
+        ocr_budget = ocr.OCR_MAX_PAGES if use_ocr and OCR_AVAILABLE else 0
+        for page in doc:
+            layer_text = page.get_text()
+            kind = classify_page(len(layer_text.strip()), _image_coverage(page))
+            text, ocr_used = layer_text, False
+            if kind in ('scanned', 'mixed') and ocr_budget > 0:
+                if should_cancel is not None and should_cancel():
+                    raise OCRCancelled(f"Extraction cancelled before page {page.number + 1}")
+                ocr_budget -= 1
+                try:
+                    ocr_text = ocr.ocr_page(page, stats=ocr_stats)
+                except Exception as e:
+                    logger.info(f"OCR failed on page {page.number + 1}: {e}")
+                    ocr_text = ''
+                if kind == 'scanned' or len(ocr_text.strip()) > MIXED_OCR_GAIN * len(layer_text.strip()):
+                    text, ocr_used = ocr_text, True
+            yield PageContent(page.number + 1, kind, text, page.rect.width, page.rect.height, ocr_used)
+    finally:
+        doc.close()
+
+
+def extract_text(data, use_ocr=True, should_cancel=None, ocr_stats=None):
+    """Full text of a PDF (bytes or path), or None if it is unreadable or empty."""
+    if ocr_stats is None:
+        ocr_stats = ocr.new_stats()
+    try:
+        text = '\n'.join(page.text for page in iter_pages(data, use_ocr, should_cancel, ocr_stats))
+    except OCRCancelled:
+        raise
+    except Exception as e:
+        logger.info(f"PDF extraction error: {e}")
+        return None
+    if ocr_stats['pages']:
+        logger.info(f"OCR'd {ocr_stats['pages']} page(s), cache hit rate {ocr.hit_rate(ocr_stats)}")
+    if not text.strip():
+        logger.info("Warning: PDF appears to be empty or unreadable.")
+        return None
+    return text
+
+
+def render_page_png(data, page_number=1, dpi=150):
+    """Render one page of a PDF (bytes or path) to PNG bytes."""
+    doc = _open(data)
+    try:
+        return doc[page_number - 1].get_pixmap(dpi=dpi).tobytes('png')
+    finally:
+        doc.close()
@@ -0,0 +1,115 @@
+"""Lazily initialised Firebase Admin SDK clients.
+
+The SDK (and the Firestore gRPC stack behind it) is only imported and
+initialised when a request first needs it, instead of at import time.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before retrying after a failed initialisation
+INIT_RETRY_SECONDS = 30
+
+_lock = threading.Lock()
+_db = None
+_initialized = False
+_last_failure = 0.0
+
+
+def _initialize_app():
+    """Initialise the default Firebase app (handles local and deployed)."""
+    import firebase_admin
+    from firebase_admin import credentials
+
+    firebase_sdk_json_str = os.environ.get('FIREBASE_ADMIN_SDK_JSON_CONTENT')
+
+    if firebase_sdk_json_str:
+        # Deployed on Render (or env var set manually using JSON content)
+        logger.info("Using Firebase key from environment variable.")
+        firebase_sdk_config = json.loads(firebase_sdk_json_str)
+        cred = credentials.Certificate(firebase_sdk_config)
+        project_id = firebase_sdk_config.get('project_id')
+    else:
+        # Running Locally - Check for Render Secret File path OR local path
+        render_secret_path = '/etc/secrets/firebase_key.json'
+        local_key_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'lease-shield-ai-firebase-admin-sdk.json')
+
+        if os.path.exists(render_secret_path):
+            logger.info(f"Using Firebase key from Render secret file: {render_secret_path}")
+            cred = credentials.Certificate(render_secret_path)
+            # Attempt to get project_id from credential object
+            try:
+                project_id = cred.project_id
+            except Exception as cred_err:
+                logger.warning(f"Could not get project_id from credential object: {cred_err}")
+                try:
+                    with open(render_secret_path, 'r') as f:
+                        key_data = json.load(f)
+                    project_id = key_data.get('project_id')
+                except Exception as parse_err:
+                    logger.error(f"Error parsing secret file for project_id: {parse_err}")
+                    project_id = None
+        elif os.path.exists(local_key_path):
+            logger.info(f"Using Firebase key from local file: {local_key_path}")
+            cred = credentials.Certificate(local_key_path)
+            # Attempt to parse the file to get project_id
+            try:
+                with open(local_key_path, 'r') as f:
+                    key_data = json.load(f)
+                project_id = key_data.get('project_id')
+            except Exception as parse_err:
+                logger.error(f"Error parsing local key file for project_id: {parse_err}")
+                project_id = None
+        else:
+            raise FileNotFoundError(f"Firebase key file not found at {render_secret_path} or {local_key_path}")
+
+        if not project_id:
+            raise ValueError("Could not determine Firebase project ID from credentials.")
+
+    firebase_admin.initialize_app(cred, {
+        'storageBucket': f"{project_id}.appspot.com"
+    })
+    logger.info("Firebase Admin SDK initialized successfully.")
+
+
+def get_db():
+    """Return the Firestore client, initialising Firebase on first use.
+
+    Returns None if initialisation failed; it is retried at most every
+    INIT_RETRY_SECONDS so a broken config doesn't slow every request.
+    """
+    global _db, _initialized, _last_failure
+    if _db is not None:
+        return _db
+    with _lock:
+        if _db is not None:
+            return _db
+        if _last_failure and time.monotonic() - _last_failure < INIT_RETRY_SECONDS:
+            return None
+        try:
+            if not _initialized:
+                _initialize_app()
+                _initialized = True
+            from firebase_admin import firestore
+            _db = firestore.client()
+        except FileNotFoundError as e:
+            logger.critical(f"Firebase Admin SDK JSON key file not found. {e}")
+        except ValueError as e:
+            logger.critical(f"Invalid Firebase Admin SDK JSON content or missing project_id. {e}")
+        except Exception as e:
+            logger.critical(f"Failed to initialize Firebase Admin SDK: {e}")
+        if _db is None:
+            _last_failure = time.monotonic()
+        return _db
+
+
+def get_bucket():
+    """Return the default Storage bucket (initialises Firebase if needed)."""
+    get_db()
+    from firebase_admin import storage
+    return storage.bucket()
@@ -0,0 +1,38 @@
+"""Gunicorn settings for the backend.
+
+SERVING_MODE selects how workers handle concurrency:
+  sync  - one request per worker process (the original deployment)
+  async - gevent workers; Gemini, Firestore, Storage and Redis I/O yield to
+          other requests instead of blocking, so a single process can hold
+          thousands of in-flight LLM-bound requests and open SSE streams.
+
+Load-test numbers for both modes are in docs/adr/0002-async-serving-mode.md.
+"""
+import multiprocessing
+import os
+
+SERVING_MODE = os.environ.get('SERVING_MODE', 'sync').lower()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+if SERVING_MODE == 'async':
+    worker_class = 'gevent'
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 2000))
+else:
+    worker_class = 'sync'
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+
+def post_fork(server, worker):
+    if SERVING_MODE != 'async':
+        return
+    # gRPC (Gemini and Firestore clients) does not cooperate with gevent's
+    # monkey-patching unless told to; without this a call blocks the whole hub.
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+    server.log.info(f"Worker {worker.pid}: gRPC configured for gevent")
@@ -0,0 +1,89 @@
+"""Compressed storage for finished analysis job results.
+
+Results are stored once, compressed (zstd when the ``zstandard`` package is
+installed, gzip otherwise), in a Redis hash next to a strong ETag. The web
+process can hand the compressed bytes straight to clients that accept the
+encoding, and a copy is persisted to Firestore so Redis only needs to hold
+results for a short while.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('JOB_RESULT_CACHE_TTL_SECONDS', 3600))
+JOB_RESULTS_COLLECTION = 'job_results'
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _key(job_id):
+    return f'job-result:{job_id}'
+
+
+def compress(result):
+    """Serialise and compress a result dict. Returns ``(body, encoding)``."""
+    raw = json.dumps(result, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(raw), 'zstd'
+    return gzip.compress(raw, compresslevel=6, mtime=0), 'gzip'
+
+
+def decompress(body):
+    if body[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError('zstd-compressed result but zstandard is not installed')
+        return json.loads(zstandard.ZstdDecompressor().decompress(body))
+    return json.loads(gzip.decompress(body))
+
+
+def etag_for(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def store(redis_conn, job_id, result, ttl=RESULT_CACHE_TTL_SECONDS, user_id=None, status=None):
+    """Cache a finished result in Redis, with the user it belongs to; returns the stored entry.
+
+    ``status`` is the HTTP status to serve it with when the job ended without
+    an analysis (e.g. 429 for a quota error); successful results leave it unset.
+    """
+    body, encoding = compress(result)
+    entry = {'body': body, 'encoding': encoding, 'etag': etag_for(body)}
+    if user_id:
+        entry['userId'] = user_id
+    if status:
+        entry['status'] = status
+    pipe = redis_conn.pipeline()
+    pipe.hset(_key(job_id), mapping=entry)
+    pipe.expire(_key(job_id), ttl)
+    pipe.execute()
+    return entry
+
+
+def load(redis_conn, job_id):
+    """Return ``{'body', 'encoding', 'etag', 'userId', 'status'}`` for a cached result, or None."""
+    raw = redis_conn.hgetall(_key(job_id))
+    if not raw:
+        return None
+    entry = {(k.decode('utf-8') if isinstance(k, bytes) else k): v for k, v in raw.items()}
+    for field in ('encoding', 'etag', 'userId'):
+        if isinstance(entry.get(field), bytes):
+            entry[field] = entry[field].decode('utf-8')
+    if 'status' in entry:
+        entry['status'] = int(entry['status'])
+    return entry
+
+
+def persist(writer, job_id, user_id, result):
+    """Write a final result to Firestore under the job's ID."""
+    from firebase_admin import firestore
+    return writer(JOB_RESULTS_COLLECTION, {
+        'userId': user_id,
+        'result': result,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+    }, doc_id=job_id)
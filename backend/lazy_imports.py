@@ -0,0 +1,52 @@
+"""Deferred imports for heavy optional dependencies.
+
+``lazy_module('google.generativeai')`` returns a stand-in module object that
+performs the real import the first time one of its attributes is used, so
+importing ``app`` stays cheap and cold starts pass health checks quickly.
+"""
+import importlib
+import importlib.util
+import threading
+import types
+
+_import_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports ``name`` on first attribute access."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_target'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_target']
+        if module is None:
+            with _import_lock:
+                module = self.__dict__['_lazy_target']
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__['_lazy_target'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_target'] is not None else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_module(name):
+    return LazyModule(name)
+
+
+def is_available(name):
+    """Check whether a module can be imported without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
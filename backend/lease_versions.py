@@ -0,0 +1,175 @@
+"""Detect an upload as a new version of one of the user's leases and summarise what changed.
+
+During a negotiation the same lease is uploaded again and again with a few
+clauses amended. Every saved lease keeps ``clauseKeys``: the clause_cache
+hash of each of its clauses, in order (section numbers don't count, so an
+inserted clause doesn't change the keys of the ones after it).
+
+Candidates are the lease the client names as ``previousLeaseId``, or else at
+most ``LEASE_VERSION_MAX_CANDIDATES`` of the user's leases with the same file
+name or the same property address; leases merely built from the same
+template are not linked. Their clause keys are compared with the upload's
+(Jaccard similarity of the key sets, read with a field-masked query). The best
+candidate reaching ``LEASE_VERSION_MIN_SIMILARITY`` (a named lease always
+qualifies) is treated as the previous version. The key sequences are then
+diffed into added, removed and modified clauses, and the annotations of both
+sides are looked up in the clause cache to describe the changes.
+
+Only the changed clauses cost Gemini time: unchanged ones are clause cache
+hits in clause_analysis. The lease text itself is not stored, so the diff
+works on clause hashes rather than on the previous text.
+"""
+import difflib
+import logging
+import os
+
+import chunking
+import clause_cache
+
+logger = logging.getLogger(__name__)
+
+LEASE_VERSION_MIN_SIMILARITY = float(os.environ.get('LEASE_VERSION_MIN_SIMILARITY', 0.5))
+LEASE_VERSION_MAX_CANDIDATES = int(os.environ.get('LEASE_VERSION_MAX_CANDIDATES', 10))
+NOT_FOUND = 'Not Found'
+# Names the app gives uploads without a file name; they say nothing about which lease it is
+GENERIC_FILE_NAMES = ('Uploaded File', 'Pasted Text')
+CANDIDATE_FIELDS = ['userId', 'clauseKeys', 'fileName', 'versionNumber', 'analysis.score']
+CHANGE_EXCERPT_CHARS = 300
+
+
+def clause_keys(text):
+    """Cache keys of ``text``'s clauses, in document order."""
+    return [clause_cache.cache_key(clause) for clause in chunking.split_clauses(text)]
+
+
+def similarity(keys, other_keys):
+    """Jaccard similarity of two leases' clause key sets."""
+    keys, other_keys = set(keys), set(other_keys)
+    if not keys and not other_keys:
+        return 0.0
+    return len(keys & other_keys) / len(keys | other_keys)
+
+
+def address_key(address):
+    """Comparable form of an extracted property address, or None if there isn't one."""
+    if not address or address == NOT_FOUND:
+        return None
+    return ' '.join(str(address).lower().replace(',', ' ').split())
+
+
+def _candidates(db, user_id, file_name, address):
+    leases = db.collection('leases')
+    seen = set()
+    for field, value in (('fileName', file_name), ('propertyAddressKey', address_key(address))):
+        if not value or value in GENERIC_FILE_NAMES:
+            continue
+        query = leases.where('userId', '==', user_id).where(field, '==', value)
+        for doc in query.select(CANDIDATE_FIELDS).limit(LEASE_VERSION_MAX_CANDIDATES).stream():
+            if doc.id not in seen:
+                seen.add(doc.id)
+                yield doc.id, doc.to_dict() or {}
+
+
+def find_previous_version(db, user_id, keys, file_name=None, address=None, previous_lease_id=None):
+    """The lease ``keys`` revises, as ``(doc id, data, similarity)``, or None."""
+    if not keys:
+        return None
+    if previous_lease_id:
+        doc = db.collection('leases').document(previous_lease_id).get()
+        data = (doc.to_dict() or {}) if doc.exists else {}
+        if data.get('userId') != user_id:
+            return None
+        return previous_lease_id, data, similarity(keys, data.get('clauseKeys') or [])
+
+    best = None
+    for doc_id, data in _candidates(db, user_id, file_name, address):
+        score = similarity(keys, data.get('clauseKeys') or [])
+        if score >= LEASE_VERSION_MIN_SIMILARITY and (best is None or score > best[2]):
+            best = (doc_id, data, score)
+    return best
+
+
+def diff_clauses(old_keys, new_keys):
+    """``[(change, old index, new index)]`` with change 'modified', 'added' or 'removed'."""
+    changes = []
+    matcher = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        old, new = list(range(i1, i2)), list(range(j1, j2))
+        # A replaced run pairs clauses up in order; the surplus on either side was added or removed
+        for i, j in zip(old, new):
+            changes.append(('modified', i, j))
+        changes.extend(('removed', i, None) for i in old[len(new):])
+        changes.extend(('added', None, j) for j in new[len(old):])
+    return changes
+
+
+def _excerpt(text):
+    text = ' '.join(text.split())
+    return text if len(text) <= CHANGE_EXCERPT_CHARS else text[:CHANGE_EXCERPT_CHARS - 3] + '...'
+
+
+def describe_changes(old_keys, new_keys, clauses):
+    """Change entries for the diff; ``clauses`` are the new version's clause texts."""
+    changes = diff_clauses(old_keys, new_keys)
+    wanted = [old_keys[i] for _, i, _ in changes if i is not None] + \
+             [new_keys[j] for _, _, j in changes if j is not None]
+    annotations = dict(zip(wanted, clause_cache.lookup_many(wanted)))
+
+    entries = []
+    for change, i, j in changes:
+        before = annotations.get(old_keys[i]) if i is not None else None
+        after = annotations.get(new_keys[j]) if j is not None else None
+        before_risks = {risk['text'] for risk in (before or {}).get('risks', [])}
+        after_risks = {risk['text'] for risk in (after or {}).get('risks', [])}
+        entries.append({
+            'change': change,
+            'clause': j + 1 if j is not None else None,
+            'category': (after or before or {}).get('category'),
+            'before': (before or {}).get('summary'),
+            'after': (after or {}).get('summary'),
+            'excerpt': _excerpt(clauses[j]) if j is not None else None,
+            'risksAdded': sorted(after_risks - before_risks),
+            'risksRemoved': sorted(before_risks - after_risks),
+        })
+    return entries
+
+
+def summarize(entries, previous_score, score):
+    counts = {change: sum(1 for entry in entries if entry['change'] == change)
+              for change in ('modified', 'added', 'removed')}
+    if not entries:
+        text = 'No clause changes from the previous version.'
+    else:
+        text = (f"{counts['modified']} clause(s) modified, {counts['added']} added, "
+                f"{counts['removed']} removed since the previous version.")
+    if isinstance(previous_score, int) and isinstance(score, int) and previous_score != score:
+        text += f" Score {previous_score} -> {score}."
+    return text
+
+
+def attach_version(db, user_id, text, result_data, file_name=None, previous_lease_id=None):
+    """Record on ``result_data`` which lease this upload revises and what changed, if any."""
+    clauses = chunking.split_clauses(text)
+    keys = [clause_cache.cache_key(clause) for clause in clauses]
+    address = (result_data.get('extracted_data') or {}).get('Property_Address')
+    match = find_previous_version(db, user_id, keys, file_name=file_name, address=address,
+                                  previous_lease_id=previous_lease_id)
+    if match is None:
+        return None
+    previous_id, previous, score = match
+    entries = describe_changes(previous.get('clauseKeys') or [], keys, clauses)
+    previous_score = (previous.get('analysis') or {}).get('score')
+    version = {
+        'previousVersionId': previous_id,
+        'previousFileName': previous.get('fileName'),
+        'number': (previous.get('versionNumber') or 1) + 1,
+        'similarity': round(score, 3),
+        'changes': entries,
+        'summary': summarize(entries, previous_score, result_data.get('score')),
+    }
+    result_data['version'] = version
+    logger.info(f"Lease for {user_id} is version {version['number']} of {previous_id} "
+                f"(similarity {score:.2f}, {len(entries)} clause changes)")
+    return version
@@ -0,0 +1,362 @@
+"""Gemini client management and the lease analysis prompts.
+
+Shared by the web app and the RQ worker so both run the same LLM stages.
+"""
+import logging
+import os
+import threading
+import time
+
+import llm_executor
+import llm_guard
+import model_router
+import response_parsing
+from lazy_imports import lazy_module
+
+logger = logging.getLogger(__name__)
+
+genai = lazy_module('google.generativeai')
+glm = lazy_module('google.ai.generativelanguage')
+client_options = lazy_module('google.api_core.client_options')
+
+# --- Load Gemini API Keys --- 
+# Load all potential keys, filtering out any that aren't set
+gemini_api_keys = [
+    key for key in [
+        os.environ.get('GEMINI_API_KEY_1'),
+        os.environ.get('GEMINI_API_KEY_2'),
+        os.environ.get('GEMINI_API_KEY_3'),
+        # Keep the original name as a fallback for backward compatibility or single-key use
+        os.environ.get('GEMINI_API_KEY')
+    ] if key
+]
+
+# --- Reusable Gemini Model Initialization ---
+# Models are cached per key and configuration. Each one is bound to its own
+# key's client: genai.configure() sets a single process-wide key, which the
+# models would otherwise all pick up on their first request.
+gemini_models = {}
+gemini_clients = {}
+current_key_index = 0
+_models_lock = threading.Lock()
+
+DEFAULT_MODEL = "gemini-2.5-flash-preview-05-20"
+
+def _client_for_key(key_index):
+    if key_index not in gemini_clients:
+        gemini_clients[key_index] = glm.GenerativeServiceClient(
+            client_options=client_options.ClientOptions(api_key=gemini_api_keys[key_index]))
+    return gemini_clients[key_index]
+
+def model_for_key(key_index, model_name=DEFAULT_MODEL, temperature=None, json_mode=False):
+    """Return the cached model for one key.
+
+    ``json_mode`` sets ``response_mime_type`` to application/json so the model
+    emits bare JSON (Gemini's structured-output mode).
+    """
+    if not gemini_api_keys:
+        raise ValueError("No Gemini API keys configured.")
+    key_index %= len(gemini_api_keys)
+
+    # Model unique ID includes temperature if specified, to cache different configurations
+    temp_suffix = f"_t{temperature}" if temperature is not None else ""
+    json_suffix = "_json" if json_mode else ""
+    model_key_id = f"{model_name}_{key_index}{temp_suffix}{json_suffix}"
+
+    with _models_lock:
+        if model_key_id not in gemini_models:
+            logger.info(f"Initializing Gemini model {model_name} with key index {key_index} and temperature {temperature or 'default'}")
+            generation_config = {}
+            if temperature is not None:
+                generation_config['temperature'] = temperature
+            if json_mode:
+                generation_config['response_mime_type'] = 'application/json'
+
+            safety_settings = [
+                # Your safety settings here...
+            ]
+
+            model = genai.GenerativeModel(
+                model_name,
+                safety_settings=safety_settings,
+                generation_config=genai.types.GenerationConfig(**generation_config) if generation_config else None
+            )
+            # Private SDK attribute: the pinned google-generativeai has no public per-model client
+            # option (test_llm.py checks it is still used)
+            model._client = _client_for_key(key_index)
+            gemini_models[model_key_id] = model
+
+    return gemini_models[model_key_id]
+
+def next_key_index():
+    global current_key_index
+    with _models_lock:
+        key_index = current_key_index
+        current_key_index = (current_key_index + 1) % max(1, len(gemini_api_keys))
+    return key_index
+
+def generate(contents, model_name=DEFAULT_MODEL, temperature=None, json_mode=False, key_index=None):
+    """``generate_content`` bounded by the current deadline, hedged and retried across keys.
+
+    Starts on ``key_index`` (default: the next key in rotation); see
+    llm_executor.py. Raises ``llm_guard.Overloaded`` when the call isn't
+    admitted or every key's circuit is open.
+    """
+    if not gemini_api_keys:
+        raise ValueError("No Gemini API keys configured.")
+    first = next_key_index() if key_index is None else key_index
+    key_count = len(gemini_api_keys)
+
+    def call(slot, timeout):
+        # Keys whose circuit is open are skipped (see llm_guard.py)
+        index = llm_guard.pick_key(model_name, first + slot, key_count)
+        breaker = llm_guard.breaker(model_name, index)
+        try:
+            response = model_for_key(index, model_name, temperature, json_mode).generate_content(
+                contents, request_options={'timeout': timeout})
+        except Exception as e:
+            # Only upstream trouble counts against the key; a rejected request means it answered
+            if llm_executor.is_retryable(e, key_count):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return response
+
+    with llm_guard.admit(model_name):
+        return llm_executor.execute(call, name=model_name, key_count=key_count)
+
+# Analyze lease with Gemini
+def warm_up():
+    """Build the models ``analyze_lease`` and ``analyze_clauses`` use for every key, ahead of the first job.
+
+    Call after forking: the gRPC channels behind the clients must not be shared
+    between processes.
+    """
+    models = set(model_router.models_for('lease_analysis')) | set(model_router.models_for('clause_analysis'))
+    for model_name in sorted(models):
+        for temperature in (0.2, 0.1):
+            for key_index in range(len(gemini_api_keys)):
+                model_for_key(key_index, model_name, temperature, json_mode=True)
+
+def _generate_lease_json(model_name, prompt):
+    """Pass 1 on ``model_name``, plus a JSON-fixing pass 2 only if local repair fails."""
+    # Pass 1 (lower temperature for precision)
+    resp1 = generate(prompt, model_name=model_name, temperature=0.2, json_mode=True)
+    cleaned1 = (resp1.text or '').strip()
+
+    # Repair locally first; only unrepairable output costs a second call
+    try:
+        response_parsing.parse_json_response(cleaned1)
+        return cleaned1
+    except response_parsing.ResponseParseError:
+        logger.info("Lease analysis JSON not repairable locally; asking the model to fix it")
+
+    # Pass 2 (Refinement) - ask model to strictly fix JSON
+    refine_prompt = f"""
+    The following was intended to be a single strict JSON object response but may contain formatting issues or extra commentary.
+    Return ONLY a corrected JSON object that strictly adheres to the schema described earlier.
+    If any fields are missing, include them with the value "Not Found" where appropriate.
+    Response to correct:
+    ---
+    {cleaned1}
+    ---
+    """
+    resp2 = generate(refine_prompt, model_name=model_name, temperature=0.1, json_mode=True)
+    return (resp2.text or '').strip()
+
+def _routed_lease_call(decision, model_name, prompt, escalated_from=None, note=None):
+    started = time.monotonic()
+    try:
+        result = _generate_lease_json(model_name, prompt)
+    except llm_guard.Overloaded:
+        raise
+    except Exception as e:
+        model_router.record_outcome(decision, time.monotonic() - started, ok=False, model=model_name,
+                                    escalated_from=escalated_from, note=note)
+        logger.info(f"analyze_lease error on {model_name}: {e}")
+        return None
+    model_router.record_outcome(decision, time.monotonic() - started, ok=bool(result), model=model_name,
+                                escalated_from=escalated_from, note=note)
+    return result
+
+def _lease_confidence(result, partial):
+    try:
+        data = response_parsing.parse_lease_analysis(result) if result else None
+    except response_parsing.ResponseParseError:
+        data = None
+    return model_router.confidence(data, partial=partial)
+
+def analyze_lease(text, part=None, tier=None):
+    """Analyze lease text with the routed model and a JSON correction step.
+
+    The model comes from ``model_router`` (``lease_analysis`` task); when the
+    route has a fallback and the output's confidence is too low, the lease is
+    re-analysed on the fallback model. ``part`` is ``(index, count)`` when
+    ``text`` is one chunk of a longer lease (see chunking.py).
+    """
+    part_note = ""
+    if part:
+        part_note = (f"This is part {part[0]} of {part[1]} of a longer lease. Report only what appears "
+                     f"in this part and use \"Not Found\" for anything that does not. ")
+    base_prompt = f"""
+    Analyze the following lease document. {part_note}Extract the specified information and format the output ONLY as a single JSON object. 
+    Do not include any text before or after the JSON object (no markdown fences).
+    The JSON object must have these top-level keys: 'extracted_data', 'clause_summaries', 'risks', and 'score'.
+
+    1. extracted_data: An object with these exact keys. If a value cannot be found, use the string "Not Found".
+       - Landlord_Name
+       - Tenant_Name
+       - Property_Address
+       - Lease_Start_Date
+       - Lease_End_Date
+       - Monthly_Rent_Amount
+       - Rent_Due_Date
+       - Security_Deposit_Amount
+       - Lease_Term
+
+    2. clause_summaries: Summarize these clauses using the exact key names (omit if not present or use "Not Found").
+       - Termination_Clause
+       - Pet_Policy
+       - Subletting_Policy
+       - Maintenance_Responsibilities
+       - Late_Fee_Policy
+       - Renewal_Options
+
+    3. risks: Array of strings describing unusual or unfavorable clauses. Return [] if none.
+
+    4. score: Integer from 0 (unfavorable) to 100 (favorable), based on number and severity of risks.
+
+    Lease Document Text:
+    --- START ---
+    {text}
+    --- END ---
+
+    Output ONLY the JSON.
+    """
+
+    decision = model_router.choose('lease_analysis', chars=len(text), tier=tier,
+                                   quality=model_router.text_quality(text))
+    result = _routed_lease_call(decision, decision.model, base_prompt)
+    if decision.fallback and decision.fallback != decision.model:
+        confidence = _lease_confidence(result, partial=bool(part))
+        if confidence < decision.min_confidence:
+            escalated = _routed_lease_call(decision, decision.fallback, base_prompt,
+                                           escalated_from=decision.model, note=f"confidence {confidence}")
+            result = escalated or result
+    return result
+
+def analyze_clauses(clauses, tier=None):
+    """Annotate numbered lease clauses in one call; ``clauses`` is ``[(number, text), ...]``.
+
+    Returns the raw JSON text (``{"clauses": [...]}``), or None on failure.
+    See clause_analysis.py.
+    """
+    numbered = "\n\n".join(f"Clause {number}:\n---\n{text.strip()}\n---" for number, text in clauses)
+    prompt = f"""
+    You are analysing numbered clauses taken from a residential or commercial lease.
+    For EACH clause return one object with these keys:
+    - id: the clause number given below
+    - category: one of Termination_Clause, Pet_Policy, Subletting_Policy, Maintenance_Responsibilities,
+      Late_Fee_Policy, Renewal_Options, or Other
+    - summary: one or two plain-English sentences
+    - risks: array of objects {{"text": ..., "severity": "low" | "medium" | "high"}} for terms that are unusual
+      or unfavorable to the tenant; [] if none
+    - facts: object with any of these keys whose value is stated in this clause (omit the others):
+      Landlord_Name, Tenant_Name, Property_Address, Lease_Start_Date, Lease_End_Date,
+      Monthly_Rent_Amount, Rent_Due_Date, Security_Deposit_Amount, Lease_Term
+    Judge each clause on its own text only.
+
+    {numbered}
+
+    Output ONLY a JSON object of the form {{"clauses": [...]}}.
+    """
+    decision = model_router.choose('clause_analysis', chars=len(numbered), tier=tier)
+    started = time.monotonic()
+    try:
+        response = generate(prompt, model_name=decision.model, temperature=0.2, json_mode=True)
+        result = (response.text or '').strip()
+    except llm_guard.Overloaded:
+        raise
+    except Exception as e:
+        model_router.record_outcome(decision, time.monotonic() - started, ok=False)
+        logger.info(f"analyze_clauses error on {decision.model}: {e}")
+        return None
+    model_router.record_outcome(decision, time.monotonic() - started, ok=bool(result))
+    return result
+
+def score_risks(risks, tier=None):
+    """Score a lease from its clause risks on the same 0-100 scale ``analyze_lease`` uses.
+
+    ``risks`` is ``[{'text', 'severity'}, ...]``. Returns the score, or None on failure.
+    See clause_analysis.py.
+    """
+    listed = "\n".join(f"- [{risk['severity']}] {risk['text']}" for risk in risks)
+    prompt = f"""
+    These are the unusual or unfavorable terms found in a lease, with their severity:
+    {listed}
+
+    Rate the lease as a whole for the tenant.
+    score: Integer from 0 (unfavorable) to 100 (favorable), based on number and severity of risks.
+
+    Output ONLY a JSON object of the form {{"score": ...}}.
+    """
+    decision = model_router.choose('clause_analysis', chars=len(listed), tier=tier)
+    started = time.monotonic()
+    try:
+        response = generate(prompt, model_name=decision.model, temperature=0.1, json_mode=True)
+        score = int(response_parsing.parse_json_response(response.text or '')['score'])
+    except llm_guard.Overloaded:
+        raise
+    except Exception as e:
+        model_router.record_outcome(decision, time.monotonic() - started, ok=False)
+        logger.info(f"score_risks error on {decision.model}: {e}")
+        return None
+    model_router.record_outcome(decision, time.monotonic() - started, ok=True)
+    return max(0, min(100, score))
+
+def analyze_compliance(new_lease_text, master_template_text):
+    """
+    Compares a new lease against a master template using Gemini AI.
+    Returns a JSON object with a summary of deviations.
+    """
+    prompt = f"""
+    You are a compliance analysis bot. Compare the 'New Lease Document' against the 'Master Template'.
+    Your goal is to identify differences, deviations, and any clauses present in the new lease that are NOT in the master template.
+
+    Master Template Text:
+    --- START ---
+    {master_template_text}
+    --- END ---
+
+    New Lease Document Text:
+    --- START ---
+    {new_lease_text}
+    --- END ---
+
+    Analyze the documents and provide a report ONLY in a single JSON object format.
+    The JSON object must have one top-level key: 'compliance_report'.
+    The value of 'compliance_report' should be an object with three keys:
+    1.  `summary`: A brief, one-sentence summary of the overall compliance (e.g., "The document largely conforms to the master template with minor deviations.").
+    2.  `deviations`: An array of objects, where each object describes a specific deviation. Each object should have two keys: `clause_title` (e.g., "Termination Clause") and `description` (e.g., "The notice period was changed from 30 days in the template to 60 days.").
+    3.  `missing_clauses`: An array of strings, where each string is the title of a clause present in the Master Template but missing from the New Lease Document.
+
+    If no deviations or missing clauses are found, return empty arrays for those keys.
+    Do not include any text before or after the JSON object.
+    """
+    decision = model_router.choose('compliance', chars=len(new_lease_text) + len(master_template_text))
+    started = time.monotonic()
+    try:
+        response = generate(prompt, model_name=decision.model, json_mode=True) # Routed model, key rotation
+        report = response_parsing.parse_json_response(response.text)
+        model_router.record_outcome(decision, time.monotonic() - started, ok=True)
+        return report
+    except Exception as e:
+        model_router.record_outcome(decision, time.monotonic() - started, ok=False)
+        logger.info(f"Error during compliance analysis: {e}")
+        return {"compliance_report": {
+            "summary": "Failed to generate compliance report due to an internal error.",
+            "deviations": [],
+            "missing_clauses": []
+        }}
@@ -0,0 +1,285 @@
+"""Deadline-bounded, hedged execution of Gemini requests.
+
+Every call runs under a deadline taken from the enclosing ``budget(seconds)``
+block (the endpoint's or job's time budget; ``LLM_DEFAULT_BUDGET_SECONDS``
+outside one) and passes the time left as the request timeout, so a slow
+upstream can't hold a worker past its budget.
+
+A call that hasn't answered by its model's recent ``LLM_HEDGE_PERCENTILE``
+latency is hedged: the same request is sent on the next API key and the first
+answer wins. The loser's result is discarded; its thread ends when the request
+returns or hits its timeout (a blocking gRPC call can't be interrupted). Until
+then it still counts against the call's admission slot (llm_guard.retain).
+Hedges run on their own ``LLM_HEDGE_THREADS`` threads and are skipped while
+those are all busy, so they can't crowd out first requests.
+Retryable errors (429, 5xx, timeouts, a rejected key when there are others)
+are retried on the next key after a jittered exponential backoff that must fit
+in the deadline.
+
+``metrics()`` reports per-model latency percentiles, the hedge rate, hedge
+wins and the latency hedging saved, for this process.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+import llm_guard
+
+logger = logging.getLogger(__name__)
+
+LLM_DEFAULT_BUDGET_SECONDS = float(os.environ.get('LLM_DEFAULT_BUDGET_SECONDS', 120))
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'true').lower() == 'true'
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20))
+# Hedge delay until a model has LLM_HEDGE_MIN_SAMPLES latencies
+LLM_HEDGE_AFTER_SECONDS = float(os.environ.get('LLM_HEDGE_AFTER_SECONDS', 30))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_MIN_DELAY_SECONDS', 2))
+LLM_MAX_ATTEMPTS = int(os.environ.get('LLM_MAX_ATTEMPTS', 3))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', 1))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get('LLM_RETRY_MAX_SECONDS', 10))
+# Twice the admitted calls (llm_guard): a request that lost to its hedge keeps its thread until it returns
+LLM_EXECUTOR_THREADS = int(os.environ.get('LLM_EXECUTOR_THREADS', 2 * llm_guard.LLM_MAX_INFLIGHT_PER_PROCESS))
+LLM_HEDGE_THREADS = int(os.environ.get('LLM_HEDGE_THREADS', 16 if llm_guard.ASYNC_SERVING else 4))
+
+LATENCY_WINDOW = 200
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(Exception):
+    """The call's budget ran out before any request answered."""
+
+
+# --- Deadlines ---
+
+_deadline = contextvars.ContextVar('llm_deadline', default=None)
+
+
+@contextlib.contextmanager
+def budget(seconds):
+    """Bound every LLM call in the block to ``seconds`` from now; nested budgets only shrink."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+# --- Metrics ---
+
+class _ModelMetrics:
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.latency_saved = 0.0
+        self.retries = 0
+        self.deadline_exceeded = 0
+        self.errors = 0
+
+
+_metrics = collections.defaultdict(_ModelMetrics)
+_metrics_lock = threading.Lock()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def hedge_delay(name):
+    """How long to wait on the first request before hedging it."""
+    with _metrics_lock:
+        latencies = list(_metrics[name].latencies)
+    if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_AFTER_SECONDS
+    return max(LLM_HEDGE_MIN_DELAY_SECONDS, percentile(latencies, LLM_HEDGE_PERCENTILE))
+
+
+def _count(name, field, amount=1):
+    with _metrics_lock:
+        m = _metrics[name]
+        setattr(m, field, getattr(m, field) + amount)
+
+
+def _record_latency(name, seconds):
+    with _metrics_lock:
+        _metrics[name].latencies.append(seconds)
+
+
+def metrics():
+    with _metrics_lock:
+        report = {}
+        for name, m in _metrics.items():
+            latencies = list(m.latencies)
+            report[name] = {
+                'calls': m.calls,
+                'p50Seconds': percentile(latencies, 0.5),
+                'p95Seconds': percentile(latencies, 0.95),
+                'p99Seconds': percentile(latencies, 0.99),
+                'hedged': m.hedged,
+                'hedgeRate': round(m.hedged / m.calls, 3) if m.calls else None,
+                'hedgeWins': m.hedge_wins,
+                'latencySavedSeconds': round(m.latency_saved, 3),
+                'retries': m.retries,
+                'deadlineExceeded': m.deadline_exceeded,
+                'errors': m.errors,
+            }
+        return report
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+# --- Execution ---
+
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_EXECUTOR_THREADS,
+                                              thread_name_prefix='llm')
+_hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_HEDGE_THREADS,
+                                                    thread_name_prefix='llm-hedge')
+_hedge_slots = threading.BoundedSemaphore(LLM_HEDGE_THREADS)
+
+
+def is_retryable(error, key_count=1):
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    if code in RETRYABLE_STATUS:
+        return True
+    # A rejected key is worth retrying on another one
+    return key_count > 1 and code in (400, 401, 403) and 'api key' in str(error).lower()
+
+
+def retry_delay(attempt):
+    """Full-jitter exponential backoff for the ``attempt``-th retry (0-based)."""
+    return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+def _timed(call, slot, timeout):
+    started = time.monotonic()
+    result = call(slot, timeout)
+    return result, time.monotonic() - started
+
+
+def _submit(call, slot, deadline, pool=None, on_done=None):
+    release = llm_guard.retain()
+
+    def done(future):
+        release()
+        if on_done:
+            on_done()
+
+    future = (pool or _pool).submit(contextvars.copy_context().run, _timed, call, slot,
+                                    max(0.001, deadline - time.monotonic()))
+    future.add_done_callback(done)
+    return future
+
+
+def _record_saved(name, winner_finished):
+    """Done-callback for a hedge's losing request: credit the time the hedge saved."""
+    def callback(future):
+        if not future.cancelled() and future.exception() is None:
+            _count(name, 'latency_saved', max(0.0, time.monotonic() - winner_finished))
+    return callback
+
+
+def _hedged(call, name, key_count, slots, deadline):
+    primary = _submit(call, next(slots), deadline)
+    remaining = deadline - time.monotonic()
+    delay = hedge_delay(name)
+    can_hedge = LLM_HEDGE_ENABLED and key_count > 1 and delay < remaining
+    done, _ = concurrent.futures.wait([primary], timeout=delay if can_hedge else remaining)
+    if primary in done:
+        result, latency = primary.result()
+        _record_latency(name, latency)
+        return result
+    # No hedge when every hedge thread is taken: wait on the first request instead
+    if can_hedge and not _hedge_slots.acquire(blocking=False):
+        can_hedge = False
+        done, _ = concurrent.futures.wait([primary], timeout=max(0.0, deadline - time.monotonic()))
+        if primary in done:
+            result, latency = primary.result()
+            _record_latency(name, latency)
+            return result
+    if not can_hedge:
+        primary.cancel()
+        raise DeadlineExceeded(f"{name} did not answer within the deadline")
+
+    hedge = _submit(call, next(slots), deadline, pool=_hedge_pool, on_done=_hedge_slots.release)
+    _count(name, 'hedged')
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                                return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            result, latency = future.result()
+            _record_latency(name, latency)
+            for loser in pending:
+                loser.cancel()
+                if future is hedge:
+                    loser.add_done_callback(_record_saved(name, time.monotonic()))
+            if future is hedge:
+                _count(name, 'hedge_wins')
+            return result
+    if error is not None:
+        raise error
+    for future in pending:
+        future.cancel()
+    raise DeadlineExceeded(f"{name} did not answer within the deadline")
+
+
+def execute(call, name, key_count=1):
+    """Run ``call(slot, timeout)`` under the current deadline, hedging and retrying it.
+
+    ``slot`` counts the requests made for this call (0 for the first); callers
+    use it to pick the API key, so hedges and retries go to a different key
+    than the request they back up. ``timeout`` is the seconds left.
+    """
+    deadline = current_deadline() or time.monotonic() + LLM_DEFAULT_BUDGET_SECONDS
+    slots = itertools.count()
+    _count(name, 'calls')
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        if time.monotonic() >= deadline:
+            _count(name, 'deadline_exceeded')
+            raise DeadlineExceeded(f"No time left for {name}")
+        try:
+            return _hedged(call, name, key_count, slots, deadline)
+        except DeadlineExceeded:
+            _count(name, 'deadline_exceeded')
+            raise
+        except Exception as e:
+            delay = retry_delay(attempt)
+            last_attempt = attempt == LLM_MAX_ATTEMPTS - 1
+            if last_attempt or not is_retryable(e, key_count) or time.monotonic() + delay >= deadline:
+                _count(name, 'errors')
+                raise
+            logger.info(f"Retrying {name} in {delay:.2f}s after {type(e).__name__}: {e}")
+            _count(name, 'retries')
+            time.sleep(delay)
@@ -0,0 +1,325 @@
+"""Circuit breakers and admission control in front of Gemini.
+
+* A ``CircuitBreaker`` per (model, key) opens after
+  ``LLM_BREAKER_FAILURES`` consecutive upstream failures (429, 5xx, timeouts),
+  sending no requests on that key for ``LLM_BREAKER_COOLDOWN_SECONDS``; then a
+  single probe decides whether it closes again. ``llm.generate`` skips keys
+  whose breaker is open.
+* ``admit(name)`` bounds concurrent LLM calls to ``LLM_MAX_INFLIGHT_PER_PROCESS``
+  in this process and ``LLM_MAX_INFLIGHT_CLUSTER`` across all processes (a
+  Redis sorted set of leases, so a crashed process's slots expire).
+
+Admission is charged per Gemini call: every ``llm.generate`` takes its own
+slots, so a lease analysis fanning out into clause batches, chunks and the
+compliance check holds one slot per call it has in flight. The cluster limit
+therefore bounds concurrent Gemini calls, not requests. At most
+``LLM_MAX_INFLIGHT_CLUSTER`` calls are in flight cluster-wide (or
+processes x ``LLM_MAX_INFLIGHT_PER_PROCESS`` if that is lower). A hedged call
+keeps its one slot until both of its requests have finished (llm_executor
+takes ``retain()`` for each request it submits), so hedges can add up to
+``LLM_HEDGE_THREADS`` upstream requests per process on top of that.
+
+The per-process default follows ``SERVING_MODE``: a sync worker serves one
+request at a time, so 8 slots cover its fan-out, while a gevent worker
+serves many and gets 64 (llm_executor sizes its thread pool to match).
+
+A call that gets no slot raises ``Overloaded`` instead of queueing, and the
+web app turns it into ``503`` with ``Retry-After``, so a degraded Gemini
+sheds load quickly instead of tying up every worker; routes that don't call
+Gemini stay responsive. ``@sheds_load`` / ``shed_if_saturated`` reject a
+request up front when this process has no free slot, before its upload is
+read. ``admit_request`` does the same for an analysis, then lets its calls
+wait ``LLM_FANOUT_ADMISSION_WAIT_SECONDS`` for slots, so a request that was
+started is rarely shed halfway through. Background jobs have nobody waiting
+on a response and run under a longer ``patient(seconds)``. Their calls retry
+the cluster with jittered backoff, and only after that wait does a job fail
+into RQ's retry schedule.
+"""
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import queues
+
+logger = logging.getLogger(__name__)
+
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', 30))
+ASYNC_SERVING = os.environ.get('SERVING_MODE', 'sync').lower() == 'async'
+LLM_MAX_INFLIGHT_PER_PROCESS = int(os.environ.get('LLM_MAX_INFLIGHT_PER_PROCESS', 64 if ASYNC_SERVING else 8))
+LLM_MAX_INFLIGHT_CLUSTER = int(os.environ.get('LLM_MAX_INFLIGHT_CLUSTER', 64)) # 0 disables the cluster limit
+LLM_ADMISSION_WAIT_SECONDS = float(os.environ.get('LLM_ADMISSION_WAIT_SECONDS', 0.5))
+# How long the calls of an analysis admitted by admit_request wait for a slot
+LLM_FANOUT_ADMISSION_WAIT_SECONDS = float(os.environ.get('LLM_FANOUT_ADMISSION_WAIT_SECONDS', 30))
+LLM_OVERLOAD_RETRY_AFTER = int(os.environ.get('LLM_OVERLOAD_RETRY_AFTER', 5))
+# Cluster slots expire after this long even if never released (crashed process)
+LLM_ADMISSION_LEASE_SECONDS = int(os.environ.get('LLM_ADMISSION_LEASE_SECONDS', 300))
+
+INFLIGHT_KEY = 'llm:inflight'
+
+
+class Overloaded(Exception):
+    """Gemini capacity is exhausted; retry after ``retry_after`` seconds."""
+
+    def __init__(self, message, retry_after=LLM_OVERLOAD_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+# --- Circuit breakers ---
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN_SECONDS):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent now; in half-open only one probe is let through."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(model_name, key_index):
+    with _breakers_lock:
+        key = (model_name, key_index)
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker()
+        return _breakers[key]
+
+
+def pick_key(model_name, start, key_count):
+    """First key index from ``start`` (in rotation order) whose breaker admits a request."""
+    waits = []
+    for offset in range(key_count):
+        key_index = (start + offset) % key_count
+        b = breaker(model_name, key_index)
+        if b.allow():
+            return key_index
+        waits.append(b.retry_after())
+    raise Overloaded(f"Circuit open for {model_name} on every key",
+                     retry_after=min(waits) if waits else LLM_OVERLOAD_RETRY_AFTER)
+
+
+def breaker_states():
+    with _breakers_lock:
+        return {f"{model}#{key_index}": {'state': b.state, 'failures': b.failures}
+                for (model, key_index), b in _breakers.items()}
+
+
+# --- Admission control ---
+
+_inflight = threading.BoundedSemaphore(LLM_MAX_INFLIGHT_PER_PROCESS)
+_counts = {'admitted': 0, 'shed': 0}
+_counts_lock = threading.Lock()
+
+
+def _count(field):
+    with _counts_lock:
+        _counts[field] += 1
+
+
+def _claim_cluster_slot(token):
+    """Take a cluster-wide slot; False if the cluster is at its limit."""
+    redis_conn = queues.get_redis_conn()
+    now = time.time()
+    pipe = redis_conn.pipeline()
+    pipe.zremrangebyscore(INFLIGHT_KEY, 0, now)
+    pipe.zadd(INFLIGHT_KEY, {token: now + LLM_ADMISSION_LEASE_SECONDS})
+    pipe.zcard(INFLIGHT_KEY)
+    pipe.expire(INFLIGHT_KEY, LLM_ADMISSION_LEASE_SECONDS)
+    in_flight = pipe.execute()[2]
+    if in_flight > LLM_MAX_INFLIGHT_CLUSTER:
+        redis_conn.zrem(INFLIGHT_KEY, token)
+        return False
+    return True
+
+
+def _release_cluster_slot(token):
+    try:
+        queues.get_redis_conn().zrem(INFLIGHT_KEY, token)
+    except Exception as e:
+        logger.info(f"Could not release LLM admission slot (expires on its own): {e}")
+
+
+class _Grant:
+    """An admitted call's slots, released when the last of its requests lets go."""
+
+    def __init__(self, token):
+        self.token = token
+        self.holders = 1
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self.holders += 1
+
+    def release(self):
+        with self._lock:
+            self.holders -= 1
+            last = self.holders == 0
+        if last:
+            if self.token is not None:
+                _release_cluster_slot(self.token)
+            _inflight.release()
+
+
+_grant = contextvars.ContextVar('llm_grant', default=None)
+# Seconds admit() may wait for a slot; None for the short web wait
+_patience = contextvars.ContextVar('llm_patience', default=None)
+
+
+@contextlib.contextmanager
+def patient(seconds):
+    """Let every admission in this context wait up to ``seconds`` for a slot.
+
+    Never shortens the wait of an enclosing ``patient`` block.
+    """
+    token = _patience.set(max(seconds, _patience.get() or 0))
+    try:
+        yield
+    finally:
+        _patience.reset(token)
+
+
+def _claim_cluster_slot_within(token, deadline):
+    """Claim a cluster slot, retrying with jittered backoff until ``deadline`` (monotonic)."""
+    delay = 0.1
+    while not _claim_cluster_slot(token):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, 5.0)
+    return True
+
+
+def retain():
+    """Keep the current call's admission slots taken, even past the call; returns the release function."""
+    grant = _grant.get()
+    if grant is None:
+        return lambda: None
+    grant.acquire()
+    return grant.release
+
+
+@contextlib.contextmanager
+def admit_request(name):
+    """Shed ``name`` now if this process is saturated; otherwise let its LLM calls wait for slots."""
+    if saturated():
+        _count('shed')
+        raise Overloaded(f"Too many LLM calls in flight in this process to start {name}")
+    with patient(LLM_FANOUT_ADMISSION_WAIT_SECONDS):
+        yield
+
+
+@contextlib.contextmanager
+def admit(name):
+    """Hold a process and a cluster slot for one LLM call, or raise ``Overloaded``."""
+    patience = _patience.get()
+    deadline = time.monotonic() + (patience or 0)
+    if not _inflight.acquire(timeout=LLM_ADMISSION_WAIT_SECONDS if patience is None else patience):
+        _count('shed')
+        raise Overloaded(f"Too many {name} calls in flight in this process")
+    token = None
+    granted = False
+    try:
+        if LLM_MAX_INFLIGHT_CLUSTER > 0:
+            token = uuid.uuid4().hex
+            try:
+                claimed = _claim_cluster_slot_within(token, deadline)
+            except Exception as e:
+                # Redis trouble must not take Gemini down with it; the process limit still applies
+                logger.info(f"Cluster LLM admission unavailable, admitting locally: {e}")
+                claimed, token = True, None
+            if not claimed:
+                token = None
+                _count('shed')
+                raise Overloaded(f"Too many {name} calls in flight across the cluster")
+        _count('admitted')
+        grant = _Grant(token)
+        granted = True
+        context_token = _grant.set(grant)
+        try:
+            yield
+        finally:
+            _grant.reset(context_token)
+            grant.release()
+    finally:
+        if not granted:
+            _inflight.release()
+
+
+def saturated():
+    """Whether this process has no free LLM slot right now."""
+    if _inflight.acquire(blocking=False):
+        _inflight.release()
+        return False
+    return True
+
+
+def shed_if_saturated():
+    """Raise ``Overloaded`` now, before any work is done, if this process has no free slot."""
+    if saturated():
+        _count('shed')
+        raise Overloaded('Too many LLM calls in flight in this process')
+
+
+def sheds_load(view):
+    """Route decorator applying ``shed_if_saturated`` to every request."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        shed_if_saturated()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def admission_stats():
+    with _counts_lock:
+        stats = dict(_counts)
+    stats['limitPerProcess'] = LLM_MAX_INFLIGHT_PER_PROCESS
+    stats['limitCluster'] = LLM_MAX_INFLIGHT_CLUSTER
+    return stats
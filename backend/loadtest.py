@@ -0,0 +1,87 @@
+"""Simple concurrent load generator for comparing serving modes.
+
+Run the backend once with SERVING_MODE=sync and once with SERVING_MODE=async
+(same worker count), then point this script at each deployment:
+
+    python loadtest.py http://localhost:8080/api/analyze --concurrency 200 \
+        --requests 1000 --token "$ID_TOKEN" --json '{"text": "..."}'
+
+It reports throughput, error count and latency percentiles so the two modes
+can be compared on the same LLM-bound endpoint. Recorded results:
+docs/adr/0002-async-serving-mode.md.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(url, total, concurrency, token=None, body=None, timeout=300):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    data = body.encode('utf-8') if body else None
+
+    def one_request(_):
+        request = urllib.request.Request(url, data=data, headers=headers,
+                                         method='POST' if data else 'GET')
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+            ok = True
+        except (urllib.error.URLError, OSError) as e:
+            ok = False
+            error = str(e)
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors.append(error)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(total)))
+    wall = time.perf_counter() - started
+
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'succeeded': len(latencies),
+        'failed': len(errors),
+        'wall_seconds': round(wall, 2),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else 0.0,
+        'latency_p50': round(_percentile(latencies, 50), 3),
+        'latency_p95': round(_percentile(latencies, 95), 3),
+        'latency_p99': round(_percentile(latencies, 99), 3),
+        'latency_mean': round(statistics.mean(latencies), 3) if latencies else 0.0,
+        'sample_errors': errors[:5],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--token', help='Firebase ID token for authenticated endpoints')
+    parser.add_argument('--json', dest='body', help='JSON request body (sends a POST)')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+    print(json.dumps(run(args.url, args.requests, args.concurrency, args.token, args.body, args.timeout), indent=2))
@@ -0,0 +1,223 @@
+"""Per-call Gemini model selection.
+
+``choose(task, ...)`` picks a model for one call from the policy in
+``model_routing.yaml`` (override with ``MODEL_ROUTING_POLICY``), using the
+prompt size, a text-quality estimate (noisy OCR output scores low), the user's
+tier and this process's recent latency and error rates per model. Callers
+report how the call went with ``record_outcome``, which updates those rates
+and logs the decision together with its outcome, e.g.::
+
+    Model route lease_analysis: gemini-2.5-flash via short-clean-lease
+    (chars=18211 quality=0.93 tier=free) -> ok in 7.41s
+
+A rule with a ``fallback`` re-runs low-confidence output on the fallback model
+(see ``llm.analyze_lease``); the escalation is logged on the same line.
+
+An unhealthy model gets no traffic, so its averages would never change. After
+``probe_interval_seconds`` without a call, one call is routed to it anyway as
+a probe; a healthy probe resets the model's stats, putting it back in rotation.
+"""
+import dataclasses
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+from response_parsing import LEASE_EXTRACTED_FIELDS, NOT_FOUND
+
+logger = logging.getLogger(__name__)
+
+POLICY_FILE = Path(os.environ.get('MODEL_ROUTING_POLICY') or Path(__file__).with_name('model_routing.yaml'))
+
+_WORD_RE = re.compile(r'\S+')
+_CLEAN_WORD_RE = re.compile(r"^[(\"'$€£]?[A-Za-z0-9][A-Za-z0-9.,:;'/&%-]*[)\"']?[.,:;!?]?$")
+
+
+def load_policy(path=POLICY_FILE):
+    with Path(path).open('r', encoding='utf-8') as f:
+        policy = yaml.safe_load(f) or {}
+    policy.setdefault('health', {})
+    policy.setdefault('tasks', {})
+    return policy
+
+
+POLICY = load_policy()
+
+
+@dataclasses.dataclass
+class Decision:
+    task: str
+    model: str
+    reason: str
+    features: dict
+    fallback: str = None
+    min_confidence: float = 0.0
+    probe: bool = False
+
+
+# --- Per-model health (this process only) ---
+
+class ModelStats:
+    """Exponentially weighted latency and error rate for one model."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.reset()
+        self.last_used = time.monotonic()
+
+    def reset(self):
+        self.samples = 0
+        self.latency = None
+        self.error_rate = 0.0
+
+    def add(self, latency_s, ok):
+        self.last_used = time.monotonic()
+        self.samples += 1
+        if self.latency is None:
+            self.latency = latency_s
+            self.error_rate = 0.0 if ok else 1.0
+        else:
+            self.latency += self.alpha * (latency_s - self.latency)
+            self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def stats_for(model):
+    with _stats_lock:
+        if model not in _stats:
+            _stats[model] = ModelStats(POLICY['health'].get('ewma_alpha', 0.2))
+        return _stats[model]
+
+
+def snapshot():
+    """Current latency/error averages per model, for logs and admin views."""
+    with _stats_lock:
+        return {model: {'samples': s.samples,
+                        'latencySeconds': round(s.latency, 3) if s.latency is not None else None,
+                        'errorRate': round(s.error_rate, 3)}
+                for model, s in _stats.items()}
+
+
+def unhealthy_reason(model):
+    """Why ``model`` should be avoided right now, or None if it's fine."""
+    health = POLICY['health']
+    s = stats_for(model)
+    if s.samples < health.get('min_samples', 5):
+        return None
+    if s.error_rate > health.get('max_error_rate', 0.5):
+        return f"error rate {s.error_rate:.2f}"
+    max_latency = health.get('max_latency_seconds')
+    if max_latency and s.latency > max_latency:
+        return f"latency {s.latency:.1f}s"
+    return None
+
+
+def _probe_due(model):
+    """Claim a health probe of an unhealthy ``model`` if it hasn't been called for a while."""
+    interval = POLICY['health'].get('probe_interval_seconds', 30)
+    s = stats_for(model)
+    with _stats_lock:
+        now = time.monotonic()
+        if now - s.last_used < interval:
+            return False
+        s.last_used = now  # one probe per interval, even while it is in flight
+        return True
+
+
+# --- Routing ---
+
+def text_quality(text):
+    """Share of whitespace-separated tokens that look like real words (0..1)."""
+    words = _WORD_RE.findall(text[:20000]) if text else []
+    if not words:
+        return 0.0
+    return round(sum(1 for w in words if _CLEAN_WORD_RE.match(w)) / len(words), 3)
+
+
+def _matches(rule, features):
+    chars = features.get('chars', 0)
+    if 'max_chars' in rule and chars > rule['max_chars']:
+        return False
+    if 'min_chars' in rule and chars < rule['min_chars']:
+        return False
+    if 'min_text_quality' in rule:
+        quality = features.get('quality')
+        if quality is None or quality < rule['min_text_quality']:
+            return False
+    if 'tiers' in rule and features.get('tier') not in rule['tiers']:
+        return False
+    return True
+
+
+def choose(task, chars=0, tier=None, quality=None):
+    """Pick the model for one ``task`` call."""
+    policy = POLICY['tasks'].get(task)
+    if policy is None:
+        raise KeyError(f"No routing policy for task '{task}'")
+    features = {'chars': chars, 'quality': quality, 'tier': tier}
+    skipped = []
+    for rule in policy.get('rules') or []:
+        if not _matches(rule, features):
+            continue
+        reason = unhealthy_reason(rule['model'])
+        if reason and not _probe_due(rule['model']):
+            skipped.append(f"{rule['name']} ({rule['model']} {reason})")
+            continue
+        return Decision(task, rule['model'], f"{rule['name']} (probe, {reason})" if reason else rule['name'],
+                        features, fallback=rule.get('fallback'),
+                        min_confidence=rule.get('min_confidence', 0.0), probe=bool(reason))
+    reason = 'default' + (f", skipped {', '.join(skipped)}" if skipped else '')
+    return Decision(task, policy['default'], reason, features)
+
+
+def models_for(task):
+    """Every model ``task`` can be routed to."""
+    policy = POLICY['tasks'].get(task) or {}
+    models = {policy['default']} if 'default' in policy else set()
+    for rule in policy.get('rules') or []:
+        models.add(rule['model'])
+        if rule.get('fallback'):
+            models.add(rule['fallback'])
+    return sorted(models)
+
+
+def confidence(data, partial=False):
+    """0..1 confidence in a parsed lease analysis.
+
+    Unparseable output scores 0. For a chunk of a longer lease (``partial``)
+    missing fields are expected, so any parsed result scores 1; otherwise it's
+    the share of ``extracted_data`` fields found, or 0 without a score.
+    """
+    if not isinstance(data, dict) or 'error_message' in data:
+        return 0.0
+    if partial:
+        return 1.0
+    if data.get('score') in (None, NOT_FOUND):
+        return 0.0
+    extracted = data.get('extracted_data') or {}
+    found = sum(1 for field in LEASE_EXTRACTED_FIELDS if extracted.get(field) not in (None, '', NOT_FOUND))
+    return round(found / len(LEASE_EXTRACTED_FIELDS), 3)
+
+
+def record_outcome(decision, latency_s, ok, model=None, escalated_from=None, note=None):
+    """Update ``model``'s health (default: the decided model) and log the decision with its outcome."""
+    model = model or decision.model
+    stats = stats_for(model)
+    stats.add(latency_s, ok)
+    max_latency = POLICY['health'].get('max_latency_seconds')
+    if decision.probe and model == decision.model and ok and (not max_latency or latency_s <= max_latency):
+        stats.reset()  # the model has recovered
+    f = decision.features
+    quality = f"{f['quality']:.2f}" if f.get('quality') is not None else '-'
+    escalation = f" escalated from {escalated_from}" if escalated_from else ''
+    extra = f" [{note}]" if note else ''
+    logger.info(f"Model route {decision.task}: {model} via {decision.reason}{escalation} "
+                f"(chars={f.get('chars', 0)} quality={quality} tier={f.get('tier') or '-'}) "
+                f"-> {'ok' if ok else 'error'} in {latency_s:.2f}s{extra}")
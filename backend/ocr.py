@@ -0,0 +1,104 @@
+"""Per-page OCR for scanned PDF pages.
+
+Each page is rendered on its own, straight to grayscale, at a DPI chosen from
+its size so no render exceeds ``OCR_MAX_PAGE_PIXELS``; it is binarised, OCR'd
+and released before the next page is rendered, so peak memory is bounded by
+one page. Results are cached by raster hash (see ocr_cache.py).
+``extraction.iter_pages`` decides which pages need OCR.
+"""
+import logging
+import os
+
+import ocr_cache
+from lazy_imports import lazy_module, is_available
+
+logger = logging.getLogger(__name__)
+
+fitz = lazy_module('fitz')
+Image = lazy_module('PIL.Image')
+pytesseract = lazy_module('pytesseract')
+
+OCR_AVAILABLE = is_available('pytesseract') and is_available('PIL')
+
+OCR_DPI = int(os.environ.get('OCR_DPI', 300))
+# 12M 8-bit pixels is a 300 DPI render of an 11x17" page, about 12 MB
+OCR_MAX_PAGE_PIXELS = int(os.environ.get('OCR_MAX_PAGE_PIXELS', 12_000_000))
+OCR_MAX_PAGES = int(os.environ.get('OCR_MAX_PAGES', 300))
+OCR_LANG = os.environ.get('OCR_LANG', 'eng')
+
+
+class OCRCancelled(Exception):
+    """Raised when ``should_cancel`` reports the job was stopped."""
+
+
+def choose_dpi(width_pts, height_pts, dpi=OCR_DPI, max_pixels=OCR_MAX_PAGE_PIXELS):
+    """Render DPI for a page: ``dpi`` unless that would exceed ``max_pixels``."""
+    area_sq_in = (width_pts / 72.0) * (height_pts / 72.0)
+    if area_sq_in <= 0:
+        return dpi
+    ceiling = int((max_pixels / area_sq_in) ** 0.5)
+    return max(1, min(dpi, ceiling))
+
+
+def otsu_threshold(histogram):
+    """Otsu's threshold for a 256-bin grayscale histogram."""
+    total = sum(histogram)
+    if not total:
+        return 127
+    weighted_total = sum(i * count for i, count in enumerate(histogram))
+    background = 0
+    weighted_background = 0
+    best_threshold, best_variance = 0, -1.0
+    for i, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += i * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+def binarize(image):
+    gray = image if image.mode == 'L' else image.convert('L')
+    threshold = otsu_threshold(gray.histogram()[:256])
+    return gray.point(lambda p: 255 if p > threshold else 0)
+
+
+def render_page(page, dpi=None):
+    """Render a PyMuPDF page to a grayscale PIL image."""
+    dpi = dpi or choose_dpi(page.rect.width, page.rect.height)
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    return Image.frombytes('L', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def new_stats():
+    """Per-document OCR counters filled in by ``ocr_page``."""
+    return {'pages': 0, 'cacheHits': 0}
+
+
+def hit_rate(stats):
+    return round(stats['cacheHits'] / stats['pages'], 3) if stats['pages'] else None
+
+
+def ocr_page(page, lang=OCR_LANG, stats=None):
+    """OCR a single PyMuPDF page, skipping Tesseract for pages seen before."""
+    image = render_page(page)
+    try:
+        key = ocr_cache.cache_key(image.tobytes(), image.width, image.height, lang)
+        text = ocr_cache.lookup(key)
+        if stats is not None:
+            stats['pages'] += 1
+            stats['cacheHits'] += text is not None
+        if text is None:
+            text = pytesseract.image_to_string(binarize(image), lang=lang)
+            ocr_cache.store(key, text)
+        return text
+    finally:
+        image.close()
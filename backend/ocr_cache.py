@@ -0,0 +1,129 @@
+"""Page-level cache of OCR results keyed by a hash of the rendered page raster.
+
+Master compliance templates, standard addenda and lender forms recur as
+scanned pages across uploads. ``ocr.ocr_page`` looks the page's raster hash up
+here before running Tesseract. Backends (``OCR_CACHE``):
+
+* ``redis`` (default) - shared by every web and worker process; each hit
+  refreshes the entry's TTL, so idle entries age out first,
+* ``disk``  - a SQLite file with least-recently-used eviction past
+  ``OCR_CACHE_MAX_ENTRIES``,
+* ``off``.
+
+Cache errors are logged and treated as misses.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+OCR_CACHE = os.environ.get('OCR_CACHE', 'redis')
+OCR_CACHE_TTL_SECONDS = int(os.environ.get('OCR_CACHE_TTL_SECONDS', 30 * 86400))
+OCR_CACHE_PATH = os.environ.get('OCR_CACHE_PATH', '/tmp/leaseshield/ocr_cache.sqlite3')
+OCR_CACHE_MAX_ENTRIES = int(os.environ.get('OCR_CACHE_MAX_ENTRIES', 50000))
+# Bump when rendering or preprocessing changes so stale text is not reused
+CACHE_VERSION = 1
+
+
+def cache_key(raster, width, height, lang):
+    digest = hashlib.sha256(f'{CACHE_VERSION}:{lang}:{width}x{height}:'.encode('utf-8'))
+    digest.update(raster)
+    return digest.hexdigest()
+
+
+class RedisOCRCache:
+    def __init__(self, get_conn, ttl=OCR_CACHE_TTL_SECONDS):
+        self._get_conn = get_conn
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self._get_conn().getex(f'ocr:{key}', ex=self.ttl)
+        return value.decode('utf-8') if value is not None else None
+
+    def put(self, key, text):
+        self._get_conn().set(f'ocr:{key}', text.encode('utf-8'), ex=self.ttl)
+
+
+class DiskOCRCache:
+    def __init__(self, path, max_entries=OCR_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS ocr_pages ('
+                         'key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT text FROM ocr_pages WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE ocr_pages SET last_used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key, text):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO ocr_pages (key, text, last_used) VALUES (?, ?, ?)',
+                         (key, text, time.time()))
+            excess = conn.execute('SELECT COUNT(*) FROM ocr_pages').fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute('DELETE FROM ocr_pages WHERE key IN '
+                             '(SELECT key FROM ocr_pages ORDER BY last_used LIMIT ?)', (excess,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the configured cache backend, or None when caching is off."""
+    global _cache
+    if _cache is None and OCR_CACHE != 'off':
+        with _cache_lock:
+            if _cache is None:
+                if OCR_CACHE == 'disk':
+                    _cache = DiskOCRCache(OCR_CACHE_PATH)
+                else:
+                    import queues
+                    _cache = RedisOCRCache(queues.get_redis_conn)
+    return _cache
+
+
+def lookup(key):
+    cache = get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"OCR cache lookup failed: {e}")
+        return None
+
+
+def store(key, text):
+    cache = get_cache()
+    if cache is None:
+        return
+    try:
+        cache.put(key, text)
+    except Exception as e:
+        logger.warning(f"OCR cache store failed: {e}")
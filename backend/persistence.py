@@ -0,0 +1,372 @@
+"""Write-behind persistence for Firestore documents.
+
+Routes that only need to record a result (lease analyses, inspections, expense
+scans) hand their documents to ``WriteBehindQueue.add`` and respond straight
+away. Document IDs are generated locally, the payload is spooled to a SQLite
+file so it survives a crash, and a background thread flushes the spool to
+Firestore in batched writes. When a batch fails its rows are retried one by
+one, so a single bad document can't hold back the rest; each row keeps its
+own attempt count and backoff, and after ``max_attempts`` it is moved to the
+``dead_writes`` table (and logged as an error) for someone to look at.
+
+The spool only protects writes if it outlives the container: set
+``WRITE_SPOOL_PATH`` to a file on a persistent volume (docker-compose mounts
+one at /var/lib/leaseshield). The /tmp default is for local development and
+is logged as a warning.
+
+``discard`` drops the spooled writes of a document that is being deleted. A
+write that a flush has already claimed can't be recalled, so it leaves a
+tombstone, and the flush deletes that document again right after writing it.
+"""
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Firestore caps a write batch at 500 operations
+MAX_BATCH_SIZE = 500
+_SENTINEL_KEY = '__firestore_sentinel__'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    claimed_until REAL NOT NULL DEFAULT 0
+)
+"""
+
+_DEAD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_writes (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL
+)
+"""
+
+
+_TOMBSTONE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tombstones (
+    collection TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (collection, doc_id)
+)
+"""
+
+DEFAULT_SPOOL_PATH = '/tmp/leaseshield/write_spool.sqlite3'
+
+
+def _server_timestamp():
+    from firebase_admin import firestore
+    return firestore.SERVER_TIMESTAMP
+
+
+def _encode(data):
+    def default(value):
+        if value is _server_timestamp():
+            return {_SENTINEL_KEY: 'server_timestamp'}
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        raise TypeError(f"Cannot spool value of type {type(value).__name__}")
+
+    return json.dumps(data, default=default)
+
+
+def _decode(payload):
+    def hook(obj):
+        if obj.get(_SENTINEL_KEY) == 'server_timestamp':
+            return _server_timestamp()
+        return obj
+
+    return json.loads(payload, object_hook=hook)
+
+
+class WriteBehindQueue:
+    """Durable, batched, asynchronous ``set`` writes to Firestore."""
+
+    def __init__(self, get_db, spool_path, batch_size=400, flush_interval=0.5,
+                 claim_seconds=60, max_backoff=300, max_attempts=10):
+        self._get_db = get_db
+        self.spool_path = spool_path
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.claim_seconds = claim_seconds
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._conn = None
+        self._conn_pid = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+    # --- Spool ---
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            spool_dir = os.path.dirname(self.spool_path)
+            if spool_dir:
+                os.makedirs(spool_dir, exist_ok=True)
+            # Several gunicorn workers may share one spool file
+            conn = sqlite3.connect(self.spool_path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(_SCHEMA)
+            conn.execute(_DEAD_SCHEMA)
+            conn.execute(_TOMBSTONE_SCHEMA)
+            if self.spool_path == DEFAULT_SPOOL_PATH:
+                logger.warning(f"Write-behind spool at {self.spool_path}: spooled writes are lost with the "
+                               f"container. Set WRITE_SPOOL_PATH to a persistent volume.")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def new_document_id(self, collection):
+        """Generate a Firestore auto-ID locally; no network round-trip."""
+        return self._get_db().collection(collection).document().id
+
+    def add(self, collection, data, doc_id=None):
+        """Spool a document write and return its ID immediately."""
+        doc_id = doc_id or self.new_document_id(collection)
+        payload = _encode(data)
+        with self._lock:
+            self._connection().execute(
+                'INSERT INTO pending_writes (collection, doc_id, payload) VALUES (?, ?, ?)',
+                (collection, doc_id, payload))
+        self._ensure_worker()
+        self._wakeup.set()
+        return doc_id
+
+    def pending_count(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM pending_writes').fetchone()[0]
+
+    def pending_document(self, collection, doc_id):
+        """The latest spooled data for a document not yet written, or None."""
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT payload FROM pending_writes WHERE collection = ? AND doc_id = ? ORDER BY id DESC LIMIT 1',
+                (collection, doc_id)).fetchone()
+        return _decode(row[0]) if row else None
+
+    def discard(self, collection, doc_id):
+        """Drop a document's spooled writes, so deleting it isn't undone by a later flush.
+
+        Returns the number of writes dropped. A write already claimed by a
+        flush leaves a tombstone instead; see ``_bury``.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                in_flight = conn.execute(
+                    'SELECT COUNT(*) FROM pending_writes WHERE collection = ? AND doc_id = ? AND claimed_until > ?',
+                    (collection, doc_id, now)).fetchone()[0]
+                dropped = conn.execute('DELETE FROM pending_writes WHERE collection = ? AND doc_id = ?',
+                                       (collection, doc_id)).rowcount
+                conn.execute('DELETE FROM dead_writes WHERE collection = ? AND doc_id = ?', (collection, doc_id))
+                if in_flight:
+                    conn.execute('INSERT OR REPLACE INTO tombstones (collection, doc_id, created_at) '
+                                 'VALUES (?, ?, ?)', (collection, doc_id, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return dropped
+
+    def dead_count(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM dead_writes').fetchone()[0]
+
+    def _claim_batch(self):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT id, collection, doc_id, payload, attempts FROM pending_writes '
+                    'WHERE next_attempt_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?',
+                    (now, now, self.batch_size)).fetchall()
+                if rows:
+                    conn.executemany('UPDATE pending_writes SET claimed_until = ? WHERE id = ?',
+                                     [(now + self.claim_seconds, row[0]) for row in rows])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return rows
+
+    # --- Flushing ---
+    def flush_once(self):
+        """Write one batch to Firestore. Returns the number of documents written."""
+        rows = self._claim_batch()
+        if not rows:
+            return 0
+        db = self._get_db()
+        if db is None:
+            self._failed(rows, RuntimeError('Firestore client unavailable'))
+            return 0
+        try:
+            self._commit(db, rows)
+        except Exception as e:
+            if len(rows) == 1:
+                self._failed(rows, e)
+                return 0
+            logger.warning(f"Write-behind flush of {len(rows)} docs failed, retrying them one by one: {e}")
+            written = []
+            for row in rows:
+                try:
+                    self._commit(db, [row])
+                except Exception as row_error:
+                    self._failed([row], row_error)
+                else:
+                    written.append(row)
+            self._delete(written)
+            self._bury(db, written)
+            return len(written)
+        self._delete(rows)
+        self._bury(db, rows)
+        return len(rows)
+
+    def _commit(self, db, rows):
+        batch = db.batch()
+        for _, collection, doc_id, payload, _ in rows:
+            batch.set(db.collection(collection).document(doc_id), _decode(payload))
+        batch.commit()
+
+    def _delete(self, rows):
+        with self._lock:
+            self._connection().executemany('DELETE FROM pending_writes WHERE id = ?',
+                                           [(row[0],) for row in rows])
+
+    def _bury(self, db, rows):
+        """Delete just-written documents that were discarded while their write was in flight."""
+        if not rows:
+            return
+        docs = {(row[1], row[2]) for row in rows}
+        with self._lock:
+            buried = [doc for doc in self._connection().execute('SELECT collection, doc_id FROM tombstones')
+                      if doc in docs]
+        for collection, doc_id in buried:
+            try:
+                db.collection(collection).document(doc_id).delete()
+            except Exception as e:
+                logger.error(f"Write-behind could not delete discarded {collection}/{doc_id}: {e}")
+                continue
+            with self._lock:
+                self._connection().execute('DELETE FROM tombstones WHERE collection = ? AND doc_id = ?',
+                                           (collection, doc_id))
+
+    def _failed(self, rows, error):
+        """Back off each failed row by its own attempt count, dead-lettering it after ``max_attempts``."""
+        now = time.time()
+        retry, dead = [], []
+        for row in rows:
+            attempts = row[4] + 1
+            if attempts >= self.max_attempts:
+                dead.append(row)
+                logger.error(f"Write-behind gave up on {row[1]}/{row[2]} after {attempts} attempts: {error}")
+            else:
+                retry.append((attempts, now + min(self.max_backoff, 2 ** attempts), row[0]))
+        if retry:
+            logger.warning(f"Write-behind write of {len(retry)} docs failed, retrying with backoff: {error}")
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('UPDATE pending_writes SET attempts = ?, next_attempt_at = ?, claimed_until = 0 '
+                                 'WHERE id = ?', retry)
+                conn.executemany('INSERT OR REPLACE INTO dead_writes '
+                                 '(id, collection, doc_id, payload, attempts, error, failed_at) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 [(row[0], row[1], row[2], row[3], row[4] + 1, str(error), now) for row in dead])
+                conn.executemany('DELETE FROM pending_writes WHERE id = ?', [(row[0],) for row in dead])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def flush(self, timeout=10):
+        """Flush until the spool is empty or nothing is currently writable."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.flush_once():
+                break
+
+    def start(self):
+        """Start the flush thread in this process, picking up any rows left in the spool."""
+        self._ensure_worker()
+        self._wakeup.set()
+
+    def _ensure_worker(self):
+        # After a fork the parent's thread does not exist in the child
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self._shutdown)
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                while self.flush_once():
+                    pass
+            except Exception as e:
+                logger.error(f"Write-behind worker error: {e}")
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def _shutdown(self):
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            self.flush(timeout=5)
+        except Exception as e:
+            logger.error(f"Write-behind flush on shutdown failed; writes stay spooled: {e}")
+
+
+def _default_db():
+    from firebase_client import get_db
+    return get_db()
+
+
+# Process-wide queue used by the web app for analysis, inspection and expense results
+write_behind = WriteBehindQueue(
+    _default_db,
+    spool_path=os.environ.get('WRITE_SPOOL_PATH', DEFAULT_SPOOL_PATH),
+    max_attempts=int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 10)),
+)
+
+
+def write_now(collection, data, doc_id=None):
+    """Synchronous counterpart of ``write_behind.add`` for worker processes.
+
+    RQ work-horses exit right after their job, so they can't rely on a
+    background flush thread.
+    """
+    db = _default_db()
+    if db is None:
+        raise RuntimeError('Firestore client unavailable')
+    doc_ref = db.collection(collection).document(doc_id) if doc_id else db.collection(collection).document()
+    doc_ref.set(data)
+    return doc_ref.id
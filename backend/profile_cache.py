@@ -0,0 +1,154 @@
+"""Process-level cache for Firestore user profiles.
+
+Profiles are read on almost every authenticated request, mostly just to look
+at ``subscriptionTier`` and the scan counters. Entries live for a short TTL and
+every write path in the app updates the cached copy (write-through) or drops it
+so a worker never keeps serving a stale tier for long.
+
+A write in one process also has to reach the copies other processes hold:
+``broadcast_invalidation`` publishes the user id on a Redis channel, and every
+process that caches profiles runs a listener thread that drops its copy. If
+the listener loses Redis it clears the whole cache, since it may have missed
+messages. Quota checks don't rely on any of this; they read the profile
+fresh (profiles.get_fresh_user_profile).
+"""
+import copy
+import logging
+import os
+import socket
+import threading
+import time
+
+import queues
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', 30))
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get('PROFILE_CACHE_MAX_ENTRIES', 10000))
+PROFILE_CACHE_BROADCAST = os.environ.get('PROFILE_CACHE_BROADCAST', 'true').lower() == 'true'
+INVALIDATION_CHANNEL = 'profile-cache:invalidate'
+LISTENER_RETRY_SECONDS = 5
+
+_lock = threading.Lock()
+_entries = {}  # user_id -> (expires_at, profile dict)
+_listener = None
+_listener_pid = None
+
+
+def get(user_id):
+    """Return a copy of the cached profile, or None if missing or expired."""
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, profile = entry
+        if expires_at < time.monotonic():
+            del _entries[user_id]
+            return None
+        return copy.deepcopy(profile)
+
+
+def put(user_id, profile):
+    """Store a profile snapshot for ``PROFILE_CACHE_TTL_SECONDS``."""
+    if profile is None or PROFILE_CACHE_TTL_SECONDS <= 0:
+        return
+    with _lock:
+        if len(_entries) >= PROFILE_CACHE_MAX_ENTRIES and user_id not in _entries:
+            # Drop the entry closest to expiry to make room
+            oldest = min(_entries, key=lambda uid: _entries[uid][0])
+            del _entries[oldest]
+        _entries[user_id] = (time.monotonic() + PROFILE_CACHE_TTL_SECONDS, copy.deepcopy(profile))
+    _ensure_listener()
+
+
+def update(user_id, fields):
+    """Write-through: merge plain field values into a cached profile if present.
+
+    Callers must pass resolved values, not Firestore sentinels such as
+    ``Increment`` or ``SERVER_TIMESTAMP``; use ``increment`` or ``invalidate``
+    for those.
+    """
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None:
+            return
+        entry[1].update(copy.deepcopy(fields))
+
+
+def increment(user_id, field, amount=1):
+    """Write-through counterpart of ``firestore.Increment`` for a cached profile."""
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None:
+            return
+        profile = entry[1]
+        profile[field] = (profile.get(field) or 0) + amount
+
+
+def invalidate(user_id):
+    """Drop a user's cached profile, e.g. after a tier change."""
+    with _lock:
+        _entries.pop(user_id, None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+# --- Cross-process invalidation ---
+
+def _origin():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def broadcast_invalidation(user_id):
+    """Tell every other process to drop its cached copy of ``user_id``'s profile."""
+    if not PROFILE_CACHE_BROADCAST:
+        return
+    try:
+        queues.get_redis_conn().publish(INVALIDATION_CHANNEL, f"{_origin()} {user_id}")
+    except Exception as e:
+        logger.info(f"Could not broadcast profile invalidation for {user_id}: {e}")
+
+
+def handle_message(data):
+    """Apply one invalidation message; a process ignores its own."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    origin, _, user_id = data.partition(' ')
+    if user_id and origin != _origin():
+        invalidate(user_id)
+
+
+def _listen():
+    while True:
+        subscribed = False
+        try:
+            pubsub = queues.get_redis_conn().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            subscribed = True
+            for message in pubsub.listen():
+                if message.get('type') == 'message':
+                    handle_message(message['data'])
+        except Exception as e:
+            logger.info(f"Profile cache invalidation listener has no Redis connection: {e}")
+        if subscribed:
+            # Messages may have been missed while disconnected
+            clear()
+        time.sleep(LISTENER_RETRY_SECONDS)
+
+
+def _ensure_listener():
+    global _listener, _listener_pid
+    if not PROFILE_CACHE_BROADCAST:
+        return
+    # After a fork the parent's thread does not exist in the child
+    if _listener is not None and _listener.is_alive() and _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener is not None and _listener.is_alive() and _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _listener = threading.Thread(target=_listen, name='profile-cache-invalidation', daemon=True)
+        _listener.start()
@@ -0,0 +1,197 @@
+"""Firestore user profile helpers with request memoization and caching.
+
+Inside a Flask request profiles are memoized on ``flask.g``; everywhere (web
+and worker) they go through the short-TTL process cache in ``profile_cache``.
+Writes update or drop this process's copy and broadcast an invalidation to
+the others. Quota is never decided on a cached copy: checks read the profile
+with ``get_fresh_user_profile`` and ``increment_scan_counts`` re-reads the
+counters inside a Firestore transaction.
+"""
+import datetime
+import logging
+
+import profile_cache
+from firebase_client import get_db
+from lazy_imports import lazy_module
+
+logger = logging.getLogger(__name__)
+
+firestore = lazy_module('firebase_admin.firestore')
+
+# Scan limits of the metered tiers; commercial limits are per user (maxAllowedScans)
+FREE_MONTHLY_SCANS = 3
+PREMIUM_MONTHLY_SCANS = 50
+PREMIUM_DAILY_SCANS = 3
+
+
+def _request_memo():
+    """Per-request profile memo, or an empty throwaway dict outside a request."""
+    try:
+        from flask import g, has_request_context
+    except ImportError:  # worker processes don't ship Flask
+        return {}
+    if not has_request_context():
+        return {}
+    return g.setdefault('user_profiles', {})
+
+def get_or_create_user_profile(user_id):
+    """Gets user profile, memoized per request and cached briefly per process."""
+    memo = _request_memo()
+    if user_id in memo:
+        return memo[user_id]
+    profile_data = profile_cache.get(user_id)
+    if profile_data is None:
+        profile_data = _load_or_create_user_profile(user_id)
+        profile_cache.put(user_id, profile_data)
+    if profile_data is not None:
+        memo[user_id] = profile_data
+    return profile_data
+
+def get_fresh_user_profile(user_id):
+    """Reads the profile from Firestore, bypassing the caches, and refreshes them.
+
+    For decisions that must not use a stale copy, such as scan quota checks.
+    """
+    profile_data = _load_or_create_user_profile(user_id)
+    if profile_data is not None:
+        profile_cache.put(user_id, profile_data)
+        _request_memo()[user_id] = profile_data
+    return profile_data
+
+def invalidate_user_profile(user_id):
+    """Drops cached copies of a profile after a write the cache can't mirror."""
+    profile_cache.invalidate(user_id)
+    _request_memo().pop(user_id, None)
+    profile_cache.broadcast_invalidation(user_id)
+
+def update_cached_profile(user_id, fields):
+    """Write-through of plain field values to the request memo and process cache."""
+    profile_cache.update(user_id, fields)
+    memoized = _request_memo().get(user_id)
+    if memoized is not None:
+        memoized.update(fields)
+    profile_cache.broadcast_invalidation(user_id)
+
+def _load_or_create_user_profile(user_id):
+    """Gets user profile from Firestore, creates default free tier if not found."""
+    db = get_db()
+    user_ref = db.collection('users').document(user_id)
+    user_doc = user_ref.get()
+    if user_doc.exists:
+        # Ensure existing profiles have new fields (handle potential missing fields)
+        profile_data = user_doc.to_dict()
+        if 'dailyScansUsed' not in profile_data:
+            profile_data['dailyScansUsed'] = 0
+        if 'lastScanDate' not in profile_data:
+            profile_data['lastScanDate'] = None # Or a default past date string like '1970-01-01'
+        if 'lastMonthlyScan' not in profile_data:
+            profile_data['lastMonthlyScan'] = datetime.date.today().strftime('%Y-%m')
+            try:
+                user_ref.update({'lastMonthlyScan': profile_data['lastMonthlyScan']})
+            except Exception as e:
+                logger.info(f"Warning: could not backfill lastMonthlyScan for {user_id}: {e}")
+        return profile_data
+    else:
+        logger.info(f"Creating default free profile for user: {user_id}")
+        default_profile = {
+            'userId': user_id, 
+            'subscriptionTier': 'free',
+            'freeScansUsed': 0,
+            'maxAllowedScans': 3, # Default for free tier
+            'dailyScansUsed': 0,
+            'lastScanDate': None, # Initialize as None
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'lastMonthlyScan': datetime.date.today().strftime('%Y-%m')
+        }
+        try:
+            user_ref.set(default_profile)
+            # Don't cache the SERVER_TIMESTAMP sentinel as if it were a value
+            default_profile = dict(default_profile, createdAt=None)
+            return default_profile
+        except Exception as e:
+             logger.info(f"Error creating user profile for {user_id}: {e}")
+             return None # Indicate failure
+
+def _scan_count_updates(profile_data, tier, today_str):
+    """Field values after one more scan, from the stored counters."""
+    updates = {}
+    if tier in ['free', 'commercial', 'premium']:
+        month_str = today_str[:7]
+        used = profile_data.get('freeScansUsed') or 0
+        # A month that hasn't been reset yet starts again from zero
+        if profile_data.get('lastMonthlyScan') != month_str:
+            used = 0
+        updates['freeScansUsed'] = used + 1
+        updates['lastMonthlyScan'] = month_str
+    if tier == 'premium':
+        if profile_data.get('lastScanDate') == today_str:
+            updates['dailyScansUsed'] = (profile_data.get('dailyScansUsed') or 0) + 1
+        else:
+            updates['dailyScansUsed'] = 1
+            updates['lastScanDate'] = today_str
+    return updates
+
+def scan_limit_error(profile_data, tier, today_str=None):
+    """The error body if one more scan would exceed the tier's limit, else None.
+
+    Judged on the stored counters like ``_scan_count_updates``, so a month or
+    day that hasn't been reset yet counts from zero.
+    """
+    today_str = today_str or datetime.date.today().isoformat()
+    monthly = profile_data.get('freeScansUsed') or 0
+    if profile_data.get('lastMonthlyScan') != today_str[:7]:
+        monthly = 0
+    daily = profile_data.get('dailyScansUsed') or 0
+    if profile_data.get('lastScanDate') != today_str:
+        daily = 0
+    if tier == 'free' and monthly >= FREE_MONTHLY_SCANS:
+        return {'error': 'Free analysis limit reached. Please upgrade.', 'upgradeRequired': True,
+                'limitReached': 'monthly'}
+    if tier == 'premium':
+        if monthly >= PREMIUM_MONTHLY_SCANS:
+            return {'error': f'Monthly analysis limit ({PREMIUM_MONTHLY_SCANS}) reached for Premium plan. '
+                             'Upgrade or wait until next cycle.', 'limitReached': 'monthly'}
+        if daily >= PREMIUM_DAILY_SCANS:
+            return {'error': f'Daily analysis limit ({PREMIUM_DAILY_SCANS}) reached for Premium plan.',
+                    'limitReached': 'daily'}
+    if tier == 'commercial':
+        max_scans = profile_data.get('maxAllowedScans', 0)
+        if monthly >= max_scans:
+            return {'error': f'Commercial scan limit reached ({monthly}/{max_scans} used). Contact admin for more.',
+                    'limitReached': 'monthly'}
+    return None
+
+
+def increment_scan_counts(user_id, tier):
+    """Atomically increments scan counts based on tier.
+
+    The counters and ``lastScanDate`` are read and written in one Firestore
+    transaction, so concurrent scans from other processes are neither lost
+    nor judged against a stale date.
+    """
+    db = get_db()
+    user_ref = db.collection('users').document(user_id)
+    today_str = datetime.date.today().isoformat() # Get YYYY-MM-DD
+
+    def apply(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        updates = _scan_count_updates(snapshot.to_dict() or {}, tier, today_str)
+        if updates:
+            transaction.update(user_ref, updates)
+        return updates
+
+    try:
+        updates = firestore.transactional(apply)(db.transaction())
+        if updates is None:
+            logger.info(f"Error: Could not find user {user_id} to update scan counts.")
+            return False # Indicate failure if user doc missing
+        if updates:
+            update_cached_profile(user_id, updates)
+            logger.info(f"Updated scan counts for user {user_id} (tier: {tier}): {updates}")
+        return True
+    except Exception as e:
+        logger.info(f"Error incrementing scan counts for {user_id} (tier: {tier}): {e}")
+        invalidate_user_profile(user_id)
+        return False
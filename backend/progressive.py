@@ -0,0 +1,85 @@
+"""Progressive delivery of a lease analysis as Server-Sent Events.
+
+Gemini takes 20+ seconds on a lease, but the rule engine and regex
+extraction take milliseconds. A streamed /api/analyze request (``Accept:
+text/event-stream``) therefore receives, in order:
+
+``rules``       rule-engine clause matches (rules.analyze_text)
+``extracted``   the ``extracted_data`` fields found by quick_extract
+``clauses``     annotated clauses per batch as Gemini returns them (clause mode)
+``analysis``    the full analysis once Gemini is done
+``compliance``  the compliance report, for commercial users with a template
+``done``        ``{'success', 'leaseId', 'analysis'}``, the same body as the JSON response
+``error``       ``{'error'}`` (and ``retryAfter`` when overloaded) instead of ``done``
+
+The pipeline runs on a worker thread (in a copy of the request's context,
+with its own LLM deadline) and hands events over a queue. While it waits, the
+stream sends a comment every ``SSE_KEEPALIVE_SECONDS`` so proxies don't close
+an idle connection.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+
+import llm_executor
+import llm_guard
+import quick_extract
+import rules
+
+logger = logging.getLogger(__name__)
+
+SSE_KEEPALIVE_SECONDS = float(os.environ.get('SSE_KEEPALIVE_SECONDS', 15))
+
+_FINISHED = object()
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def stream_analysis(text, run, budget_seconds):
+    """Yield the SSE stream for ``text``.
+
+    ``run(progress)`` performs the LLM stages, calling ``progress(event,
+    data)`` as each finishes, and returns ``{'leaseId', 'analysis'}`` or None.
+    It runs after the route has returned, so it gets its own ``budget_seconds``.
+    """
+    yield format_event('rules', rules.analyze_text(text))
+    yield format_event('extracted', quick_extract.extract(text))
+
+    events = queue.Queue()
+
+    def progress(event, data):
+        # Encoded here: the analysis dict keeps being filled in after it is reported
+        events.put(format_event(event, data))
+
+    def worker():
+        try:
+            with llm_executor.budget(budget_seconds):
+                outcome = run(progress)
+            if outcome is None:
+                events.put(format_event('error', {'error': 'AI analysis failed. Please try again later.'}))
+            else:
+                events.put(format_event('done', {'success': True, 'leaseId': outcome['leaseId'],
+                                                 'analysis': outcome['analysis']}))
+        except llm_guard.Overloaded as e:
+            events.put(format_event('error', {'error': str(e), 'retryAfter': e.retry_after}))
+        except Exception as e:
+            logger.info(f"Streamed analysis error: {e}")
+            events.put(format_event('error', {'error': str(e)}))
+        finally:
+            events.put(_FINISHED)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True).start()
+    while True:
+        try:
+            item = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        if item is _FINISHED:
+            return
+        yield item
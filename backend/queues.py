@@ -0,0 +1,59 @@
+"""Redis connection and RQ queue shared by the web and worker processes.
+
+Kept free of PDF/OCR and web imports so that either process can use it
+without pulling in the other's dependency tree.
+"""
+import os
+import random
+import threading
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+ANALYSIS_QUEUE = 'analysis'
+# Seconds before each RQ retry; a failure is most often Gemini being
+# overloaded, which an immediate retry would only hit again
+RETRY_INTERVALS = [int(seconds) for seconds in os.environ.get('JOB_RETRY_INTERVALS', '30,120,300').split(',')]
+
+_lock = threading.Lock()
+_redis_conn = None
+_queue = None
+
+
+def get_redis_conn():
+    """Return the shared Redis connection, created on first use."""
+    global _redis_conn
+    if _redis_conn is None:
+        with _lock:
+            if _redis_conn is None:
+                from redis import Redis
+                _redis_conn = Redis.from_url(REDIS_URL, decode_responses=False)
+    return _redis_conn
+
+
+def get_queue():
+    """Return the RQ analysis queue, created on first use."""
+    global _queue
+    if _queue is None:
+        conn = get_redis_conn()
+        with _lock:
+            if _queue is None:
+                from rq import Queue
+                _queue = Queue(ANALYSIS_QUEUE, connection=conn)
+    return _queue
+
+
+def retry_intervals(retries):
+    """``RETRY_INTERVALS`` for ``retries`` attempts, each jittered up to 50% so retries don't arrive together."""
+    return [round(RETRY_INTERVALS[min(i, len(RETRY_INTERVALS) - 1)] * random.uniform(1, 1.5))
+            for i in range(retries)]
+
+
+def enqueue(func, *args, retries=3, **kwargs):
+    """Enqueue ``func`` on the analysis queue with RQ-level retries and backoff.
+
+    The web process passes a dotted path (e.g. ``'tasks.analyze'``) so it never
+    has to import the worker-side modules. Delayed retries are enqueued by the
+    workers' scheduler (``with_scheduler`` in worker.py).
+    """
+    from rq import Retry
+    return get_queue().enqueue(func, *args, retry=Retry(max=retries, interval=retry_intervals(retries)),
+                               **kwargs)
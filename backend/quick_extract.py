@@ -0,0 +1,59 @@
+"""Regex extraction of the lease terms that don't need an LLM.
+
+Rent, deposit, start and end dates, rent due day and term are usually stated
+in a handful of stock phrasings. Matching those takes milliseconds, so the
+streamed /api/analyze response shows them before Gemini has answered (see
+progressive.py). Gemini's ``extracted_data`` replaces them when it arrives.
+Fields that aren't found are left out, not set to "Not Found".
+"""
+import re
+
+_MONEY = r'\$\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?|\$\s?\d+(?:\.\d{2})?'
+_MONTH = (r'(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|'
+          r'Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)')
+_DATE = (rf'{_MONTH}\.?\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}'
+         rf'|\d{{1,2}}(?:st|nd|rd|th)?\s+(?:day\s+of\s+)?{_MONTH},?\s+\d{{4}}'
+         r'|\d{1,2}/\d{1,2}/\d{2,4}|\d{4}-\d{2}-\d{2}')
+_DAY = r'\d{1,2}(?:st|nd|rd|th)|first|second|third|fifth|tenth|fifteenth|last'
+_COUNT = r'\d{1,2}|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|eighteen|twenty-four|thirty-six'
+
+# Each field's patterns are tried in order; the first match wins
+PATTERNS = {
+    'Monthly_Rent_Amount': [
+        rf'(?:monthly\s+rent|rent\s+(?:of|is|shall\s+be|in\s+the\s+amount\s+of))[^$\n]{{0,60}}?({_MONEY})',
+        rf'({_MONEY})\s*(?:per|a|each|/)\s*month',
+    ],
+    'Security_Deposit_Amount': [
+        rf'(?:security\s+)?deposit[^$\n]{{0,60}}?({_MONEY})',
+        rf'({_MONEY})\s+(?:as\s+(?:a\s+)?)?(?:security\s+)?deposit',
+    ],
+    'Lease_Start_Date': [
+        rf'(?:commenc\w*|begin\w*|start\w*)(?:\s+on)?\s+({_DATE})',
+        rf'\bfrom\s+({_DATE})\s+(?:to|through|until)\s+(?:{_DATE})',
+    ],
+    'Lease_End_Date': [
+        rf'\bfrom\s+(?:{_DATE})\s+(?:to|through|until)\s+({_DATE})',
+        rf'(?:end\w*|terminat\w*|expir\w*)(?:\s+on)?\s+({_DATE})',
+    ],
+    'Rent_Due_Date': [
+        rf'(?:due|payable|paid)(?:\s+\w+){{0,4}}?\s+on\s+(?:or\s+before\s+)?the\s+((?:{_DAY})\s+day\s+of\s+(?:each|every)\s+(?:calendar\s+)?month)',
+    ],
+    'Lease_Term': [
+        rf'term\s+of\s+(?:this\s+lease\s+(?:is|shall\s+be)\s+)?((?:{_COUNT})(?:\s*\(\d{{1,2}}\))?\s+(?:months?|years?))',
+        rf'((?:{_COUNT})(?:\s*\(\d{{1,2}}\))?[\s-]+(?:months?|years?))\s+(?:lease|term|tenancy)',
+    ],
+}
+_COMPILED = {field: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+             for field, patterns in PATTERNS.items()}
+
+
+def extract(text):
+    """``{field: value}`` for the ``extracted_data`` fields found in ``text``."""
+    found = {}
+    for field, patterns in _COMPILED.items():
+        for pattern in patterns:
+            match = pattern.search(text)
+            if match:
+                found[field] = ' '.join(match.group(1).split())
+                break
+    return found
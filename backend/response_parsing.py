@@ -0,0 +1,197 @@
+"""Tolerant parsing of JSON returned by Gemini.
+
+Models wrap JSON in markdown fences, add commentary around it, or emit
+near-JSON: trailing commas, single-quoted strings, raw newlines inside
+strings, Python literals, or output cut off mid-array. ``parse_json_response``
+strips fences properly (as a prefix, unlike ``lstrip('```json')``), extracts
+the outermost object and repairs those defects locally, so a second model call
+is only needed when the text is beyond repair.
+"""
+import json
+import re
+
+NOT_FOUND = 'Not Found'
+
+# Lease analysis schema (see llm.analyze_lease)
+LEASE_EXTRACTED_FIELDS = (
+    'Landlord_Name', 'Tenant_Name', 'Property_Address', 'Lease_Start_Date', 'Lease_End_Date',
+    'Monthly_Rent_Amount', 'Rent_Due_Date', 'Security_Deposit_Amount', 'Lease_Term',
+)
+LEASE_CLAUSE_FIELDS = (
+    'Termination_Clause', 'Pet_Policy', 'Subletting_Policy', 'Maintenance_Responsibilities',
+    'Late_Fee_Policy', 'Renewal_Options',
+)
+
+_FENCE_RE = re.compile(r'^\s*```[a-zA-Z]*\s*\n?|\n?\s*```\s*$')
+_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+
+class ResponseParseError(ValueError):
+    """The response contained no JSON object that could be repaired."""
+
+
+def strip_fences(text):
+    return _FENCE_RE.sub('', text.strip())
+
+
+def extract_json_object(text):
+    """The outermost ``{...}`` in ``text``; runs to the end if it is never closed."""
+    start = text.find('{')
+    if start == -1:
+        raise ResponseParseError('No JSON object in response')
+    depth, in_string, quote, escaped = 0, False, None, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                in_string = False
+        elif ch in '"\'':
+            in_string, quote = True, ch
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def _strip_trailing_comma(out):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+
+def repair_json(text):
+    """Fix common near-JSON defects; the result may still be invalid."""
+    out = []
+    stack = []
+    in_string, quote, escaped = False, None, False
+    previous = ''  # last significant character outside strings
+    key_start = None  # where in ``out`` the most recent object key began
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                out.append(ch)
+                escaped = False
+            elif ch == '\\':
+                out.append(ch)
+                escaped = True
+            elif ch == quote:
+                out.append('"')
+                in_string = False
+                previous = '"'
+            elif ch == '"':  # double quote inside a single-quoted string
+                out.append('\\"')
+            elif ch == '\n':
+                out.append('\\n')
+            elif ch == '\r':
+                out.append('\\r')
+            elif ch == '\t':
+                out.append('\\t')
+            else:
+                out.append(ch)
+        elif ch in '"\'':
+            if stack and stack[-1] == '}' and previous in '{,':
+                key_start = len(out)
+            in_string, quote = True, ch
+            out.append('"')
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+            previous = ch
+        elif ch in '}]':
+            _strip_trailing_comma(out)
+            if stack:
+                stack.pop()
+            out.append(ch)
+            previous = ch
+        elif ch.isalpha():
+            j = i
+            while j < len(text) and text[j].isalnum():
+                j += 1
+            word = text[i:j]
+            out.append(_LITERALS.get(word, word))
+            previous = word[-1]
+            i = j
+            continue
+        else:
+            out.append(ch)
+            if not ch.isspace():
+                previous = ch
+        i += 1
+
+    # Close whatever a truncated response left open
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    if stack:
+        if key_start is not None and _DANGLING_KEY_RE.match(''.join(out[key_start:])):
+            # An object key that never got its value
+            del out[key_start:]
+        _strip_trailing_comma(out)
+        if out and out[-1] == ':':
+            out.pop()
+        out.extend(reversed(stack))
+    return ''.join(out)
+
+
+_DANGLING_KEY_RE = re.compile(r'^"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+
+def parse_json_response(text):
+    """Parse a model response into a dict, repairing it locally if needed."""
+    if not text or not text.strip():
+        raise ResponseParseError('Empty response')
+    candidate = strip_fences(text)
+    try:
+        value = json.loads(candidate)
+        if isinstance(value, dict):
+            return value
+    except json.JSONDecodeError:
+        pass
+    candidate = extract_json_object(candidate)
+    for attempt in (candidate, repair_json(candidate)):
+        try:
+            value = json.loads(attempt)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, dict):
+            return value
+    raise ResponseParseError('Response is not repairable JSON')
+
+
+def normalize_lease_analysis(data):
+    """Conform a parsed lease analysis to the schema, filling gaps with "Not Found"."""
+    for key, fields in (('extracted_data', LEASE_EXTRACTED_FIELDS),
+                        ('clause_summaries', LEASE_CLAUSE_FIELDS)):
+        section = data.get(key)
+        if not isinstance(section, dict):
+            section = {}
+        for field in fields:
+            if section.get(field) in (None, ''):
+                section[field] = NOT_FOUND
+        data[key] = section
+
+    risks = data.get('risks')
+    if isinstance(risks, str):
+        risks = [risks]
+    data['risks'] = [str(risk) for risk in risks] if isinstance(risks, list) else []
+
+    try:
+        data['score'] = max(0, min(100, int(round(float(data.get('score'))))))
+    except (TypeError, ValueError):
+        data['score'] = NOT_FOUND
+    return data
+
+
+def parse_lease_analysis(text):
+    return normalize_lease_analysis(parse_json_response(text))
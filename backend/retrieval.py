@@ -0,0 +1,211 @@
+"""Per-user BM25 retrieval over previously analysed leases, for chat grounding.
+
+Each lease in the ``leases`` collection contributes clause-level passages
+taken from its stored analysis: one per clause summary, one per risk, and one
+with the key terms (parties, dates, rent, deposit). They are indexed with
+BM25 on local CPU and the inverted index is written to
+``RETRIEVAL_INDEX_DIR``, one gzipped JSON file per user.
+
+The index is keyed by a signature of the user's lease IDs and creation times,
+read with a field-masked query. It is rebuilt only when a lease is added or
+removed; otherwise it is loaded from memory or disk. A chat request with
+``use_portfolio`` sends the top ``RETRIEVAL_TOP_K`` passages instead of whole
+documents, so the prompt size doesn't grow with the portfolio.
+"""
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_INDEX_DIR = os.environ.get('RETRIEVAL_INDEX_DIR') or os.path.join(tempfile.gettempdir(), 'leaseshield-retrieval')
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', 8))
+RETRIEVAL_MAX_PASSAGE_CHARS = 1200
+RETRIEVAL_MEMORY_INDEXES = 32
+INDEX_VERSION = 1
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+NOT_FOUND = 'Not Found'
+KEY_TERM_FIELDS = ('Landlord_Name', 'Tenant_Name', 'Property_Address', 'Lease_Start_Date', 'Lease_End_Date',
+                   'Monthly_Rent_Amount', 'Rent_Due_Date', 'Security_Deposit_Amount', 'Lease_Term')
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how i if in is it its my of on or our shall
+that the their them there these this to was what when where which who will with would you your
+""".split())
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        # Light plural folding: "fees" matches "fee", "pets" matches "pet"
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def _label(field):
+    return field.replace('_', ' ')
+
+
+def lease_passages(lease_id, lease):
+    """Clause-level passages for one ``leases`` document."""
+    analysis = lease.get('analysis') or {}
+    file_name = lease.get('fileName') or 'Lease'
+    passages = []
+
+    def add(section, text):
+        text = str(text).strip()
+        if text and text != NOT_FOUND:
+            passages.append({'leaseId': lease_id, 'fileName': file_name, 'section': section,
+                             'text': text[:RETRIEVAL_MAX_PASSAGE_CHARS]})
+
+    extracted = analysis.get('extracted_data') or {}
+    terms = '; '.join(f"{_label(field)}: {extracted[field]}" for field in KEY_TERM_FIELDS
+                      if extracted.get(field) not in (None, '', NOT_FOUND))
+    add('Key terms', terms)
+    for field, summary in (analysis.get('clause_summaries') or {}).items():
+        add(_label(field), summary)
+    for risk in analysis.get('risks') or []:
+        add('Risk', risk)
+    return passages
+
+
+class BM25Index:
+    def __init__(self, passages, postings, lengths, signature=None):
+        self.passages = passages
+        self.postings = postings  # term -> [[passage index, term frequency], ...]
+        self.lengths = lengths
+        self.signature = signature
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, passages, signature=None):
+        postings = collections.defaultdict(list)
+        lengths = []
+        for i, passage in enumerate(passages):
+            tokens = tokenize(f"{passage['section']} {passage['text']}")
+            lengths.append(len(tokens))
+            for term, count in collections.Counter(tokens).items():
+                postings[term].append([i, count])
+        return cls(passages, dict(postings), lengths, signature)
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        """Top ``k`` passages for ``query`` as ``(score, passage)``, best first."""
+        n = len(self.passages)
+        scores = collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / (self.avg_length or 1))
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [(round(score, 4), self.passages[i]) for i, score in best]
+
+    def to_dict(self):
+        return {'version': INDEX_VERSION, 'signature': self.signature, 'passages': self.passages,
+                'postings': self.postings, 'lengths': self.lengths}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['passages'], data['postings'], data['lengths'], data.get('signature'))
+
+
+# --- Storage ---
+
+def _index_path(user_id):
+    name = hashlib.sha256(user_id.encode('utf-8')).hexdigest()
+    return os.path.join(RETRIEVAL_INDEX_DIR, f'{name}.json.gz')
+
+
+def save_index(user_id, index):
+    os.makedirs(RETRIEVAL_INDEX_DIR, exist_ok=True)
+    path = _index_path(user_id)
+    fd, tmp_path = tempfile.mkstemp(dir=RETRIEVAL_INDEX_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(gzip.compress(json.dumps(index.to_dict(), separators=(',', ':')).encode('utf-8')))
+        os.replace(tmp_path, path)  # atomic, so concurrent readers never see half a file
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_index(user_id):
+    try:
+        with open(_index_path(user_id), 'rb') as f:
+            data = json.loads(gzip.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.info(f"Ignoring unreadable retrieval index for {user_id}: {e}")
+        return None
+    if data.get('version') != INDEX_VERSION:
+        return None
+    return BM25Index.from_dict(data)
+
+
+_memory = collections.OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def _remember(user_id, index):
+    with _memory_lock:
+        _memory[user_id] = index
+        _memory.move_to_end(user_id)
+        while len(_memory) > RETRIEVAL_MEMORY_INDEXES:
+            _memory.popitem(last=False)
+
+
+def signature(lease_stamps):
+    """Fingerprint of a user's leases from ``(lease_id, created_at)`` pairs."""
+    digest = hashlib.sha256()
+    for lease_id, created_at in sorted(lease_stamps):
+        digest.update(f"{lease_id}:{created_at}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def index_for_user(db, user_id):
+    """The user's index, rebuilt from Firestore only if their leases changed."""
+    leases = db.collection('leases').where('userId', '==', user_id)
+    stamps = [(doc.id, (doc.to_dict() or {}).get('createdAt')) for doc in leases.select(['createdAt']).stream()]
+    current = signature(stamps)
+
+    with _memory_lock:
+        index = _memory.get(user_id)
+    if index is None or index.signature != current:
+        index = load_index(user_id)
+    if index is None or index.signature != current:
+        passages = []
+        for doc in leases.stream():
+            passages.extend(lease_passages(doc.id, doc.to_dict() or {}))
+        index = BM25Index.build(passages, signature=current)
+        logger.info(f"Built retrieval index for {user_id}: {len(stamps)} leases, {len(passages)} passages")
+        try:
+            save_index(user_id, index)
+        except Exception as e:
+            logger.info(f"Could not save retrieval index for {user_id}: {e}")
+    _remember(user_id, index)
+    return index
+
+
+def format_passages(hits):
+    """Prompt text for retrieved passages."""
+    lines = [f"[{passage['fileName']} - {passage['section']}] {passage['text']}" for _, passage in hits]
+    return "--- Relevant clauses from your analysed leases ---\n" + '\n'.join(lines)
@@ -7,12 +7,14 @@ CLAUSE_FILE = Path(__file__).with_name('clause_library.yaml')
 with CLAUSE_FILE.open('r', encoding='utf-8') as f:
     CLAUSES = yaml.safe_load(f).get('clauses', [])
 
+# Compiled once per process rather than on every call
+PATTERNS = [(clause, re.compile(clause['pattern'], re.IGNORECASE)) for clause in CLAUSES]
+
 
 def analyze_text(text: str):
     """Return list of clause matches for given text."""
     results = []
-    for clause in CLAUSES:
-        pattern = re.compile(clause['pattern'], re.IGNORECASE)
+    for clause, pattern in PATTERNS:
         match = bool(pattern.search(text))
         results.append({
             'id': clause['id'],
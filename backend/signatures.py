@@ -0,0 +1,12 @@
+"""HMAC-SHA256 request signing shared by inbound webhooks and outbound callbacks."""
+import hashlib
+import hmac
+
+
+def sign(payload: bytes, secret: str) -> str:
+    """Hex HMAC-SHA256 of ``payload``, the scheme Maxelpay uses for its webhooks."""
+    return hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+
+
+def verify(payload: bytes, signature, secret: str) -> bool:
+    return hmac.compare_digest(sign(payload, secret), signature or '')
@@ -0,0 +1,111 @@
+"""Cross-process single-flight for identical analysis requests.
+
+A double-clicked upload or a frontend retry sends the same document twice
+while the first analysis is still running. Requests are keyed by user and a
+SHA-256 of the uploaded content; the first one claims the key in Redis and does
+the work, later ones attach to it:
+
+* async submissions attach to the leader's RQ job (``claim_job``);
+* synchronous requests wait for the leader's published result (``run``).
+
+Redis errors never block a request: the caller just does the work itself.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_LEASE_SECONDS = int(os.environ.get('SINGLEFLIGHT_LEASE_SECONDS', 300))
+SINGLEFLIGHT_RESULT_TTL_SECONDS = int(os.environ.get('SINGLEFLIGHT_RESULT_TTL_SECONDS', 120))
+POLL_INTERVAL_SECONDS = 0.25
+HASH_CHUNK_SIZE = 1 << 16
+
+
+def hash_stream(stream):
+    """SHA-256 of a seekable stream, read in chunks; the stream is rewound."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def flight_key(kind, user_id, content_hash):
+    return f'singleflight:{kind}:{user_id}:{content_hash}'
+
+
+def _result_key(key):
+    return f'{key}:result'
+
+
+def claim_job(redis_conn, key, job_id, ttl=SINGLEFLIGHT_LEASE_SECONDS):
+    """Claim ``key`` for ``job_id``. Returns the job ID that owns the flight."""
+    if redis_conn.set(key, job_id, nx=True, ex=ttl):
+        return job_id
+    owner = redis_conn.get(key)
+    if owner is None:
+        # Expired between SET and GET; take it over
+        redis_conn.set(key, job_id, ex=ttl)
+        return job_id
+    return owner.decode('utf-8') if isinstance(owner, bytes) else owner
+
+
+def replace_job(redis_conn, key, job_id, ttl=SINGLEFLIGHT_LEASE_SECONDS):
+    """Point the flight at a new job after the previous one failed or expired."""
+    redis_conn.set(key, job_id, ex=ttl)
+
+
+def _release(redis_conn, key, token):
+    owner = redis_conn.get(key)
+    if owner is not None and (owner.decode('utf-8') if isinstance(owner, bytes) else owner) == token:
+        redis_conn.delete(key)
+
+
+def run(redis_conn, key, fn):
+    """Call ``fn()`` once per ``key`` across processes and share its result.
+
+    Returns ``(result, led)``; ``led`` is False when the result came from
+    another request. ``fn`` must return a JSON-serialisable value, or None on
+    failure, in which case nothing is shared and a waiting request takes over.
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + SINGLEFLIGHT_LEASE_SECONDS
+    try:
+        while True:
+            cached = redis_conn.get(_result_key(key))
+            if cached is not None:
+                return json.loads(cached), False
+            if redis_conn.set(key, token, nx=True, ex=SINGLEFLIGHT_LEASE_SECONDS):
+                break
+            if time.monotonic() >= deadline:
+                logger.warning(f"Gave up waiting on in-flight analysis {key}; running it again")
+                token = None
+                break
+            time.sleep(POLL_INTERVAL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Single-flight unavailable, running without coalescing: {e}")
+        return fn(), True
+    if token is None:
+        return fn(), True
+
+    try:
+        result = fn()
+        if result is not None:
+            try:
+                redis_conn.set(_result_key(key), json.dumps(result), ex=SINGLEFLIGHT_RESULT_TTL_SECONDS)
+            except Exception as e:
+                logger.warning(f"Failed to share result of {key}: {e}")
+        return result, True
+    finally:
+        try:
+            _release(redis_conn, key, token)
+        except Exception as e:
+            logger.warning(f"Failed to release single-flight key {key}: {e}")
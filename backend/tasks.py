@@ -1,62 +1,205 @@
-import io
-import time
+"""RQ job functions. Imported only by worker processes (see worker.py)."""
 import hashlib
-from redis import Redis
-from rq import Queue, get_current_job
+import logging
+import os
+import time
+from rq import get_current_job
 import fitz  # PyMuPDF
-import pdfplumber
-try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
-except Exception:  # pragma: no cover
-    convert_from_bytes = None
-    pytesseract = None
 
+import callbacks
+import checkpoints
+import extraction
+import job_results
+import llm_executor
+import llm_guard
+import ocr
 import rules
+from analysis import analyze_lease_text, record_scan, save_lease
+from persistence import write_behind, write_now
+from profiles import get_fresh_user_profile, get_or_create_user_profile, scan_limit_error
 
-redis_conn = Redis(host='localhost', port=6379, decode_responses=False)
-queue = Queue('analysis', connection=redis_conn)
+logger = logging.getLogger(__name__)
 
+# Time budget for all Gemini calls of one job's llm stage; kept under ANALYSIS_JOB_TIMEOUT
+LLM_JOB_BUDGET_SECONDS = float(os.environ.get('LLM_JOB_BUDGET_SECONDS', 600))
+# How long a job's Gemini calls wait for an admission slot before the job
+# fails into RQ's retry backoff (queues.RETRY_INTERVALS)
+LLM_JOB_ADMISSION_WAIT_SECONDS = float(os.environ.get('LLM_JOB_ADMISSION_WAIT_SECONDS', 120))
 
-def parse_pdf(data: bytes) -> str:
-    """Parse PDF bytes using PyMuPDF, fall back to pdfplumber then Tesseract."""
-    # PyMuPDF
-    try:
-        doc = fitz.open(stream=data, filetype='pdf')
-        text = ''.join(page.get_text() for page in doc)
-        if text.strip():
-            return text
-    except Exception:
-        pass
-    # pdfplumber
-    try:
-        with pdfplumber.open(io.BytesIO(data)) as pdf:
-            text = ''.join(page.extract_text() or '' for page in pdf.pages)
-            if text.strip():
-                return text
-    except Exception:
-        pass
-    # Tesseract
-    if convert_from_bytes and pytesseract:
+
+def parse_pdf(data: bytes, should_cancel=None, ocr_stats=None) -> str:
+    """Extract a PDF's text (text layer, OCR where pages need it) or raise ValueError."""
+    text = extraction.extract_text(data, should_cancel=should_cancel, ocr_stats=ocr_stats)
+    if text is None:
+        raise ValueError('Unable to parse PDF')
+    return text
+
+
+def warm_up():
+    """Exercise PyMuPDF and Tesseract once so a long-lived worker starts its first job warm.
+
+    The clause patterns are compiled when ``rules`` is imported.
+    """
+    doc = fitz.open()
+    doc.new_page()
+    blank = doc.tobytes()
+    ''.join(page.get_text() for page in fitz.open(stream=blank, filetype='pdf'))
+    if ocr.OCR_AVAILABLE:
         try:
-            images = convert_from_bytes(data)
-            text = ''.join(pytesseract.image_to_string(img) for img in images)
-            if text.strip():
-                return text
-        except Exception:
-            pass
-    raise ValueError('Unable to parse PDF')
+            logger.info(f"Tesseract {ocr.pytesseract.get_tesseract_version()} available for OCR")
+        except Exception as e:
+            logger.warning(f"Tesseract not usable, OCR fallback disabled: {e}")
 
 
-def analyze(pdf_bytes: bytes):
+def analyze(pdf_bytes: bytes = None, user_id=None, tier=None, should_increment=False,
+            file_name='Uploaded File', text=None, callback_url=None, previous_lease_id=None):
+    """Analysis job.
+
+    With a ``user_id`` this runs the same stages as the synchronous
+    /api/analyze path (extraction, Gemini, compliance, scan counting and
+    persistence); without one it only runs the rule engine, as before. When a
+    ``callback_url`` is given the outcome is POSTed there (see callbacks.py).
+    """
     job = get_current_job()
-    job.meta['progress'] = 10
+    try:
+        result = _run_analysis(job, pdf_bytes, user_id, tier, should_increment, file_name, text,
+                               previous_lease_id)
+    except QuotaExceeded as e:
+        # A final answer, not a failure to retry: served to the client as a 429
+        logger.info(f"Job {job.id} for user {user_id}: {e}")
+        job_results.store(job.connection, job.id, e.body, user_id=user_id, status=429)
+        if callback_url:
+            callbacks.schedule(job.id, user_id, callback_url, dict(e.body, status='failed'))
+        return {'quotaExceeded': True}
+    except (ocr.OCRCancelled, JobCancelled) as e:
+        # Stopped on purpose: don't let RQ retry it, and give pollers a final answer
+        logger.info(f"Job {job.id}: {e}")
+        job_results.store(job.connection, job.id, {'status': 'cancelled'}, user_id=user_id, status=410)
+        return {'cancelled': True}
+    except Exception as e:
+        # Only report failure once RQ has no retries left for this job
+        if callback_url and not job.retries_left:
+            callbacks.schedule(job.id, user_id, callback_url, {'status': 'failed', 'error': str(e)})
+        raise
+    finally:
+        _stop_requested.discard(job.id)
+
+    if callback_url:
+        callbacks.schedule(job.id, user_id, callback_url, {'status': 'finished', 'result': result})
+    return {'hash': result['hash'], 'leaseId': result.get('leaseId')}
+
+
+class JobCancelled(Exception):
+    """The job was stopped between stages."""
+
+
+class QuotaExceeded(Exception):
+    """The user's scan limit was used up between submission and the llm stage."""
+
+    def __init__(self, body):
+        super().__init__(body['error'])
+        self.body = body
+
+
+# Jobs a warm worker was told to stop (worker.WarmWorker): they run in the
+# worker's own process, so there is no work-horse to kill
+_stop_requested = set()
+
+
+def request_stop(job_id):
+    """Have the job running in this process stop at its next cancellation check."""
+    _stop_requested.add(job_id)
+
+
+def _cancel_requested(job):
+    return job.id in _stop_requested or job.get_status(refresh=True) in ('stopped', 'canceled')
+
+
+STAGES = ('extract', 'clauses', 'llm', 'persist')
+
+
+def _run_stage(job, input_hash, name, progress, fn):
+    """Run one checkpointed stage, or load its output if an earlier attempt finished it."""
+    if _cancel_requested(job):
+        raise JobCancelled(f"stopped before stage '{name}'")
+    found, value = checkpoints.load(job.connection, job.id, input_hash, name)
+    if found:
+        job.meta.setdefault('resumed_stages', []).append(name)
+        logger.info(f"Job {job.id}: resuming past stage '{name}'")
+    else:
+        started = time.monotonic()
+        value = fn()
+        checkpoints.save(job.connection, job.id, input_hash, name, value)
+        job.meta.setdefault('stage_timings', {})[name] = round(time.monotonic() - started, 3)
+    job.meta['stage'] = name
+    job.meta['progress'] = progress
     job.save_meta()
-    text = parse_pdf(pdf_bytes)
-    job.meta['progress'] = 70
+    return value
+
+
+def _run_analysis(job, pdf_bytes, user_id, tier, should_increment, file_name, text, previous_lease_id=None):
+    input_hash = hashlib.sha256(pdf_bytes if text is None else text.encode('utf-8')).hexdigest()
+    if 'leaseId' not in job.meta:
+        # Fixed up front so a retried persist stage overwrites the same lease doc
+        job.meta['leaseId'] = write_behind.new_document_id('leases') if user_id is not None else None
+    job.meta['progress'] = 10
     job.save_meta()
-    clause_results = rules.analyze_text(text)
+
+    ocr_stats = ocr.new_stats()
+    text = _run_stage(job, input_hash, 'extract', 30,
+                      lambda: text if text is not None else parse_pdf(
+                          pdf_bytes, should_cancel=lambda: _cancel_requested(job),
+                          ocr_stats=ocr_stats))
+    if ocr_stats['pages']:
+        job.meta['ocr'] = dict(ocr_stats, hitRate=ocr.hit_rate(ocr_stats))
+        job.save_meta()
+    clause_results = _run_stage(job, input_hash, 'clauses', 40, lambda: rules.analyze_text(text))
     text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    result = {'hash': text_hash, 'clauses': clause_results}
+
+    if user_id is not None:
+        def llm_stage():
+            if should_increment:
+                # The web process checked quota at submission, but other scans
+                # may have used it up while this job was queued
+                user_profile = get_fresh_user_profile(user_id)
+                if user_profile is None:
+                    raise RuntimeError('Could not read user profile for the quota check')
+                quota_error = scan_limit_error(user_profile, tier)
+                if quota_error:
+                    raise QuotaExceeded(quota_error)
+            else:
+                user_profile = get_or_create_user_profile(user_id) or {}
+            with llm_executor.budget(LLM_JOB_BUDGET_SECONDS), llm_guard.patient(LLM_JOB_ADMISSION_WAIT_SECONDS):
+                result_data = analyze_lease_text(text, user_id, tier, user_profile, file_name=file_name,
+                                                 previous_lease_id=previous_lease_id)
+            if result_data is None:
+                # Raising lets RQ's retry policy take another attempt
+                raise RuntimeError('AI analysis failed')
+            return result_data
+
+        def persist_stage():
+            lease_id = save_lease(user_id, file_name, result_data, write_now,
+                                  lease_id=job.meta['leaseId'], text=text)
+            record_scan(user_id, tier, should_increment)
+            return lease_id
+
+        result_data = _run_stage(job, input_hash, 'llm', 85, llm_stage)
+        lease_id = _run_stage(job, input_hash, 'persist', 95, persist_stage)
+        result.update({'leaseId': lease_id, 'analysis': result_data})
+        if 'coverage' in result_data:
+            result['coverage'] = result_data['coverage']
+
+    # The full result goes to compressed storage and Firestore; RQ only keeps
+    # a small summary instead of a pickled blob for result_ttl.
+    job_results.store(job.connection, job.id, result, user_id=user_id)
+    if user_id is not None:
+        try:
+            job_results.persist(write_now, job.id, user_id, result)
+        except Exception as e:
+            logger.error(f"Failed to persist result of job {job.id}: {e}")
+    checkpoints.clear(job.connection, job.id, input_hash, STAGES)
+
     job.meta['progress'] = 100
     job.save_meta()
-    return {'hash': text_hash, 'clauses': clause_results}
+    return result
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+import callbacks
+import signatures
+
+
+def test_validate_callback_url():
+    assert callbacks.validate_callback_url('https://pm.example.com/hooks/leaseshield') is None
+    assert callbacks.validate_callback_url('http://pm.example.com/hook') is not None
+    assert callbacks.validate_callback_url('https://localhost/hook') is not None
+    assert callbacks.validate_callback_url('https://10.0.0.5/hook') is not None
+    assert callbacks.validate_callback_url('https://169.254.169.254/latest') is not None
+    assert callbacks.validate_callback_url(None) is not None
+
+
+def test_retry_delay_is_capped():
+    assert callbacks.retry_delay(1) == callbacks.CALLBACK_BASE_DELAY_SECONDS
+    assert callbacks.retry_delay(2) == 2 * callbacks.CALLBACK_BASE_DELAY_SECONDS
+    assert callbacks.retry_delay(50) == callbacks.CALLBACK_MAX_DELAY_SECONDS
+
+
+class FakeQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def enqueue_in(self, delay, func, *args, **kwargs):
+        self.scheduled.append((delay.total_seconds(), func, args, kwargs))
+
+
+def test_deliver_signs_and_reschedules(monkeypatch):
+    pytest.importorskip('requests')
+    queue = FakeQueue()
+    posted = []
+
+    class Reply:
+        status_code = 503
+
+    def fake_post(url, body, headers):
+        posted.append((body, headers))
+        return Reply()
+
+    monkeypatch.setattr(callbacks, 'CALLBACK_SIGNING_SECRET', 'shh')
+    monkeypatch.setattr(callbacks.queues, 'get_queue', lambda: queue)
+    monkeypatch.setattr(callbacks, '_post', fake_post)
+
+    assert callbacks.deliver('job-1', 'user-1', 'https://example.com/cb', {'status': 'finished'}) is False
+    body, headers = posted[0]
+    assert signatures.verify(body, headers['X-LeaseShield-Signature'], 'shh')
+    assert json.loads(body)['jobId'] == 'job-1'
+    delay, func, _, kwargs = queue.scheduled[0]
+    assert (delay, func, kwargs['attempt']) == (callbacks.retry_delay(1), 'callbacks.deliver', 2)
+
+
+def test_deliver_dead_letters_permanent_failures(monkeypatch):
+    pytest.importorskip('requests')
+    queue = FakeQueue()
+    dead = []
+
+    class Reply:
+        status_code = 410
+
+    monkeypatch.setattr(callbacks.queues, 'get_queue', lambda: queue)
+    monkeypatch.setattr(callbacks, '_post', lambda *args: Reply())
+    monkeypatch.setattr(callbacks, 'dead_letter', lambda *args: dead.append(args))
+
+    callbacks.deliver('job-2', 'user-1', 'https://example.com/cb', {'status': 'failed'})
+    assert not queue.scheduled
+    assert dead[0][0] == 'job-2' and dead[0][5] == 'HTTP 410'
+
+
+def fake_dns(monkeypatch, *addresses):
+    infos = [(None, None, None, '', (address, 443)) for address in addresses]
+    monkeypatch.setattr(callbacks.socket, 'getaddrinfo', lambda host, port, **kwargs: infos)
+
+
+def test_delivery_address_must_be_public(monkeypatch):
+    fake_dns(monkeypatch, '93.184.216.34')
+    assert str(callbacks.resolve_public_address('pm.example.com', 443)) == '93.184.216.34'
+    # A public name that now resolves (even partly) to an internal address is refused
+    for internal in ('10.0.0.5', '127.0.0.1', '169.254.169.254', '::1', 'fd00::1'):
+        fake_dns(monkeypatch, '93.184.216.34', internal)
+        with pytest.raises(callbacks.UnsafeCallbackHost):
+            callbacks.resolve_public_address('pm.example.com', 443)
+
+
+def test_rebound_host_is_dead_lettered_without_retry(monkeypatch):
+    pytest.importorskip('requests')
+    queue = FakeQueue()
+    dead = []
+    fake_dns(monkeypatch, '10.0.0.5')
+    monkeypatch.setattr(callbacks.queues, 'get_queue', lambda: queue)
+    monkeypatch.setattr(callbacks, 'dead_letter', lambda *args: dead.append(args))
+
+    callbacks.deliver('job-3', 'user-1', 'https://example.com/cb', {'status': 'finished'})
+    assert not queue.scheduled
+    assert 'non-public' in dead[0][5]
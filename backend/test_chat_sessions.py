@@ -0,0 +1,49 @@
+import pytest
+
+import chat_sessions
+
+
+def test_session_round_trip_and_ownership(fake_redis):
+    session = chat_sessions.new_session('user-1', key_index=2)
+    chat_sessions.add_document(session, 'lease.pdf', 'The rent is $1,000.')
+    chat_sessions.save(fake_redis, session)
+
+    loaded = chat_sessions.load(fake_redis, session['id'], 'user-1')
+    assert loaded['documents'][0]['text'] == 'The rent is $1,000.'
+    assert loaded['keyIndex'] == 2
+    with pytest.raises(chat_sessions.SessionNotFound):
+        chat_sessions.load(fake_redis, session['id'], 'user-2')
+    chat_sessions.delete(fake_redis, session['id'])
+    with pytest.raises(chat_sessions.SessionNotFound):
+        chat_sessions.load(fake_redis, session['id'], 'user-1')
+
+
+def test_documents_are_added_once_and_within_budget(monkeypatch):
+    monkeypatch.setattr(chat_sessions, 'CHAT_SESSION_MAX_DOCUMENT_CHARS', 30)
+    session = chat_sessions.new_session('user-1')
+    assert chat_sessions.add_document(session, 'a.pdf', 'first document text')
+    assert not chat_sessions.add_document(session, 'again.pdf', 'first document text')
+    assert not chat_sessions.add_document(session, 'b.pdf', 'a second, longer document')
+    assert [doc['name'] for doc in session['documents']] == ['a.pdf']
+
+
+def test_prefix_is_stable_across_turns():
+    session = chat_sessions.new_session('user-1')
+    chat_sessions.add_document(session, 'lease.pdf', 'The rent is $1,000.')
+    first = chat_sessions.build_prompt(session, 'What is the rent?')
+    chat_sessions.add_turn(session, 'What is the rent?', '$1,000 a month.')
+    second = chat_sessions.build_prompt(session, 'And the deposit?', [{'mime_type': 'image/png', 'data': b''}])
+
+    # The second turn's prefix extends the first turn's, so the cached part is reused
+    assert second[0].startswith(first[0])
+    assert 'The rent is $1,000.' in second[0] and '$1,000 a month.' in second[0]
+    assert second[1].endswith('And the deposit?')
+    assert second[2]['mime_type'] == 'image/png'
+
+
+def test_old_turns_are_dropped(monkeypatch):
+    monkeypatch.setattr(chat_sessions, 'CHAT_SESSION_MAX_TURNS', 2)
+    session = chat_sessions.new_session('user-1')
+    for i in range(3):
+        chat_sessions.add_turn(session, f'q{i}', f'a{i}')
+    assert [turn['user'] for turn in session['turns']] == ['q1', 'q2']
@@ -0,0 +1,16 @@
+import checkpoints
+
+
+def test_checkpoint_round_trip_and_clear(fake_redis):
+    assert checkpoints.load(fake_redis, 'job-1', 'abc', 'extract') == (False, None)
+
+    checkpoints.save(fake_redis, 'job-1', 'abc', 'extract', 'lease text')
+    checkpoints.save(fake_redis, 'job-1', 'abc', 'persist', None)
+    assert checkpoints.load(fake_redis, 'job-1', 'abc', 'extract') == (True, 'lease text')
+    # A stage whose output is None still counts as done
+    assert checkpoints.load(fake_redis, 'job-1', 'abc', 'persist') == (True, None)
+    # Different input under the same job ID does not resume
+    assert checkpoints.load(fake_redis, 'job-1', 'other', 'extract') == (False, None)
+
+    checkpoints.clear(fake_redis, 'job-1', 'abc', ('extract', 'persist'))
+    assert not fake_redis.data
@@ -0,0 +1,96 @@
+import pytest
+
+import chunking
+
+
+LEASE = ''.join(
+    f"Section {n}. Heading {n}\n" + f"Clause text for section {n}. " * 40 + "\n\n"
+    for n in range(1, 21)
+)
+
+
+def test_split_sections_respects_limit_and_boundaries():
+    chunks = chunking.split_sections(LEASE, max_chars=3000)
+    assert ''.join(chunks) == LEASE
+    assert all(len(chunk) <= 3000 for chunk in chunks)
+    assert all(chunk.startswith('Section ') for chunk in chunks)
+
+
+def test_split_sections_breaks_oversized_sections():
+    text = 'Section 1. ' + 'word. ' * 2000
+    chunks = chunking.split_sections(text, max_chars=1000)
+    assert ''.join(chunks) == text
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+
+
+def test_merge_results_is_deterministic():
+    first = {
+        'extracted_data': {'Tenant_Name': 'Not Found', 'Monthly_Rent_Amount': '$2,000'},
+        'clause_summaries': {'Pet_Policy': 'No pets.'},
+        'risks': ['Landlord may enter without notice'],
+        'score': 40,
+    }
+    second = {
+        'extracted_data': {'Tenant_Name': 'J. Doe', 'Monthly_Rent_Amount': '$9,999'},
+        'clause_summaries': {'Pet_Policy': 'Cats allowed.', 'Renewal_Options': 'Not Found'},
+        'risks': ['landlord may enter  without notice', 'Automatic renewal'],
+        'score': 80,
+    }
+    merged = chunking.merge_results([first, None, second], [1000, 500, 3000])
+    assert merged['extracted_data'] == {'Tenant_Name': 'J. Doe', 'Monthly_Rent_Amount': '$2,000'}
+    assert merged['clause_summaries'] == {'Pet_Policy': 'No pets.', 'Renewal_Options': 'Not Found'}
+    assert merged['risks'] == ['Landlord may enter without notice', 'Automatic renewal']
+    assert merged['score'] == 70  # (40 * 1000 + 80 * 3000) / 4000
+
+
+def test_analyze_chunked_skips_failed_chunks():
+    def analyze_chunk(chunk, index, count):
+        if index == 1:
+            raise RuntimeError('Gemini unavailable')
+        return {'extracted_data': {}, 'clause_summaries': {}, 'risks': [f'risk {index}'], 'score': 50}
+
+    merged = chunking.analyze_chunked(LEASE, analyze_chunk, max_chars=3000)
+    assert merged['chunking']['failed'] == 1
+    assert merged['score'] == 50
+    assert 'risk 1' not in merged['risks']
+    assert merged['coverage']['complete'] is False
+    assert merged['coverage']['missingParts'] == [1]
+    assert 0.8 < merged['coverage']['analyzedShare'] < 1
+    assert chunking.analyze_chunked(LEASE, lambda *a: None, max_chars=3000) is None
+
+
+def test_analyze_chunked_fails_when_too_many_chunks_failed():
+    def analyze_chunk(chunk, index, count):
+        if index <= 3:
+            return None
+        return {'extracted_data': {}, 'clause_summaries': {}, 'risks': [], 'score': 80}
+
+    # 3 of 10 chunks missing is over the 25% share
+    assert chunking.analyze_chunked(LEASE, analyze_chunk, max_chars=3000) is None
+    complete = chunking.analyze_chunked(LEASE, lambda chunk, index, count: analyze_chunk(chunk, 10, count),
+                                        max_chars=3000)
+    assert complete['coverage'] == {'complete': True, 'analyzedShare': 1.0, 'missingParts': []}
+
+
+def test_split_clauses_joins_bare_headings():
+    text = "ARTICLE 4 - RENT\n" + "4.1. Rent is due monthly on the first day and is payable by bank transfer only.\n" \
+        + "4.2. A late fee of $50 applies to any rent paid more than five days after the due date.\n"
+    clauses = chunking.split_clauses(text, max_chars=4000, min_chars=40)
+    assert ''.join(clauses) == text
+    assert len(clauses) == 2
+    assert clauses[0].startswith('ARTICLE 4') and '4.1' in clauses[0]
+
+
+def test_too_many_chunks_are_rejected(monkeypatch):
+    monkeypatch.setattr(chunking, 'LEASE_MAX_CHUNKS', 2)
+    calls = []
+    with pytest.raises(chunking.DocumentTooLong):
+        chunking.check_length(LEASE, max_chars=1000)
+    with pytest.raises(chunking.DocumentTooLong):
+        chunking.analyze_chunked(LEASE, lambda *args: calls.append(args), max_chars=1000)
+    assert calls == []
+
+
+def test_merged_score_defaults_when_no_chunk_scored():
+    unscored = {'extracted_data': {}, 'clause_summaries': {}, 'risks': [], 'score': None}
+    assert chunking.merge_results([unscored, None], [100, 100])['score'] == chunking.NOT_FOUND
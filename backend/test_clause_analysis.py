@@ -0,0 +1,172 @@
+import json
+import re
+
+import pytest
+
+import clause_analysis
+import clause_cache
+
+
+class DictCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get_many(self, keys):
+        return [self.entries.get(key) for key in keys]
+
+    def put_many(self, entries):
+        self.entries.update(entries)
+
+
+def lease(rent):
+    return (
+        "1. PARTIES. This lease is made between Acme Property LLC (Landlord) and the tenant named below.\n\n"
+        f"2. RENT. Tenant shall pay monthly rent of {rent} on the first day of each month without demand.\n\n"
+        "3. PETS. No animals of any kind shall be kept on the premises without the Landlord's written consent.\n\n"
+        "4. ENTRY. Landlord may enter the premises at any time without notice to make inspections or repairs.\n\n"
+    )
+
+
+def annotation_for(clause):
+    if 'RENT' in clause:
+        rent = re.search(r'\$[\d,]+', clause).group(0)
+        return {'category': 'Rent_Payment_Terms', 'summary': f'Rent is {rent}.', 'risks': [],
+                'facts': {'Monthly_Rent_Amount': rent}}
+    if 'PETS' in clause:
+        return {'category': 'Pet_Policy', 'summary': 'No pets without consent.',
+                'risks': [{'text': 'Pets need written consent', 'severity': 'low'}], 'facts': {}}
+    if 'ENTRY' in clause:
+        return {'category': 'Entry_Access', 'summary': 'Entry without notice.',
+                'risks': [{'text': 'Landlord may enter without notice', 'severity': 'high'}], 'facts': {}}
+    return {'category': 'Parties', 'summary': 'Acme Property LLC is the landlord.', 'risks': [],
+            'facts': {'Landlord_Name': 'Acme Property LLC', 'Tenant_Name': 'Not Found'}}
+
+
+DEFAULT_BATCH_SIZE = clause_analysis.CLAUSE_BATCH_SIZE
+
+
+def long_lease(clause_count):
+    return ''.join(f"{n}. TERM {n}. The tenant agrees to observe house rule number {n} at all times "
+                   f"while living on the premises.\n\n" for n in range(1, clause_count + 1))
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    cache = DictCache()
+    calls = []
+    monkeypatch.setattr(clause_cache, 'get_cache', lambda: cache)
+    # One clause per call unless a test says otherwise, so annotations reach the shared cache
+    monkeypatch.setattr(clause_analysis, 'CLAUSE_BATCH_SIZE', 1)
+    monkeypatch.setattr(clause_analysis, 'score_risks', lambda risks, tier=None: None)
+
+    def fake_analyze_clauses(clauses, tier=None):
+        calls.append([number for number, _ in clauses])
+        items = [dict(annotation_for(text), id=number) for number, text in clauses]
+        return json.dumps({'clauses': items})
+
+    monkeypatch.setattr(clause_analysis, 'analyze_clauses', fake_analyze_clauses)
+    return calls
+
+
+def test_cache_key_ignores_layout_and_typography():
+    assert clause_cache.cache_key("Tenant’s  deposit — refundable\n") == \
+        clause_cache.cache_key("tenant's deposit - REFUNDABLE")
+    assert clause_cache.cache_key("Rent is $1,000") != clause_cache.cache_key("Rent is $1,500")
+
+
+def test_cache_key_ignores_clause_numbering():
+    clause = "PETS. No animals of any kind shall be kept on the premises."
+    keys = {clause_cache.cache_key(f"{number} {clause}") for number in ('5.', '7.', '4.2)', 'B.', 'iv)', 'Section 9.')}
+    assert keys == {clause_cache.cache_key(clause)}
+
+
+def test_clean_annotation_conforms_to_schema():
+    cleaned = clause_analysis.clean_annotation({
+        'category': 'Made_Up', 'summary': ' x ', 'risks': ['plain', {'text': 'y', 'severity': 'HIGH'}, {}],
+        'facts': {'Tenant_Name': 'Jo', 'Landlord_Name': 'Not Found', 'Shoe_Size': '9'},
+    })
+    assert cleaned == {'category': 'Other', 'summary': 'x',
+                       'risks': [{'text': 'plain', 'severity': 'medium'}, {'text': 'y', 'severity': 'high'}],
+                       'facts': {'Tenant_Name': 'Jo'}}
+
+
+def test_analyze_assembles_result(gemini):
+    result = clause_analysis.analyze(lease('$1,000'))
+    assert result['extracted_data']['Monthly_Rent_Amount'] == '$1,000'
+    assert result['extracted_data']['Landlord_Name'] == 'Acme Property LLC'
+    assert result['extracted_data']['Tenant_Name'] == 'Not Found'
+    assert result['clause_summaries']['Pet_Policy'] == 'No pets without consent.'
+    assert result['risks'] == ['Pets need written consent', 'Landlord may enter without notice']
+    assert result['score'] == 100 - 2 - 15
+    assert result['clauseCache']['hits'] == 0 and result['clauseCache']['analyzed'] == 4
+
+
+def test_second_lease_only_sends_changed_clauses(gemini):
+    clause_analysis.analyze(lease('$1,000'))
+    result = clause_analysis.analyze(lease('$1,500'))
+    assert gemini[-1] == [2]
+    assert result['extracted_data']['Monthly_Rent_Amount'] == '$1,500'
+    assert result['clauseCache']['hits'] == 3
+    assert result['clauseCache']['hitRate'] == 0.75
+
+
+def test_falls_back_when_annotations_missing(gemini, monkeypatch):
+    monkeypatch.setattr(clause_analysis, 'analyze_clauses', lambda clauses, tier=None: None)
+    assert clause_analysis.analyze(lease('$1,000')) is None
+    assert clause_analysis.analyze('Too short to have clauses.') is None
+
+
+def test_clauses_are_reported_as_they_are_annotated(gemini):
+    clause_analysis.analyze(lease('$1,000'))
+    reported = []
+    clause_analysis.analyze(lease('$1,500'), on_clauses=reported.append)
+    assert [[c['clause'] for c in batch] for batch in reported] == [[1, 3, 4], [2]]
+    assert reported[1][0]['facts'] == {'Monthly_Rent_Amount': '$1,500'}
+
+
+def test_renumbered_clauses_hit_the_cache(gemini):
+    clause_analysis.analyze(lease('$1,000'))
+    renumbered = lease('$1,000').replace('3. PETS', '7. PETS').replace('4. ENTRY', '8. ENTRY')
+    assert clause_analysis.analyze(renumbered)['clauseCache']['hits'] == 4
+
+
+def test_batched_annotations_are_not_shared(gemini, monkeypatch):
+    monkeypatch.setattr(clause_analysis, 'CLAUSE_BATCH_SIZE', 2)
+    clause_analysis.analyze(lease('$1,000'))
+    assert sorted(gemini) == [[1, 2], [3, 4]]
+    assert clause_cache.get_cache().entries == {}
+    clause_analysis.analyze(lease('$1,000'))
+    assert len(gemini) == 4
+
+
+def test_batched_annotations_are_cached_for_their_user(gemini, monkeypatch):
+    monkeypatch.setattr(clause_analysis, 'CLAUSE_BATCH_SIZE', 2)
+    clause_analysis.analyze(lease('$1,000'), user_id='user-1')
+    result = clause_analysis.analyze(lease('$1,000'), user_id='user-1')
+    assert len(gemini) == 2
+    assert result['clauseCache']['fromCache'] == 4
+    clause_analysis.analyze(lease('$1,000'), user_id='user-2')
+    assert len(gemini) == 4
+
+
+def test_cold_cache_batches_clauses_by_default(gemini, monkeypatch):
+    monkeypatch.setattr(clause_analysis, 'CLAUSE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    result = clause_analysis.analyze(long_lease(20))
+    assert result['clauseCache']['analyzed'] == 20
+    assert len(gemini) == -(-20 // DEFAULT_BATCH_SIZE) < 20
+
+
+def test_failing_batches_stop_further_calls(gemini, monkeypatch):
+    calls = []
+    monkeypatch.setattr(clause_analysis, 'CLAUSE_BATCH_WORKERS', 1)
+    monkeypatch.setattr(clause_analysis, 'analyze_clauses', lambda clauses, tier=None: calls.append(clauses))
+    assert clause_analysis.analyze(long_lease(20)) is None
+    # 20 single-clause batches; the sixth failure is over the 25% share
+    assert len(calls) == 6
+
+
+def test_score_comes_from_the_model_when_it_answers(gemini, monkeypatch):
+    scored = []
+    monkeypatch.setattr(clause_analysis, 'score_risks', lambda risks, tier=None: scored.append(risks) or 55)
+    assert clause_analysis.analyze(lease('$1,000'))['score'] == 55
+    assert [risk['severity'] for risk in scored[0]] == ['low', 'high']
@@ -0,0 +1,9 @@
+from extraction import classify_page
+
+
+def test_classify_page():
+    assert classify_page(1200, 0.0) == 'text'
+    assert classify_page(1200, 0.05) == 'text'
+    assert classify_page(1200, 0.6) == 'mixed'
+    assert classify_page(3, 0.95) == 'scanned'
+    assert classify_page(0, 0.0) == 'empty'
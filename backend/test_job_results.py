@@ -0,0 +1,29 @@
+import job_results
+
+
+def test_compress_round_trip_and_stable_etag():
+    result = {'analysis': {'score': 80, 'risks': ['Late fee']}, 'leaseId': 'abc'}
+    body, _ = job_results.compress(result)
+    assert job_results.decompress(body) == result
+    again, _ = job_results.compress(dict(reversed(list(result.items()))))
+    assert job_results.etag_for(again) == job_results.etag_for(body)
+
+def test_store_and_load_from_redis(fake_redis):
+    stored = job_results.store(fake_redis, 'job1', {'score': 10})
+    loaded = job_results.load(fake_redis, 'job1')
+    assert loaded['etag'] == stored['etag']
+    assert loaded['encoding'] in ('gzip', 'zstd')
+    assert job_results.decompress(loaded['body']) == {'score': 10}
+    assert job_results.load(fake_redis, 'missing') is None
+
+def test_stored_result_records_its_owner(fake_redis):
+    job_results.store(fake_redis, 'job2', {'score': 10}, user_id='user-1')
+    assert job_results.load(fake_redis, 'job2')['userId'] == 'user-1'
+    job_results.store(fake_redis, 'job3', {'score': 10})
+    assert job_results.load(fake_redis, 'job3').get('userId') is None
+
+def test_stored_result_keeps_its_http_status(fake_redis):
+    job_results.store(fake_redis, 'job4', {'error': 'Free analysis limit reached.'}, status=429)
+    assert job_results.load(fake_redis, 'job4')['status'] == 429
+    job_results.store(fake_redis, 'job5', {'score': 10})
+    assert 'status' not in job_results.load(fake_redis, 'job5')
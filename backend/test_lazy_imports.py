@@ -0,0 +1,17 @@
+import sys
+
+from lazy_imports import is_available, lazy_module
+
+
+def test_module_is_imported_on_first_attribute_access():
+    sys.modules.pop('colorsys', None)
+    colorsys = lazy_module('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert colorsys.rgb_to_hsv(1, 0, 0)[0] == 0
+    assert 'colorsys' in sys.modules
+
+def test_is_available_does_not_import():
+    sys.modules.pop('wave', None)
+    assert is_available('wave') is True
+    assert 'wave' not in sys.modules
+    assert is_available('definitely_not_a_real_module') is False
@@ -0,0 +1,139 @@
+import pytest
+
+import clause_cache
+import lease_versions
+
+
+def lease_text(rent='$1,000', pets='No animals of any kind shall be kept on the premises.', extra=''):
+    return (
+        "1. PARTIES. This lease is made between Acme Property LLC (Landlord) and the tenant named below.\n\n"
+        f"2. RENT. Tenant shall pay monthly rent of {rent} on the first day of each month without demand.\n\n"
+        f"3. PETS. {pets} Any breach of this clause is a default under the lease.\n\n"
+        "4. ENTRY. Landlord may enter the premises at any time without notice to make inspections or repairs.\n\n"
+        + extra
+    )
+
+
+class FakeDoc:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return self._data
+
+    def get(self):
+        return self
+
+
+class FakeQuery:
+    def __init__(self, db, leases):
+        self.db = db
+        self.leases = leases
+
+    def where(self, field, op, value):
+        return FakeQuery(self.db, {i: d for i, d in self.leases.items() if d.get(field) == value})
+
+    def select(self, fields):
+        return self
+
+    def limit(self, count):
+        return FakeQuery(self.db, dict(list(self.leases.items())[:count]))
+
+    def stream(self):
+        self.db.reads += len(self.leases)
+        return [FakeDoc(doc_id, data) for doc_id, data in self.leases.items()]
+
+    def document(self, doc_id):
+        return FakeDoc(doc_id, self.leases.get(doc_id))
+
+
+class FakeDb:
+    def __init__(self, leases):
+        self.leases = leases
+        self.reads = 0
+
+    def collection(self, name):
+        return FakeQuery(self, self.leases)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    entries = {}
+
+    class DictCache:
+        def get_many(self, keys):
+            return [entries.get(key) for key in keys]
+
+        def put_many(self, new_entries):
+            entries.update(new_entries)
+
+    monkeypatch.setattr(clause_cache, 'get_cache', lambda: DictCache())
+    return entries
+
+
+def saved(text, user_id='user-1', score=70, **fields):
+    return dict({'userId': user_id, 'fileName': 'lease.pdf', 'analysis': {'score': score},
+                 'clauseKeys': lease_versions.clause_keys(text)}, **fields)
+
+
+def test_diff_pairs_replacements_and_reports_surplus():
+    assert lease_versions.diff_clauses(['a', 'b', 'c'], ['a', 'x', 'c', 'd']) == [
+        ('modified', 1, 1), ('added', None, 3)]
+    assert lease_versions.diff_clauses(['a', 'b', 'c'], ['a']) == [('removed', 1, None), ('removed', 2, None)]
+
+
+def test_revision_is_linked_to_most_similar_lease(cache):
+    db = FakeDb({
+        'v1': saved(lease_text()),
+        'other-user': saved(lease_text(), user_id='user-2'),
+        'unrelated': saved("1. SCOPE. This agreement covers the supply of office furniture to the buyer.\n\n"),
+        'legacy': {'userId': 'user-1', 'fileName': 'old.pdf', 'analysis': {}},
+    })
+    old_pets = lease_versions.clause_keys(lease_text())[2]
+    cache[old_pets] = {'category': 'Pet_Policy', 'summary': 'No pets.', 'facts': {},
+                       'risks': [{'text': 'Pets forbidden', 'severity': 'low'}]}
+
+    result = {'score': 64}
+    version = lease_versions.attach_version(db, 'user-1', lease_text(pets='One cat is allowed.'), result,
+                                            file_name='lease.pdf')
+    assert result['version'] is version
+    assert version['previousVersionId'] == 'v1' and version['number'] == 2
+    assert version['similarity'] == 0.6
+    [change] = version['changes']
+    assert change['change'] == 'modified' and change['clause'] == 3
+    assert change['category'] == 'Pet_Policy' and change['before'] == 'No pets.'
+    assert change['risksRemoved'] == ['Pets forbidden']
+    assert version['summary'] == '1 clause(s) modified, 0 added, 0 removed since the previous version. Score 70 -> 64.'
+
+
+def test_unrelated_upload_is_not_a_version(cache):
+    db = FakeDb({'v1': saved(lease_text())})
+    text = "1. SCOPE. This agreement covers the supply of office furniture to the buyer and delivery terms.\n\n"
+    assert lease_versions.attach_version(db, 'user-1', text, {}, file_name='lease.pdf') is None
+
+
+def test_same_template_with_other_name_and_address_is_not_a_version(cache):
+    db = FakeDb({'v1': saved(lease_text(), propertyAddressKey='1 main st')})
+    result = {'extracted_data': {'Property_Address': '9 Elm Rd'}}
+    assert lease_versions.attach_version(db, 'user-1', lease_text(), result, file_name='other.pdf') is None
+    result = {'extracted_data': {'Property_Address': '1 Main St.'.rstrip('.')}}
+    assert lease_versions.attach_version(db, 'user-1', lease_text(), result, file_name='other.pdf') is not None
+
+
+def test_candidate_reads_are_capped(cache, monkeypatch):
+    monkeypatch.setattr(lease_versions, 'LEASE_VERSION_MAX_CANDIDATES', 3)
+    db = FakeDb({f'l{n}': saved(lease_text(rent=f'${n},000')) for n in range(1, 50)})
+    assert lease_versions.attach_version(db, 'user-1', lease_text(), {}, file_name='lease.pdf') is not None
+    assert db.reads == 3
+
+
+def test_explicit_previous_lease_and_inserted_clause(cache):
+    db = FakeDb({'mine': saved(lease_text(), fileName='draft.pdf'),
+                 'theirs': saved(lease_text(), user_id='user-2')})
+    text = lease_text().replace('4. ENTRY', '4. NOISE. Quiet hours apply from 10pm to 7am every day of the week, including public holidays.\n\n5. ENTRY')
+    version = lease_versions.attach_version(db, 'user-1', text, {}, previous_lease_id='mine')
+    assert version['previousVersionId'] == 'mine'
+    assert [(c['change'], c['clause']) for c in version['changes']] == [('added', 4)]
+    assert lease_versions.attach_version(db, 'user-1', text, {}, previous_lease_id='theirs') is None
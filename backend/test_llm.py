@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip('google.generativeai')
+import llm  # noqa: E402
+
+
+class Sentinel(Exception):
+    pass
+
+
+class FakeClient:
+    def generate_content(self, *args, **kwargs):
+        raise Sentinel()
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    monkeypatch.setattr(llm, 'gemini_api_keys', ['key-0', 'key-1'])
+    monkeypatch.setattr(llm, 'gemini_models', {})
+    monkeypatch.setattr(llm, 'gemini_clients', {})
+
+
+def test_models_send_requests_through_their_keys_client(keys):
+    # model_for_key binds each model to its key by setting the SDK's private
+    # GenerativeModel._client (google-generativeai==0.5.4, pinned in the
+    # requirements). This fails if an SDK upgrade stops using it.
+    model = llm.model_for_key(1, 'gemini-pro')
+    assert model._client is llm.gemini_clients[1]
+    model._client = FakeClient()
+    with pytest.raises(Sentinel):
+        model.generate_content('hello')
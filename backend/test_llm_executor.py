@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+import llm_executor
+import llm_guard
+
+
+class APIError(Exception):
+    def __init__(self, code, message='upstream error'):
+        super().__init__(message)
+        self.code = code
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(llm_executor, 'LLM_HEDGE_AFTER_SECONDS', 0.05)
+    monkeypatch.setattr(llm_executor, 'LLM_RETRY_BASE_SECONDS', 0.01)
+    llm_executor.reset_metrics()
+
+
+def test_fast_call_is_not_hedged():
+    slots = []
+
+    def call(slot, timeout):
+        slots.append(slot)
+        return 'ok'
+
+    assert llm_executor.execute(call, 'm', key_count=3) == 'ok'
+    assert slots == [0]
+    assert llm_executor.metrics()['m']['hedged'] == 0
+
+
+def test_slow_call_is_hedged_on_the_next_key():
+    release = threading.Event()
+
+    def call(slot, timeout):
+        if slot == 0:
+            release.wait(timeout)
+            return 'slow'
+        return 'hedge'
+
+    with llm_executor.budget(5):
+        assert llm_executor.execute(call, 'm', key_count=2) == 'hedge'
+    release.set()
+    time.sleep(0.05)
+    stats = llm_executor.metrics()['m']
+    assert (stats['hedged'], stats['hedgeWins'], stats['hedgeRate']) == (1, 1, 1.0)
+    assert stats['latencySavedSeconds'] >= 0
+
+
+def test_single_key_is_never_hedged_and_deadline_applies():
+    def call(slot, timeout):
+        time.sleep(timeout + 0.1)
+        return 'late'
+
+    with llm_executor.budget(0.1):
+        with pytest.raises(llm_executor.DeadlineExceeded):
+            llm_executor.execute(call, 'm', key_count=1)
+    assert llm_executor.metrics()['m']['deadlineExceeded'] == 1
+
+
+def test_retryable_errors_retry_on_another_key():
+    slots = []
+
+    def call(slot, timeout):
+        slots.append(slot)
+        if slot == 0:
+            raise APIError(429)
+        return 'ok'
+
+    assert llm_executor.execute(call, 'm', key_count=2) == 'ok'
+    assert slots == [0, 1]
+    assert llm_executor.metrics()['m']['retries'] == 1
+
+
+def test_non_retryable_errors_raise():
+    def call(slot, timeout):
+        raise APIError(400, 'Request contains an invalid argument.')
+
+    with pytest.raises(APIError):
+        llm_executor.execute(call, 'm', key_count=2)
+    assert llm_executor.metrics()['m']['errors'] == 1
+    assert llm_executor.is_retryable(APIError(400, 'API key not valid'), key_count=2)
+    assert not llm_executor.is_retryable(APIError(400, 'API key not valid'), key_count=1)
+
+
+def test_nested_budgets_only_shrink():
+    with llm_executor.budget(10):
+        outer = llm_executor.current_deadline()
+        with llm_executor.budget(60):
+            assert llm_executor.current_deadline() == outer
+        with llm_executor.budget(1):
+            assert llm_executor.current_deadline() < outer
+    assert llm_executor.current_deadline() is None
+
+
+def test_hedge_delay_follows_observed_latency(monkeypatch):
+    monkeypatch.setattr(llm_executor, 'LLM_HEDGE_MIN_SAMPLES', 3)
+    monkeypatch.setattr(llm_executor, 'LLM_HEDGE_MIN_DELAY_SECONDS', 0)
+    assert llm_executor.hedge_delay('m') == 0.05
+    for latency in (1.0, 2.0, 3.0, 4.0):
+        llm_executor._record_latency('m', latency)
+    assert llm_executor.hedge_delay('m') == 4.0
+
+
+def test_hedge_loser_keeps_its_admission_slot(monkeypatch):
+    monkeypatch.setattr(llm_guard, 'LLM_MAX_INFLIGHT_CLUSTER', 0)
+    monkeypatch.setattr(llm_guard, '_inflight', threading.BoundedSemaphore(1))
+    release = threading.Event()
+
+    def call(slot, timeout):
+        if slot == 0:
+            release.wait(timeout)
+            return 'slow'
+        return 'hedge'
+
+    with llm_executor.budget(5), llm_guard.admit('m'):
+        assert llm_executor.execute(call, 'm', key_count=2) == 'hedge'
+    assert llm_guard.saturated()
+    release.set()
+    time.sleep(0.05)
+    assert not llm_guard.saturated()
+
+
+def test_no_hedge_while_hedge_threads_are_busy(monkeypatch):
+    monkeypatch.setattr(llm_executor, '_hedge_slots', threading.BoundedSemaphore(1))
+    llm_executor._hedge_slots.acquire()
+    slots = []
+
+    def call(slot, timeout):
+        slots.append(slot)
+        time.sleep(0.1)
+        return 'ok'
+
+    with llm_executor.budget(5):
+        assert llm_executor.execute(call, 'm', key_count=2) == 'ok'
+    assert slots == [0]
+    assert llm_executor.metrics()['m']['hedged'] == 0
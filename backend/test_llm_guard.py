@@ -0,0 +1,145 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+import pytest
+
+import llm_guard
+
+
+@pytest.fixture(autouse=True)
+def guard(monkeypatch, fake_redis):
+    monkeypatch.setattr(llm_guard.queues, 'get_redis_conn', lambda: fake_redis)
+    monkeypatch.setattr(llm_guard, '_inflight', threading.BoundedSemaphore(2))
+    monkeypatch.setattr(llm_guard, 'LLM_ADMISSION_WAIT_SECONDS', 0.01)
+    monkeypatch.setattr(llm_guard, '_breakers', {})
+    return fake_redis
+
+
+def test_breaker_opens_probes_and_closes(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(llm_guard.time, 'monotonic', lambda: clock[0])
+    breaker = llm_guard.CircuitBreaker(failures=2, cooldown=30)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN and not breaker.allow()
+    assert breaker.retry_after() == 30
+
+    clock[0] += 30
+    assert breaker.allow()       # the single half-open probe
+    assert not breaker.allow()
+    breaker.record_failure()     # failed probe reopens at once
+    assert breaker.state == breaker.OPEN
+
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+
+
+def test_pick_key_skips_open_circuits():
+    for _ in range(llm_guard.LLM_BREAKER_FAILURES):
+        llm_guard.breaker('flash', 0).record_failure()
+    assert llm_guard.pick_key('flash', 0, 2) == 1
+    for _ in range(llm_guard.LLM_BREAKER_FAILURES):
+        llm_guard.breaker('flash', 1).record_failure()
+    with pytest.raises(llm_guard.Overloaded) as excinfo:
+        llm_guard.pick_key('flash', 0, 2)
+    assert 1 <= excinfo.value.retry_after <= llm_guard.LLM_BREAKER_COOLDOWN_SECONDS
+    assert llm_guard.breaker_states()['flash#0']['state'] == 'open'
+
+
+@contextlib.contextmanager
+def other_call(name='m'):
+    """Admit an unrelated call: one outside the current call's context."""
+    context, admission = contextvars.Context(), llm_guard.admit(name)
+    context.run(admission.__enter__)
+    try:
+        yield
+    finally:
+        context.run(admission.__exit__, None, None, None)
+
+
+def test_process_admission_limit():
+    with other_call(), other_call():
+        assert llm_guard.saturated()
+        with pytest.raises(llm_guard.Overloaded):
+            with other_call():
+                pass
+        with pytest.raises(llm_guard.Overloaded):
+            llm_guard.shed_if_saturated()
+    assert not llm_guard.saturated()
+
+
+def test_cluster_admission_limit(guard, monkeypatch):
+    monkeypatch.setattr(llm_guard, 'LLM_MAX_INFLIGHT_CLUSTER', 1)
+    with llm_guard.admit('m'):
+        assert guard.zcard(llm_guard.INFLIGHT_KEY) == 1
+        with pytest.raises(llm_guard.Overloaded):
+            with other_call():
+                pass
+        # The rejected call neither holds a cluster nor a process slot
+        assert guard.zcard(llm_guard.INFLIGHT_KEY) == 1
+        assert not llm_guard.saturated()
+    assert guard.zcard(llm_guard.INFLIGHT_KEY) == 0
+
+
+def test_patient_admission_waits_for_a_free_slot(guard, monkeypatch):
+    monkeypatch.setattr(llm_guard, 'LLM_MAX_INFLIGHT_CLUSTER', 1)
+    # Another process holds the only cluster slot for a moment
+    guard.zadd(llm_guard.INFLIGHT_KEY, {'elsewhere': 10 ** 12})
+    threading.Timer(0.2, guard.zrem, (llm_guard.INFLIGHT_KEY, 'elsewhere')).start()
+    with pytest.raises(llm_guard.Overloaded):
+        with llm_guard.admit('m'):
+            pass
+    with llm_guard.patient(5), llm_guard.admit('m'):
+        assert guard.zcard(llm_guard.INFLIGHT_KEY) == 1
+
+    guard.zadd(llm_guard.INFLIGHT_KEY, {'elsewhere': 10 ** 12})
+    with pytest.raises(llm_guard.Overloaded):
+        with llm_guard.patient(0.2), llm_guard.admit('m'):
+            pass
+    assert not llm_guard.saturated()
+
+
+def test_every_call_is_charged_its_own_slots(guard, monkeypatch):
+    monkeypatch.setattr(llm_guard, 'LLM_MAX_INFLIGHT_CLUSTER', 3)
+    with llm_guard.admit_request('lease'):
+        # Fan-out children run in copies of the request's context
+        children = [contextvars.copy_context() for _ in range(2)]
+        admissions = [llm_guard.admit('chunk') for _ in children]
+        for child, admission in zip(children, admissions):
+            child.run(admission.__enter__)
+        assert llm_guard.saturated()
+        assert guard.zcard(llm_guard.INFLIGHT_KEY) == 2
+        for child, admission in zip(children, admissions):
+            child.run(admission.__exit__, None, None, None)
+    assert not llm_guard.saturated()
+    assert guard.zcard(llm_guard.INFLIGHT_KEY) == 0
+
+
+def test_admitted_request_is_shed_up_front_and_then_waits(guard, monkeypatch):
+    monkeypatch.setattr(llm_guard, 'LLM_FANOUT_ADMISSION_WAIT_SECONDS', 5)
+    with other_call(), other_call():
+        with pytest.raises(llm_guard.Overloaded):
+            with llm_guard.admit_request('lease'):
+                pass
+    with llm_guard.admit_request('lease'):
+        others = contextlib.ExitStack()
+        others.enter_context(other_call())
+        others.enter_context(other_call())
+        threading.Timer(0.2, others.close).start()
+        started = time.monotonic()
+        # Once started, the request's calls wait for a slot instead of being shed
+        with llm_guard.admit('chunk'):
+            assert time.monotonic() - started >= 0.15
+
+
+def test_redis_outage_admits_locally(monkeypatch):
+    def down():
+        raise ConnectionError('redis down')
+    monkeypatch.setattr(llm_guard.queues, 'get_redis_conn', down)
+    with llm_guard.admit('m'):
+        pass
@@ -0,0 +1,124 @@
+import pytest
+
+import model_router
+
+POLICY = {
+    'health': {'ewma_alpha': 0.5, 'min_samples': 2, 'max_error_rate': 0.5, 'max_latency_seconds': 30},
+    'tasks': {
+        'lease_analysis': {
+            'default': 'pro',
+            'rules': [{'name': 'short-clean', 'model': 'flash', 'max_chars': 1000,
+                       'min_text_quality': 0.8, 'fallback': 'pro', 'min_confidence': 0.6}],
+        },
+        'chat': {'default': 'pro', 'rules': [{'name': 'free', 'model': 'flash', 'tiers': ['free']}]},
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def policy(monkeypatch):
+    monkeypatch.setattr(model_router, 'POLICY', POLICY)
+    monkeypatch.setattr(model_router, '_stats', {})
+
+
+def test_shipped_policy_loads():
+    policy = model_router.load_policy()
+    for task in ('lease_analysis', 'clause_analysis', 'compliance', 'chat', 'photo_inspection', 'expense_scan', 'image_description'):
+        assert policy['tasks'][task]['default']
+
+
+def test_rules_match_on_size_quality_and_tier():
+    short_clean = model_router.choose('lease_analysis', chars=500, quality=0.95)
+    assert (short_clean.model, short_clean.fallback) == ('flash', 'pro')
+    assert model_router.choose('lease_analysis', chars=5000, quality=0.95).model == 'pro'
+    assert model_router.choose('lease_analysis', chars=500, quality=0.5).model == 'pro'
+    assert model_router.choose('chat', tier='free').model == 'flash'
+    assert model_router.choose('chat', tier='pro').model == 'pro'
+    with pytest.raises(KeyError):
+        model_router.choose('unknown')
+
+
+def test_unhealthy_model_is_skipped():
+    decision = model_router.choose('lease_analysis', chars=500, quality=0.95)
+    model_router.record_outcome(decision, 1.0, ok=False)
+    # Below min_samples health isn't judged yet
+    assert model_router.choose('lease_analysis', chars=500, quality=0.95).model == 'flash'
+    model_router.record_outcome(decision, 1.0, ok=False)
+    rerouted = model_router.choose('lease_analysis', chars=500, quality=0.95)
+    assert rerouted.model == 'pro'
+    assert 'flash error rate' in rerouted.reason
+
+
+def test_slow_model_is_skipped_and_recovers():
+    decision = model_router.choose('chat', tier='free')
+    for _ in range(2):
+        model_router.record_outcome(decision, 60.0, ok=True)
+    assert model_router.choose('chat', tier='free').model == 'pro'
+    for _ in range(3):
+        model_router.record_outcome(decision, 2.0, ok=True)
+    assert model_router.choose('chat', tier='free').model == 'flash'
+    assert model_router.snapshot()['flash']['samples'] == 5
+
+
+def test_unhealthy_model_is_probed_and_recovers(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(model_router.time, 'monotonic', lambda: clock[0])
+    decision = model_router.choose('chat', tier='free')
+    for _ in range(2):
+        model_router.record_outcome(decision, 1.0, ok=False)
+    assert model_router.choose('chat', tier='free').model == 'pro'
+
+    clock[0] += 31
+    probe = model_router.choose('chat', tier='free')
+    assert (probe.model, probe.probe) == ('flash', True)
+    assert model_router.choose('chat', tier='free').model == 'pro'  # one probe at a time
+    model_router.record_outcome(probe, 1.0, ok=False)
+    clock[0] += 10
+    assert model_router.choose('chat', tier='free').model == 'pro'
+
+    clock[0] += 31
+    probe = model_router.choose('chat', tier='free')
+    model_router.record_outcome(probe, 1.0, ok=True)
+    recovered = model_router.choose('chat', tier='free')
+    assert (recovered.model, recovered.probe) == ('flash', False)
+
+
+def test_text_quality_flags_noisy_ocr():
+    clean = 'The Tenant shall pay rent of $1,200.00 on the first day of each month.'
+    noisy = 'T~e T#n@nt s|-|all p@y r3nt ¦¦ 0f $1,2OO ~~ ,,. ]]] }{ %%'
+    assert model_router.text_quality(clean) > 0.9
+    assert model_router.text_quality(noisy) < 0.6
+    assert model_router.text_quality('') == 0.0
+
+
+def test_confidence():
+    found = {field: 'x' for field in model_router.LEASE_EXTRACTED_FIELDS}
+    assert model_router.confidence({'extracted_data': found, 'score': 70}) == 1.0
+    sparse = dict.fromkeys(model_router.LEASE_EXTRACTED_FIELDS, 'Not Found')
+    sparse['Tenant_Name'] = 'Jo'
+    assert model_router.confidence({'extracted_data': sparse, 'score': 70}) < 0.2
+    assert model_router.confidence({'extracted_data': found, 'score': 'Not Found'}) == 0.0
+    assert model_router.confidence({'raw_analysis': 'x', 'error_message': 'bad'}) == 0.0
+    assert model_router.confidence({'extracted_data': sparse, 'score': 70}, partial=True) == 1.0
+    assert model_router.models_for('lease_analysis') == ['flash', 'pro']
+
+
+def test_low_confidence_output_escalates_to_fallback(monkeypatch):
+    import llm
+    calls = []
+    outputs = {'flash': '{"extracted_data": {}, "score": 50}',
+               'pro': '{"extracted_data": {"Tenant_Name": "Jo"}, "score": 60}'}
+
+    def fake_generate(model_name, prompt):
+        calls.append(model_name)
+        return outputs[model_name]
+
+    monkeypatch.setattr(llm, '_generate_lease_json', fake_generate)
+    lease = 'The Tenant shall pay rent monthly. ' * 10
+    assert llm.analyze_lease(lease) == outputs['pro']
+    assert calls == ['flash', 'pro']
+
+    # Chunks of a longer lease aren't expected to contain every field
+    calls.clear()
+    assert llm.analyze_lease(lease, part=(1, 3)) == outputs['flash']
+    assert calls == ['flash']
@@ -0,0 +1,18 @@
+import ocr
+
+
+def test_choose_dpi_respects_pixel_ceiling():
+    letter = (612, 792)  # US Letter in points
+    assert ocr.choose_dpi(*letter, dpi=300, max_pixels=12_000_000) == 300
+    # A 24x36" drawing would be 77M pixels at 300 DPI
+    dpi = ocr.choose_dpi(24 * 72, 36 * 72, dpi=300, max_pixels=12_000_000)
+    assert dpi < 300
+    assert (24 * dpi) * (36 * dpi) <= 12_000_000
+
+
+def test_otsu_threshold_splits_bimodal_histogram():
+    histogram = [0] * 256
+    histogram[30] = 500   # ink
+    histogram[220] = 4500  # paper
+    threshold = ocr.otsu_threshold(histogram)
+    assert 30 <= threshold < 220
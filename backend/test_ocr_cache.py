@@ -0,0 +1,19 @@
+import ocr_cache
+
+
+def test_cache_key_depends_on_raster_and_language():
+    key = ocr_cache.cache_key(b'\x00\xff' * 10, 4, 5, 'eng')
+    assert key == ocr_cache.cache_key(b'\x00\xff' * 10, 4, 5, 'eng')
+    assert key != ocr_cache.cache_key(b'\x00\xfe' * 10, 4, 5, 'eng')
+    assert key != ocr_cache.cache_key(b'\x00\xff' * 10, 4, 5, 'deu')
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = ocr_cache.DiskOCRCache(str(tmp_path / 'ocr.sqlite3'), max_entries=2)
+    cache.put('a', 'page a')
+    cache.put('b', 'page b')
+    assert cache.get('a') == 'page a'  # 'b' is now the least recently used
+    cache.put('c', 'page c')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'page a'
+    assert cache.get('c') == 'page c'
@@ -0,0 +1,126 @@
+import itertools
+
+from persistence import WriteBehindQueue
+
+
+class FakeRef:
+    def __init__(self, db, collection, doc_id):
+        self.db = db
+        self.collection = collection
+        self.id = doc_id
+
+    def delete(self):
+        self.db.deleted.append((self.collection, self.id))
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data):
+        self.ops.append((ref.collection, ref.id, data))
+
+    def commit(self):
+        if any(doc_id in self.db.bad_ids for _, doc_id, _ in self.ops):
+            raise ValueError('invalid document')
+        if self.db.fail_commits:
+            self.db.fail_commits -= 1
+            raise RuntimeError('unavailable')
+        self.db.on_commit()
+        self.db.commits.append(self.ops)
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id=None):
+        return FakeRef(self.db, self.name, doc_id or f'auto{next(self.db.ids)}')
+
+
+class FakeDB:
+    def __init__(self, fail_commits=0, bad_ids=()):
+        self.fail_commits = fail_commits
+        self.bad_ids = set(bad_ids)
+        self.commits = []
+        self.deleted = []
+        self.ids = itertools.count(1)
+        self.on_commit = lambda: None
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def make_queue(tmp_path, db, **kwargs):
+    queue = WriteBehindQueue(lambda: db, str(tmp_path / 'spool.sqlite3'), batch_size=2, **kwargs)
+    # Keep the background thread out of the way; tests flush explicitly
+    queue._ensure_worker = lambda: None
+    return queue
+
+
+def test_ids_are_returned_before_writes_are_batched(tmp_path):
+    db = FakeDB()
+    queue = make_queue(tmp_path, db)
+    ids = [queue.add('leases', {'n': i}) for i in range(3)]
+    assert ids == ['auto1', 'auto2', 'auto3']
+    assert db.commits == []
+    queue.flush()
+    assert [len(ops) for ops in db.commits] == [2, 1]
+    assert db.commits[0][0] == ('leases', 'auto1', {'n': 0})
+    assert queue.pending_count() == 0
+
+
+def test_failed_flush_stays_spooled(tmp_path):
+    db = FakeDB(fail_commits=1)
+    queue = make_queue(tmp_path, db)
+    queue.add('expenses', {'total': 5}, doc_id='e1')
+    assert queue.flush_once() == 0
+    # A fresh queue on the same spool (e.g. after a crash) still sees the write
+    reopened = make_queue(tmp_path, db)
+    assert reopened.pending_count() == 1
+
+
+def test_bad_document_is_retried_alone_then_dead_lettered(tmp_path):
+    db = FakeDB(bad_ids={'bad'})
+    queue = make_queue(tmp_path, db, max_backoff=0, max_attempts=2)
+    queue.add('leases', {'n': 1}, doc_id='good')
+    queue.add('leases', {'n': 2}, doc_id='bad')
+    assert queue.flush_once() == 1
+    assert db.commits == [[('leases', 'good', {'n': 1})]]
+    assert (queue.pending_count(), queue.dead_count()) == (1, 0)
+    assert queue.flush_once() == 0
+    assert (queue.pending_count(), queue.dead_count()) == (0, 1)
+
+
+def test_discarded_writes_are_not_flushed(tmp_path):
+    db = FakeDB()
+    queue = make_queue(tmp_path, db)
+    queue.add('leases', {'userId': 'u1'}, doc_id='l1')
+    queue.add('leases', {'userId': 'u1'}, doc_id='l2')
+    assert queue.pending_document('leases', 'l1') == {'userId': 'u1'}
+    # The lease is deleted before its write was flushed
+    assert queue.discard('leases', 'l1') == 1
+    queue.flush()
+    assert [doc_id for ops in db.commits for _, doc_id, _ in ops] == ['l2']
+    assert queue.pending_document('leases', 'l1') is None
+    assert db.deleted == []
+
+
+def test_write_in_flight_when_discarded_is_deleted_after_it_lands(tmp_path):
+    db = FakeDB()
+    queue = make_queue(tmp_path, db)
+    queue.add('leases', {'userId': 'u1'}, doc_id='l1')
+    queue.add('leases', {'userId': 'u1'}, doc_id='l2')
+    # The delete arrives while the flush is writing the batch
+    db.on_commit = lambda: queue.discard('leases', 'l1')
+    assert queue.flush_once() == 2
+    assert db.deleted == [('leases', 'l1')]
+    db.on_commit = lambda: None
+    queue.add('leases', {'userId': 'u1'}, doc_id='l3')
+    queue.flush()
+    assert db.deleted == [('leases', 'l1')]
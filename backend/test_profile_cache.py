@@ -0,0 +1,43 @@
+import profile_cache
+import profiles
+
+
+def test_write_through_update_and_increment():
+    profile_cache.clear()
+    profile_cache.put('u1', {'subscriptionTier': 'free', 'freeScansUsed': 1})
+    profile_cache.update('u1', {'subscriptionTier': 'commercial'})
+    profile_cache.increment('u1', 'freeScansUsed')
+    cached = profile_cache.get('u1')
+    assert cached == {'subscriptionTier': 'commercial', 'freeScansUsed': 2}
+
+def test_get_returns_copy_and_invalidate_drops_entry():
+    profile_cache.clear()
+    profile_cache.put('u2', {'subscriptionTier': 'free'})
+    profile_cache.get('u2')['subscriptionTier'] = 'paid'
+    assert profile_cache.get('u2')['subscriptionTier'] == 'free'
+    profile_cache.invalidate('u2')
+    assert profile_cache.get('u2') is None
+
+def test_update_ignores_uncached_users():
+    profile_cache.clear()
+    profile_cache.update('missing', {'subscriptionTier': 'paid'})
+    assert profile_cache.get('missing') is None
+
+def test_invalidation_from_another_process_drops_entry(monkeypatch):
+    profile_cache.clear()
+    monkeypatch.setattr(profile_cache, 'PROFILE_CACHE_BROADCAST', False)
+    profile_cache.put('u3', {'subscriptionTier': 'free'})
+    profile_cache.handle_message(f"{profile_cache._origin()} u3".encode())
+    assert profile_cache.get('u3') is not None
+    profile_cache.handle_message(b"other-host:1 u3")
+    assert profile_cache.get('u3') is None
+
+def test_scan_counts_come_from_the_stored_counters():
+    stored = {'freeScansUsed': 4, 'lastMonthlyScan': '2026-10', 'dailyScansUsed': 2, 'lastScanDate': '2026-10-18'}
+    assert profiles._scan_count_updates(stored, 'premium', '2026-10-19') == {
+        'freeScansUsed': 5, 'lastMonthlyScan': '2026-10', 'dailyScansUsed': 1, 'lastScanDate': '2026-10-19'}
+    assert profiles._scan_count_updates(dict(stored, lastScanDate='2026-10-19'), 'premium', '2026-10-19')[
+        'dailyScansUsed'] == 3
+    assert profiles._scan_count_updates(stored, 'free', '2026-11-01') == {
+        'freeScansUsed': 1, 'lastMonthlyScan': '2026-11'}
+    assert profiles._scan_count_updates(stored, 'pro', '2026-10-19') == {}
@@ -0,0 +1,17 @@
+import profiles
+
+
+def test_scan_limit_error_counts_an_unreset_month_and_day_from_zero():
+    profile = {'freeScansUsed': 3, 'lastMonthlyScan': '2026-09',
+               'dailyScansUsed': 3, 'lastScanDate': '2026-09-30'}
+    assert profiles.scan_limit_error(profile, 'free', '2026-10-01') is None
+    assert profiles.scan_limit_error(profile, 'premium', '2026-10-01') is None
+    assert profiles.scan_limit_error(profile, 'free', '2026-09-30')['limitReached'] == 'monthly'
+    assert profiles.scan_limit_error(profile, 'premium', '2026-09-30')['limitReached'] == 'daily'
+
+
+def test_scan_limit_error_uses_the_commercial_allowance():
+    profile = {'freeScansUsed': 5, 'lastMonthlyScan': '2026-10', 'maxAllowedScans': 5}
+    assert profiles.scan_limit_error(profile, 'commercial', '2026-10-19')['limitReached'] == 'monthly'
+    assert profiles.scan_limit_error(dict(profile, maxAllowedScans=6), 'commercial', '2026-10-19') is None
+    assert profiles.scan_limit_error(profile, 'pro', '2026-10-19') is None
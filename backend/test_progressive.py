@@ -0,0 +1,46 @@
+import json
+
+import llm_executor
+import llm_guard
+import progressive
+
+TEXT = "Tenant agrees to pay monthly rent of $1,200. A late fee of $50 applies."
+
+
+def events(stream):
+    parsed = []
+    for chunk in stream:
+        if chunk.startswith(':'):
+            continue
+        event, data = chunk.strip().split('\n')
+        parsed.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return parsed
+
+
+def test_instant_results_come_before_llm_stages():
+    def run(progress):
+        assert llm_executor.current_deadline() is not None
+        analysis = {'score': 80}
+        progress('clauses', [{'clause': 1, 'summary': 'Rent is $1,200.'}])
+        progress('analysis', analysis)
+        analysis['compliance_report'] = {'summary': 'ok'}  # reported events aren't affected
+        progress('compliance', {'compliance_report': analysis['compliance_report']})
+        return {'leaseId': 'lease-1', 'analysis': analysis}
+
+    parsed = events(progressive.stream_analysis(TEXT, run, budget_seconds=30))
+    assert [event for event, _ in parsed] == ['rules', 'extracted', 'clauses', 'analysis', 'compliance', 'done']
+    assert next(r for r in parsed[0][1] if r['id'] == 'CLAUSE001')['matched'] is True
+    assert parsed[1][1] == {'Monthly_Rent_Amount': '$1,200'}
+    assert parsed[3][1] == {'score': 80}
+    assert parsed[-1][1]['leaseId'] == 'lease-1'
+
+
+def test_failures_end_the_stream_with_an_error(monkeypatch):
+    monkeypatch.setattr(progressive, 'SSE_KEEPALIVE_SECONDS', 0.01)
+
+    def overloaded(progress):
+        raise llm_guard.Overloaded('busy', retry_after=3)
+
+    assert events(progressive.stream_analysis(TEXT, overloaded, 30))[-1] == \
+        ('error', {'error': 'busy', 'retryAfter': 3})
+    assert events(progressive.stream_analysis(TEXT, lambda progress: None, 30))[-1][0] == 'error'
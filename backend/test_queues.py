@@ -0,0 +1,9 @@
+import queues
+
+
+def test_retry_intervals_back_off_with_jitter(monkeypatch):
+    monkeypatch.setattr(queues, 'RETRY_INTERVALS', [30, 120])
+    intervals = queues.retry_intervals(3)
+    assert len(intervals) == 3
+    assert 30 <= intervals[0] <= 45
+    assert 120 <= intervals[1] <= 180 and 120 <= intervals[2] <= 180
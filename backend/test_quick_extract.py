@@ -0,0 +1,25 @@
+import quick_extract
+
+
+def test_extracts_stock_phrasings():
+    text = ("This Lease shall commence on January 1, 2025 and end on December 31, 2025. The term of this "
+            "lease is twelve (12) months. Tenant agrees to pay monthly rent of $1,850.00, due on the 1st day "
+            "of each month. A security deposit in the amount of $2,000 is due at signing.")
+    assert quick_extract.extract(text) == {
+        'Monthly_Rent_Amount': '$1,850.00',
+        'Security_Deposit_Amount': '$2,000',
+        'Lease_Start_Date': 'January 1, 2025',
+        'Lease_End_Date': 'December 31, 2025',
+        'Rent_Due_Date': '1st day of each month',
+        'Lease_Term': 'twelve (12) months',
+    }
+
+
+def test_date_ranges_and_missing_fields():
+    text = "Lease period from 03/01/2024 to 02/28/2025. Rent: $950 per month."
+    assert quick_extract.extract(text) == {
+        'Monthly_Rent_Amount': '$950',
+        'Lease_Start_Date': '03/01/2024',
+        'Lease_End_Date': '02/28/2025',
+    }
+    assert quick_extract.extract('No terms here.') == {}
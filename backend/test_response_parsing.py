@@ -0,0 +1,37 @@
+import pytest
+
+import response_parsing
+from response_parsing import parse_json_response, parse_lease_analysis
+
+
+def test_fences_are_stripped_as_a_prefix():
+    # lstrip('```json') would also eat the leading "j"/"s"/"o"/"n" of the payload
+    assert parse_json_response('```json\n{"name": "json"}\n```') == {'name': 'json'}
+    assert parse_json_response('{"summary": "ok"}') == {'summary': 'ok'}
+
+
+def test_common_defects_are_repaired():
+    assert parse_json_response('Sure! {"risks": ["a", "b",], "score": 55,} Done.') == {
+        'risks': ['a', 'b'], 'score': 55}
+    assert parse_json_response("{'ok': True, 'note': None}") == {'ok': True, 'note': None}
+    assert parse_json_response('{"summary": "line one\nline two"}') == {'summary': 'line one\nline two'}
+
+
+def test_truncated_output_is_closed():
+    assert parse_json_response('{"risks": ["late fee", "no pe') == {'risks': ['late fee', 'no pe']}
+    assert parse_json_response('{"extracted_data": {"Tenant_Name": "Jo", "Landlord_Name":') == {
+        'extracted_data': {'Tenant_Name': 'Jo'}}
+
+
+def test_unrepairable_output_raises():
+    with pytest.raises(response_parsing.ResponseParseError):
+        parse_json_response('I could not analyse this document.')
+
+
+def test_lease_analysis_is_filled_to_schema():
+    data = parse_lease_analysis('{"extracted_data": {"Tenant_Name": "Jo"}, "risks": "Auto renewal", "score": "72"}')
+    assert data['extracted_data']['Tenant_Name'] == 'Jo'
+    assert data['extracted_data']['Lease_Term'] == 'Not Found'
+    assert set(data['clause_summaries']) == set(response_parsing.LEASE_CLAUSE_FIELDS)
+    assert data['risks'] == ['Auto renewal']
+    assert data['score'] == 72
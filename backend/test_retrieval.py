@@ -0,0 +1,89 @@
+import retrieval
+
+
+def lease(file_name, pet_policy, risks=(), rent='$1,000'):
+    return {
+        'userId': 'user-1',
+        'fileName': file_name,
+        'createdAt': f'2025-01-01 {file_name}',
+        'analysis': {
+            'extracted_data': {'Tenant_Name': 'Jo', 'Monthly_Rent_Amount': rent, 'Lease_Term': 'Not Found'},
+            'clause_summaries': {'Pet_Policy': pet_policy, 'Late_Fee_Policy': 'Not Found'},
+            'risks': list(risks),
+        },
+    }
+
+
+class FakeDoc:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeQuery:
+    def __init__(self, db, fields=None):
+        self.db = db
+        self.fields = fields
+
+    def where(self, field, op, value):
+        return self
+
+    def select(self, fields):
+        return FakeQuery(self.db, fields)
+
+    def stream(self):
+        if self.fields is None:
+            self.db.full_reads += 1
+        for doc_id, data in self.db.leases.items():
+            yield FakeDoc(doc_id, {f: data[f] for f in self.fields} if self.fields else data)
+
+
+class FakeDb:
+    def __init__(self, leases):
+        self.leases = leases
+        self.full_reads = 0
+
+    def collection(self, name):
+        return FakeQuery(self)
+
+
+def test_passages_skip_missing_fields():
+    passages = retrieval.lease_passages('l1', lease('a.pdf', 'No pets allowed.', risks=['Auto renewal']))
+    sections = [p['section'] for p in passages]
+    assert sections == ['Key terms', 'Pet Policy', 'Risk']
+    assert 'Monthly Rent Amount: $1,000' in passages[0]['text']
+    assert 'Lease Term' not in passages[0]['text']
+
+
+def test_bm25_ranks_the_matching_clause_first():
+    passages = (retrieval.lease_passages('l1', lease('a.pdf', 'No pets allowed on the premises.'))
+                + retrieval.lease_passages('l2', lease('b.pdf', 'Cats and dogs allowed with a deposit.',
+                                                       risks=['Late fees of 20% apply after 3 days'])))
+    index = retrieval.BM25Index.build(passages)
+    hits = index.search('Are dogs allowed?', k=2)
+    assert hits[0][1]['leaseId'] == 'l2' and hits[0][1]['section'] == 'Pet Policy'
+    assert index.search('late fee', k=1)[0][1]['section'] == 'Risk'
+    assert index.search('zebra') == []
+
+
+def test_index_is_persisted_and_rebuilt_only_on_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval, 'RETRIEVAL_INDEX_DIR', str(tmp_path))
+    monkeypatch.setattr(retrieval, '_memory', retrieval.collections.OrderedDict())
+    db = FakeDb({'l1': lease('a.pdf', 'No pets allowed.')})
+
+    first = retrieval.index_for_user(db, 'user-1')
+    assert db.full_reads == 1
+    assert retrieval.load_index('user-1').signature == first.signature
+
+    retrieval._memory.clear()  # a fresh process loads it from disk
+    assert retrieval.index_for_user(db, 'user-1').signature == first.signature
+    assert db.full_reads == 1
+
+    db.leases['l2'] = lease('b.pdf', 'Dogs allowed.')
+    rebuilt = retrieval.index_for_user(db, 'user-1')
+    assert db.full_reads == 2
+    assert {p['leaseId'] for p in rebuilt.passages} == {'l1', 'l2'}
+    assert 'Dogs allowed.' in retrieval.format_passages(rebuilt.search('dogs', k=1))
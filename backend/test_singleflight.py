@@ -0,0 +1,47 @@
+import io
+
+import singleflight
+
+
+class BrokenRedis:
+    def get(self, key):
+        raise ConnectionError('redis down')
+
+
+def test_hash_stream_rewinds():
+    stream = io.BytesIO(b'%PDF-1.4 lease' * 10000)
+    assert singleflight.hash_stream(stream) == singleflight.hash_text('%PDF-1.4 lease' * 10000)
+    assert stream.tell() == 0
+
+
+def test_run_shares_result_with_later_requests(fake_redis):
+    key = singleflight.flight_key('analyze', 'user-1', 'abc')
+    calls = []
+
+    def work():
+        calls.append(1)
+        return {'leaseId': 'lease-1'}
+
+    assert singleflight.run(fake_redis, key, work) == ({'leaseId': 'lease-1'}, True)
+    assert singleflight.run(fake_redis, key, work) == ({'leaseId': 'lease-1'}, False)
+    assert len(calls) == 1
+    # The leader's claim is released once it is done
+    assert fake_redis.get(key) is None
+
+
+def test_failed_run_is_not_shared(fake_redis):
+    key = singleflight.flight_key('analyze', 'user-1', 'abc')
+    assert singleflight.run(fake_redis, key, lambda: None) == (None, True)
+    assert singleflight.run(fake_redis, key, lambda: {'ok': True}) == ({'ok': True}, True)
+
+
+def test_run_without_redis_still_runs():
+    assert singleflight.run(BrokenRedis(), 'k', lambda: 42) == (42, True)
+
+
+def test_claim_job_returns_existing_owner(fake_redis):
+    key = singleflight.flight_key('job', 'user-1', 'abc')
+    assert singleflight.claim_job(fake_redis, key, 'job-1') == 'job-1'
+    assert singleflight.claim_job(fake_redis, key, 'job-2') == 'job-1'
+    singleflight.replace_job(fake_redis, key, 'job-3')
+    assert singleflight.claim_job(fake_redis, key, 'job-4') == 'job-3'
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_cors')
+
+BACKEND_DIR = Path(__file__).parent
+# Generous enough for a cold CI runner; a regression that re-introduces an
+# eager Gemini/Firebase/PDF import costs well over this.
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', 1.5))
+HEAVY_MODULES = [
+    'google.generativeai', 'firebase_admin', 'google.cloud.firestore', 'PyPDF2',
+    'PIL', 'cryptography', 'sentry_sdk', 'pdf2image', 'pytesseract', 'fitz',
+    'pdfplumber', 'redis', 'rq',
+]
+
+
+def _import_app(code):
+    env = dict(os.environ, GEMINI_API_KEY='test-key', SENTRY_DSN='')
+    return subprocess.run([sys.executable, '-c', code], cwd=BACKEND_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def test_importing_app_does_not_load_heavy_modules():
+    code = ("import sys, json, app; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    loaded = json.loads(_import_app(code).stdout.strip().splitlines()[-1])
+    assert loaded == []
+
+def test_import_time_budget():
+    _import_app('import flask')  # warm the filesystem cache
+    started = time.perf_counter()
+    _import_app('import app')
+    elapsed = time.perf_counter() - started
+    assert elapsed < STARTUP_BUDGET_SECONDS, f"Importing app took {elapsed:.2f}s"
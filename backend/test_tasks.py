@@ -0,0 +1,83 @@
+import datetime
+import threading
+
+import pytest
+
+pytest.importorskip('rq')
+pytest.importorskip('fitz')
+import tasks  # noqa: E402
+
+
+class Job:
+    id = 'job-1'
+    connection = None
+    retries_left = 0
+
+    def __init__(self):
+        self.meta = {}
+
+    def save_meta(self):
+        pass
+
+    def get_status(self, refresh=False):
+        return 'started'
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Run jobs without Redis or Firestore; returns what the job stored as its result."""
+    stored = {}
+    monkeypatch.setattr(tasks, 'get_current_job', Job)
+    monkeypatch.setattr(tasks.write_behind, 'new_document_id', lambda collection: 'lease-1')
+    monkeypatch.setattr(tasks.checkpoints, 'load', lambda *args: (False, None))
+    monkeypatch.setattr(tasks.checkpoints, 'save', lambda *args: None)
+    monkeypatch.setattr(tasks.checkpoints, 'clear', lambda *args: None)
+    monkeypatch.setattr(tasks.job_results, 'store',
+                        lambda conn, job_id, result, user_id=None, status=None: stored.update(
+                            result=result, status=status))
+    monkeypatch.setattr(tasks.job_results, 'persist', lambda *args: None)
+    return stored
+
+
+def test_job_fails_with_a_quota_error_when_the_limit_was_used_up_while_queued(monkeypatch, stored):
+    month = datetime.date.today().strftime('%Y-%m')
+    monkeypatch.setattr(tasks, 'get_fresh_user_profile',
+                        lambda user_id: {'freeScansUsed': 3, 'lastMonthlyScan': month})
+    monkeypatch.setattr(tasks, 'analyze_lease_text', lambda *args, **kwargs: pytest.fail('analysis ran over quota'))
+    monkeypatch.setattr(tasks, 'record_scan', lambda *args: pytest.fail('scan charged over quota'))
+
+    outcome = tasks.analyze(text='The tenant shall pay rent monthly.', user_id='user-1', tier='free',
+                            should_increment=True)
+
+    assert outcome == {'quotaExceeded': True}
+    assert stored['status'] == 429
+    assert stored['result']['limitReached'] == 'monthly'
+
+
+def test_job_waits_for_admission_instead_of_failing_when_saturated(monkeypatch, stored):
+    inflight = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(tasks.llm_guard, '_inflight', inflight)
+    monkeypatch.setattr(tasks.llm_guard, 'LLM_MAX_INFLIGHT_CLUSTER', 0)
+    monkeypatch.setattr(tasks.llm_guard, 'LLM_ADMISSION_WAIT_SECONDS', 0.01)
+    monkeypatch.setattr(tasks, 'get_or_create_user_profile', lambda user_id: {})
+    monkeypatch.setattr(tasks, 'save_lease', lambda *args, **kwargs: 'lease-1')
+    monkeypatch.setattr(tasks, 'record_scan', lambda *args: None)
+
+    def analyze_lease_text(*args, **kwargs):
+        with tasks.llm_guard.admit('lease analysis'):
+            return {'score': 80}
+    monkeypatch.setattr(tasks, 'analyze_lease_text', analyze_lease_text)
+
+    # Web requests hold the process's only slot while the job starts
+    inflight.acquire()
+    threading.Timer(0.2, inflight.release).start()
+    tasks.analyze(text='The tenant shall pay rent monthly.', user_id='user-1', tier='pro')
+
+    assert stored['result']['analysis'] == {'score': 80}
+
+
+def test_cancelled_job_stores_a_final_result(monkeypatch, stored):
+    tasks.request_stop('job-1')
+    assert tasks.analyze(text='The tenant shall pay rent monthly.') == {'cancelled': True}
+    assert stored == {'result': {'status': 'cancelled'}, 'status': 410}
+    assert 'job-1' not in tasks._stop_requested
@@ -0,0 +1,60 @@
+import hashlib
+import io
+
+import pytest
+
+pytest.importorskip('flask')
+from werkzeug.datastructures import FileStorage  # noqa: E402
+from werkzeug.exceptions import RequestEntityTooLarge  # noqa: E402
+
+import uploads  # noqa: E402
+
+
+def test_spool_file_enforces_limit_while_writing():
+    spool = uploads._SpoolFile(limit=10)
+    spool.write(b'12345')
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(b'678901')
+
+
+def test_content_hash_reads_mapped_spool():
+    spool = uploads._SpoolFile(limit=None)
+    spool.write(b'%PDF-1.4 lease' * 1000)
+    upload = FileStorage(stream=spool, filename='lease.pdf')
+    assert uploads.spool_path(upload) == spool.name
+    assert uploads.content_hash(upload) == hashlib.sha256(b'%PDF-1.4 lease' * 1000).hexdigest()
+
+
+def test_in_memory_upload_falls_back_to_bytes():
+    upload = FileStorage(stream=io.BytesIO(b'abc'), filename='lease.pdf')
+    assert uploads.spool_path(upload) is None
+    assert uploads.pdf_source(upload) == b'abc'
+
+
+def test_request_budget_spans_every_file():
+    budget = uploads._UploadBudget(limit=10)
+    first = uploads._SpoolFile(limit=10, budget=budget)
+    second = uploads._SpoolFile(limit=10, budget=budget)
+    first.write(b'123456')
+    with pytest.raises(RequestEntityTooLarge):
+        second.write(b'78901')
+
+
+def test_unspooled_stream_is_hashed_in_chunks(monkeypatch):
+    monkeypatch.setattr(uploads, 'HASH_CHUNK_SIZE', 4)
+    reads = []
+
+    class Stream(io.RawIOBase):
+        def __init__(self, data):
+            self.inner = io.BytesIO(data)
+
+        def read(self, size=-1):
+            reads.append(size)
+            return self.inner.read(size)
+
+        def seek(self, *args):
+            return self.inner.seek(*args)
+
+    upload = FileStorage(stream=Stream(b'0123456789'), filename='lease.pdf')
+    assert uploads.content_hash(upload) == hashlib.sha256(b'0123456789').hexdigest()
+    assert set(reads) == {4}
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('rq')
+pytest.importorskip('fitz')
+from rq import Queue  # noqa: E402
+from rq.command import send_stop_job_command  # noqa: E402
+
+import queues  # noqa: E402
+import tasks  # noqa: E402
+
+
+@pytest.fixture
+def redis_conn():
+    conn = queues.get_redis_conn()
+    try:
+        conn.ping()
+    except Exception:
+        pytest.skip(f"no Redis at {queues.REDIS_URL}")
+    return conn
+
+
+def wait_for(predicate, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_stopping_a_job_leaves_the_warm_pool_running(redis_conn):
+    queue = Queue(queues.ANALYSIS_QUEUE, connection=redis_conn)
+    supervisor = subprocess.Popen([sys.executable, 'worker.py', '--mode', 'warm', '--processes', '2'],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        job = queue.enqueue(time.sleep, 3)
+        assert wait_for(lambda: job.get_status(refresh=True) == 'started')
+        send_stop_job_command(redis_conn, job.id)
+        time.sleep(1)
+        assert supervisor.poll() is None
+        # The sibling worker still takes jobs
+        follow_up = queue.enqueue(len, 'abc')
+        assert wait_for(lambda: follow_up.get_status(refresh=True) == 'finished')
+        assert supervisor.poll() is None
+    finally:
+        supervisor.terminate()
+        supervisor.wait(timeout=30)
+
+
+def test_stop_request_cancels_before_the_next_stage():
+    class Job:
+        id = 'job-1'
+
+    tasks.request_stop('job-1')
+    try:
+        with pytest.raises(tasks.JobCancelled):
+            tasks._run_stage(Job(), 'hash', 'llm', 85, lambda: pytest.fail('stage ran after stop'))
+    finally:
+        tasks._stop_requested.discard('job-1')
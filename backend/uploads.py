@@ -0,0 +1,149 @@
+"""Disk-spooled upload handling with per-endpoint size limits.
+
+Every uploaded file is streamed by Werkzeug's form parser straight into a
+named temporary file under ``UPLOAD_SPOOL_DIR``; none is kept in memory. The
+byte count of the whole request (every file in it together) is checked as
+each chunk is written, so an oversized body is rejected with 413 as soon as it
+crosses the route's limit, even when the client sends no Content-Length or
+splits the body over many files. Routes set their limit with
+``@upload_limit``; ``MAX_CONTENT_LENGTH`` applies to everything else.
+
+Consumers read the spool without copying it into Python bytes: PDF parsing
+opens ``spool_path(file)`` directly, and ``mapped(file)`` gives a read-only
+memoryview over an mmap of the file. ``content_hash`` hashes a stream that
+isn't spooled in ``HASH_CHUNK_SIZE`` pieces rather than reading it whole.
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+MB = 1024 * 1024
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 25 * MB))
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR') or None  # None: system temp dir
+# Non-file form fields are small; keep them from being used to buffer data
+MAX_FORM_MEMORY_SIZE = 1 * MB
+HASH_CHUNK_SIZE = 1 << 16
+
+
+def upload_limit(max_bytes):
+    """Route decorator setting the largest request body the route accepts."""
+    def decorator(view):
+        view.upload_limit = max_bytes
+        return view
+    return decorator
+
+
+class _UploadBudget:
+    """Bytes all the files of one request may still spool."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def spend(self, count):
+        self.used += count
+        if self.limit is not None and self.used > self.limit:
+            raise RequestEntityTooLarge()
+
+
+class _SpoolFile:
+    """Named temporary file that refuses writes past ``limit`` bytes or its request's ``budget``."""
+
+    def __init__(self, limit, budget=None):
+        self._file = tempfile.NamedTemporaryFile(prefix='upload-', dir=UPLOAD_SPOOL_DIR)
+        self.limit = limit
+        self.budget = budget
+        self.written = 0
+
+    def write(self, chunk):
+        self.written += len(chunk)
+        if self.limit is not None and self.written > self.limit:
+            raise RequestEntityTooLarge()
+        if self.budget is not None:
+            self.budget.spend(len(chunk))
+        return self._file.write(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class SpoolingRequest(Request):
+    max_form_memory_size = MAX_FORM_MEMORY_SIZE
+
+    @property
+    def max_content_length(self):
+        view = current_app.view_functions.get(self.endpoint) if self.url_rule else None
+        limit = getattr(view, 'upload_limit', None)
+        return limit if limit is not None else current_app.config.get('MAX_CONTENT_LENGTH')
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        # One budget for every file in the request, not a fresh limit per file
+        if getattr(self, '_upload_budget', None) is None:
+            self._upload_budget = _UploadBudget(self.max_content_length)
+        return _SpoolFile(self.max_content_length, budget=self._upload_budget)
+
+
+def spool_path(file_storage):
+    """Filesystem path of an uploaded file's spool, or None if it isn't on disk."""
+    name = getattr(file_storage.stream, 'name', None)
+    if isinstance(name, str) and os.path.exists(name):
+        file_storage.stream.flush()
+        return name
+    return None
+
+
+@contextlib.contextmanager
+def mapped(file_storage):
+    """Read-only, zero-copy memoryview of an uploaded file's contents.
+
+    Only for files spooled to disk or held in a ``BytesIO``; raises ValueError otherwise.
+    """
+    path = spool_path(file_storage)
+    if path is None:
+        stream = file_storage.stream
+        if not hasattr(stream, 'getbuffer'):
+            raise ValueError('upload is not spooled to disk')
+        with stream.getbuffer() as buffer, buffer.toreadonly() as view:
+            yield view
+        return
+    if os.path.getsize(path) == 0:
+        yield memoryview(b'')
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            yield view
+        finally:
+            view.release()
+
+
+def content_hash(file_storage):
+    """SHA-256 of an upload, hashed straight from the mapped spool or else in chunks."""
+    if spool_path(file_storage) is not None:
+        with mapped(file_storage) as view:
+            return hashlib.sha256(view).hexdigest()
+    stream = file_storage.stream
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def pdf_source(file_storage):
+    """What to hand ``extraction``: the spool path, or the bytes as a fallback."""
+    path = spool_path(file_storage)
+    if path is not None:
+        return path
+    file_storage.stream.seek(0)
+    return file_storage.stream.read()
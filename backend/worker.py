@@ -0,0 +1,127 @@
+"""Entry point for RQ worker processes.
+
+Imports only the job modules, their PDF/OCR dependencies and the shared
+analysis pipeline; none of the Flask web stack is loaded here.
+
+    python worker.py                        # warm pool (default)
+    python worker.py --mode fork            # RQ's fork-per-job worker
+    python worker.py --processes 4 --max-jobs 200
+    python worker.py --burst                # exit once the queue is empty
+
+In ``warm`` mode a supervisor preloads PyMuPDF, Tesseract and the clause
+patterns, then forks ``--processes`` long-lived ``SimpleWorker`` processes that
+run jobs in-process, so each one keeps its Gemini clients and caches between
+jobs. A process exits after ``--max-jobs`` jobs to contain leaks and the
+supervisor starts a fresh one. Warm processes run ``WarmWorker``: RQ's
+stop-job command would otherwise SIGKILL the worker's process group (a
+SimpleWorker has no work-horse of its own), so it sets a cancel flag the job
+checks between stages and during OCR instead; each process also gets its own
+process group. ``fork`` mode is RQ's default: a new work-horse per job. Per-job timings of both modes: docs/adr/0003-warm-rq-workers.md.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from rq import SimpleWorker, Worker
+
+import llm
+import queues
+import tasks
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+WORKER_MODE = os.environ.get('WORKER_MODE', 'warm')
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 2))
+WORKER_MAX_JOBS = int(os.environ.get('WORKER_MAX_JOBS', 500))
+
+
+class WarmWorker(SimpleWorker):
+    """SimpleWorker that stops a job by asking it to cancel rather than by killing processes."""
+
+    def kill_horse(self, sig=signal.SIGKILL):
+        job_id = self.get_current_job_id()
+        if job_id:
+            tasks.request_stop(job_id)
+            logger.info(f"Asked job {job_id} to stop")
+
+
+def run_fork_worker(burst):
+    queue = queues.get_queue()
+    worker = Worker([queue], connection=queues.get_redis_conn())
+    logger.info(f"Starting fork-per-job worker on queue '{queue.name}' ({queues.REDIS_URL})")
+    worker.work(burst=burst, with_scheduler=True)
+
+
+def _warm_child(max_jobs, burst):
+    # Drop the supervisor's handlers; SimpleWorker installs its own in work()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Anything signalling this worker's group must not reach the supervisor or siblings
+    os.setpgrp()
+    # Redis connections and Gemini clients are created here, after the fork
+    llm.warm_up()
+    worker = WarmWorker([queues.get_queue()], connection=queues.get_redis_conn())
+    worker.work(burst=burst, max_jobs=max_jobs, with_scheduler=True)
+
+
+def run_warm_pool(processes, max_jobs, burst):
+    tasks.warm_up()
+    logger.info(f"Starting {processes} warm worker(s) on queue '{queues.ANALYSIS_QUEUE}' "
+                f"({queues.REDIS_URL}), recycling every {max_jobs} jobs")
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        process = multiprocessing.Process(target=_warm_child, args=(max_jobs, burst),
+                                          name='rq-warm-worker')
+        process.start()
+        children[process.pid] = process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in children.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)  # warm shutdown: finish the current job
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(processes):
+        spawn()
+    while children:
+        for pid, process in list(children.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del children[pid]
+            if not stopping and not burst:
+                logger.info(f"Worker {pid} exited with code {process.exitcode}; starting a replacement")
+                spawn()
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run RQ workers for the analysis queue.')
+    parser.add_argument('--burst', action='store_true', help='Exit when the queue is empty')
+    parser.add_argument('--mode', choices=('warm', 'fork'), default=WORKER_MODE)
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES,
+                        help='Long-lived worker processes (warm mode)')
+    parser.add_argument('--max-jobs', type=int, default=WORKER_MAX_JOBS,
+                        help='Jobs per worker process before it is recycled (warm mode)')
+    args = parser.parse_args()
+
+    if args.mode == 'fork':
+        run_fork_worker(args.burst)
+    else:
+        run_warm_pool(args.processes, args.max_jobs, args.burst)
+
+
+if __name__ == '__main__':
+    main()
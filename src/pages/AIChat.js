@@ -17,7 +17,9 @@ import {
   Avatar,
   Slider,
   ListSubheader,
-  Tooltip
+  Tooltip,
+  FormControlLabel,
+  Switch
 } from '@mui/material';
 import { 
   Send as SendIcon, 
@@ -110,8 +112,11 @@ const AIChat = () => {
   const [currentPlaceholder, setCurrentPlaceholder] = useState(placeholderPrompts[0]);
   const [selectedModel, setSelectedModel] = useState(flatModels[0].value);
   const [uploadedFiles, setUploadedFiles] = useState([]);
+  const [usePortfolio, setUsePortfolio] = useState(false);
 
   const bottomRef = useRef(null);
+  // Server-side conversation: documents are uploaded and extracted only once
+  const sessionIdRef = useRef(null);
   const apiUrl = getApiBaseUrl();
 
   // --- Effects ---
@@ -161,6 +166,8 @@ const AIChat = () => {
       // Ensure the model value from the select is sent
       formData.append('model', modelSpec.value); 
       formData.append('use_refinement', modelSpec.refinement);
+      if (sessionIdRef.current) formData.append('sessionId', sessionIdRef.current);
+      formData.append('use_portfolio', usePortfolio);
       uploadedFiles.forEach(file => formData.append('files', file));
       
       const resp = await fetch(`${apiUrl}/api/chat`, {
@@ -171,10 +178,13 @@ const AIChat = () => {
 
       setMessages(prev => prev.filter(m => m.sender !== 'system'));
       if (!resp.ok) {
-        throw new Error((await resp.json()).error || 'Server error');
+        const errorData = await resp.json();
+        if (errorData.sessionExpired) sessionIdRef.current = null;
+        throw new Error(errorData.error || 'Server error');
       }
 
       const data = await resp.json();
+      if (data.sessionId) sessionIdRef.current = data.sessionId;
       
       // Handle standard refinement (e.g., for Ultra - now the only multi-response type)
       if (modelSpec.value !== 'gemini-2.5-fly' && modelSpec.refinement && data.initial && data.refined) {
@@ -224,6 +234,12 @@ const AIChat = () => {
             ])}
           </Select>
         </FormControl>
+        <Tooltip title="Answer using the most relevant clauses from leases you have already analyzed">
+          <FormControlLabel
+            control={<Switch checked={usePortfolio} onChange={(e) => setUsePortfolio(e.target.checked)} />}
+            label="Use my analyzed leases"
+          />
+        </Tooltip>
         <Box sx={{ mt: 'auto' }} />
         <Typography variant="caption" color="text.secondary">Drag files anywhere to attach (max 5).</Typography>
       </Paper>
@@ -72,6 +72,30 @@ const getScoreColor = (score) => {
   return 'success';
 };
 
+// Reads a text/event-stream response body, calling onEvent(event, data) for each event
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      let data = '';
+      block.split('\n').forEach((line) => {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      });
+      if (data) onEvent(event, JSON.parse(data));
+    }
+  }
+};
+
 const LeaseAnalysis = ({ showSnackbar }) => {
   const { leaseId } = useParams();
   const navigate = useNavigate();
@@ -213,6 +237,46 @@ const LeaseAnalysis = ({ showSnackbar }) => {
     setTextContent(e.target.value);
   };
   
+  // Shows streamed partial results as they arrive; resolves with the final
+  // response body ({ success, leaseId, analysis } or { error })
+  const readAnalysisStream = async (response) => {
+    const preview = { extracted_data: {}, clause_summaries: {}, risks: [], partial: true };
+    const show = () => setAnalysisResult({ ...preview });
+    let finalBody = { error: 'Analysis stream ended unexpectedly.' };
+
+    await readEventStream(response, (event, data) => {
+      if (event === 'rules') {
+        data.filter((rule) => rule.matched).forEach((rule) => {
+          preview.risks.push(`Flagged clause ${rule.id} (${rule.severity} severity)`);
+        });
+        show();
+      } else if (event === 'extracted') {
+        preview.extracted_data = { ...data, ...preview.extracted_data };
+        show();
+      } else if (event === 'clauses') {
+        data.forEach((clause) => {
+          preview.extracted_data = { ...preview.extracted_data, ...clause.facts };
+          if (clause.summary && clause.category !== 'Other') {
+            const previous = preview.clause_summaries[clause.category];
+            preview.clause_summaries[clause.category] = previous ? `${previous} ${clause.summary}` : clause.summary;
+          }
+          (clause.risks || []).forEach((risk) => preview.risks.push(risk.text));
+        });
+        show();
+      } else if (event === 'analysis') {
+        Object.assign(preview, data, { partial: true });
+        setScore(data.score);
+        show();
+      } else if (event === 'compliance') {
+        Object.assign(preview, data);
+        show();
+      } else if (event === 'done' || event === 'error') {
+        finalBody = data;
+      }
+    });
+    return finalBody;
+  };
+
   // Refactored: Processes a single analysis task (file or text)
   // Returns: { success: true, analysis: object, score: number, leaseId: string | null } or { success: false, error: string }
   const runSingleAnalysis = async (type, data, fileName = null) => {
@@ -253,10 +317,15 @@ const LeaseAnalysis = ({ showSnackbar }) => {
       const token = await user.getIdToken();
       let response;
 
+      // Single analyses stream their results: rule findings and key terms show up
+      // right away, Gemini's clause summaries as they arrive
+      const acceptHeader = isMultiMode ? {} : { Accept: 'text/event-stream' };
+
       if (type === 'text') {
         response = await fetch(`${apiUrl}/api/analyze`, {
           method: 'POST',
           headers: {
+            ...acceptHeader,
             'Content-Type': 'application/json',
             'Authorization': `Bearer ${token}`,
           },
@@ -268,6 +337,7 @@ const LeaseAnalysis = ({ showSnackbar }) => {
         response = await fetch(`${apiUrl}/api/analyze`, {
           method: 'POST',
           headers: {
+            ...acceptHeader,
             Authorization: `Bearer ${token}`,
           },
           body: formData,
@@ -276,11 +346,16 @@ const LeaseAnalysis = ({ showSnackbar }) => {
         throw new Error('Invalid analysis type');
       }
 
+      let result;
+      if ((response.headers.get('Content-Type') || '').includes('text/event-stream')) {
+        result = await readAnalysisStream(response);
+      } else {
+        result = await response.json();
+      }
+
       clearInterval(progressTimer);
       setAnalysisProgress(100);
 
-      const result = await response.json();
-
       if (!response.ok) {
         throw new Error(result.error || `Analysis failed with status ${response.status}`);
       }
@@ -340,6 +415,9 @@ const LeaseAnalysis = ({ showSnackbar }) => {
     } catch (err) {
       clearInterval(progressTimer);
       setAnalysisProgress(100);
+      if (!isMultiMode) {
+        setAnalysisResult(null); // Drop any partial streamed result
+      }
       console.error('Error during analysis:', err);
       // Return a structured error object
       return { success: false, error: err.message || 'An unknown error occurred' };
@@ -662,7 +740,7 @@ const LeaseAnalysis = ({ showSnackbar }) => {
       if (!analysisResult) return null;
 
       // Destructure analysisResult for easier access
-      const { extracted_data = {}, clause_summaries = {}, risks = [] } = analysisResult;
+      const { extracted_data = {}, clause_summaries = {}, risks = [], version } = analysisResult;
 
       return (
           <Paper elevation={3} sx={{ p: { xs: 2, sm: 3, md: 4 }, borderRadius: 2 }}>
@@ -687,6 +765,22 @@ const LeaseAnalysis = ({ showSnackbar }) => {
               
               <Divider sx={{ mb: 3 }}/>
 
+              {/* Changes since the previous version of this lease */}
+              {version && (
+                  <Alert severity="info" sx={{ mb: 3 }}>
+                      <Typography variant="subtitle1" sx={{ fontWeight: 'bold' }}>
+                          Version {version.number} of {version.previousFileName || 'a previous lease'}
+                      </Typography>
+                      <Typography variant="body2" sx={{ mb: version.changes.length ? 1 : 0 }}>{version.summary}</Typography>
+                      {version.changes.map((change, index) => (
+                          <Typography key={index} variant="body2">
+                              <strong>{change.change}{change.category ? ` (${change.category.replace(/_/g, ' ')})` : ''}:</strong>{' '}
+                              {change.after || change.before || change.excerpt}
+                          </Typography>
+                      ))}
+                  </Alert>
+              )}
+
               {/* Overview Section */}
               <Typography variant="h5" gutterBottom sx={{ mb: 2 }}>Overview</Typography>
               <Card variant="outlined" sx={{ mb: 3 }}>
@@ -695,9 +789,16 @@ const LeaseAnalysis = ({ showSnackbar }) => {
                            {/* Score */} 
                            <Grid item xs={12} md={4} sx={{ textAlign: 'center' }}>
                               <Typography variant="subtitle1" color="text.secondary">Overall Score</Typography>
-                              <Typography variant="h2" component="div" sx={{ fontWeight: 'bold', color: `${getScoreColor(score)}.main` }}>
-                                  {score}
-                              </Typography>
+                              {analysisResult.partial && analysisResult.score === undefined ? (
+                                  <Box sx={{ py: 2 }}>
+                                      <CircularProgress size={40} />
+                                      <Typography variant="body2" color="text.secondary">Analyzing...</Typography>
+                                  </Box>
+                              ) : (
+                                  <Typography variant="h2" component="div" sx={{ fontWeight: 'bold', color: `${getScoreColor(score)}.main` }}>
+                                      {score}
+                                  </Typography>
+                              )}
                               <Box sx={{ width: '80%', mx: 'auto' }}>
                                   <LinearProgress variant="determinate" value={score} color={getScoreColor(score)} sx={{ height: 10, borderRadius: 5 }} />
                               </Box>